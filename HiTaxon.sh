@@ -5,6 +5,7 @@ ACTION_C=false
 ACTION_P=false
 ACTION_B=false
 ACTION_A=false
+ACTION_K=false
 ACTION_T=false
 ACTION_E=false
 ACTION_F=false
@@ -14,17 +15,19 @@ HELP=false
 
 # Listing HiTaxon's command-line arguments
 usage() {
-    echo "Usage: $0 [-c|--collect] [-p|--process] [-b|--build] [-t|--train] [-e|--evaluate] [--help]"
+    echo "Usage: $0 [-c|--collect] [-p|--process] [-b|--build] [-a|--align] [-k|--kmer] [-t|--train] [-e|--evaluate] [-s|--samples] [--help]"
     echo "Options:"
     echo "  -c, --collect     Download assemblies from RefSeq"
     echo "  -p, --process     Perform data reduction of RefSeq sequences"
     echo "  -b, --build       Construct Kraken2 Database"
     echo "  -a, --align       Generate indices for BWA"
+    echo "  -k, --kmer        Generate k-mer tables for exact k-mer lookup"
     echo "  -t, --train       Train FastText machine learning model"
     echo "  -e, --evaluate    Evaluate FASTA file with either Kraken2 or Ensemble"
     echo "  -f, --fasta       Path to FASTA file"
     echo "  -o, --output      Name of output report"
-    echo "  -m, --mode        Evaluation mode, options being Kraken2, Kraken2_ML, Kraken2_BWA"
+    echo "  -s, --samples     Tab-separated sheet of report names and FASTA files, evaluated together instead of -f and -o"
+    echo "  -m, --mode        Evaluation mode, options being Kraken2, Kraken2_ML, Kraken2_BWA, Kraken2_ML_BWA, Kraken2_AUTO, Kraken2_KMER, Kraken2_BOTH"
     echo "  --help            Display this help message"
     exit 1
 }
@@ -33,48 +36,56 @@ usage() {
 while [[ $# -gt 0 ]]; do
     case "$1" in
         -c|--collect) 
-            if [ "$ACTION_P" = true ] || [ "$ACTION_B" = true ] || [ "$ACTION_A" = true ] || [ "$ACTION_T" = true ] || [ "$ACTION_E" = true ] || [ "$ACTION_F" = true ] || [ "$ACTION_O" = true ] || [ "$ACTION_M" = true ] || [ "$HELP" = true ]; then
-                echo "Options -c, -p, -b, -a, -t, -e and --help cannot be used together."
+            if [ "$ACTION_P" = true ] || [ "$ACTION_B" = true ] || [ "$ACTION_A" = true ] || [ "$ACTION_K" = true ] || [ "$ACTION_T" = true ] || [ "$ACTION_E" = true ] || [ "$ACTION_F" = true ] || [ "$ACTION_O" = true ] || [ "$ACTION_M" = true ] || [ "$HELP" = true ]; then
+                echo "Options -c, -p, -b, -a, -k, -t, -e and --help cannot be used together."
                 usage
             fi
             ACTION_C=true
             shift
             ;;
         -p|--process)
-            if [ "$ACTION_C" = true ] || [ "$ACTION_B" = true ] || [ "$ACTION_A" = true ] || [ "$ACTION_T" = true ] || [ "$ACTION_E" = true ] || [ "$ACTION_F" = true ] || [ "$ACTION_O" = true ] || [ "$ACTION_M" = true ] || [ "$HELP" = true ]; then
-                echo "Options -c, -p, -b, -a, -t, -e and --help cannot be used together."
+            if [ "$ACTION_C" = true ] || [ "$ACTION_B" = true ] || [ "$ACTION_A" = true ] || [ "$ACTION_K" = true ] || [ "$ACTION_T" = true ] || [ "$ACTION_E" = true ] || [ "$ACTION_F" = true ] || [ "$ACTION_O" = true ] || [ "$ACTION_M" = true ] || [ "$HELP" = true ]; then
+                echo "Options -c, -p, -b, -a, -k, -t, -e and --help cannot be used together."
                 usage
             fi
             ACTION_P=true
             shift
             ;;
         -b|--build)
-            if [ "$ACTION_C" = true ] || [ "$ACTION_P" = true ] || [ "$ACTION_A" = true ] || [ "$ACTION_T" = true ] || [ "$ACTION_E" = true ] || [ "$ACTION_F" = true ] || [ "$ACTION_O" = true ] || [ "$ACTION_M" = true ] || [ "$HELP" = true ]; then
-                echo "Options -c, -p, -b, -a, -t, -e and --help cannot be used together."
+            if [ "$ACTION_C" = true ] || [ "$ACTION_P" = true ] || [ "$ACTION_A" = true ] || [ "$ACTION_K" = true ] || [ "$ACTION_T" = true ] || [ "$ACTION_E" = true ] || [ "$ACTION_F" = true ] || [ "$ACTION_O" = true ] || [ "$ACTION_M" = true ] || [ "$HELP" = true ]; then
+                echo "Options -c, -p, -b, -a, -k, -t, -e and --help cannot be used together."
                 usage
             fi
             ACTION_B=true
             shift
             ;;
         -a|--align)
-            if [ "$ACTION_C" = true ] || [ "$ACTION_P" = true ] || [ "$ACTION_B" = true ] || [ "$ACTION_T" = true ] || [ "$ACTION_E" = true ] || [ "$ACTION_F" = true ] || [ "$ACTION_O" = true ] || [ "$ACTION_M" = true ] || [ "$HELP" = true ]; then
-                echo "Options -c, -p, -b, -a, -t, -e and --help cannot be used together."
+            if [ "$ACTION_C" = true ] || [ "$ACTION_P" = true ] || [ "$ACTION_B" = true ] || [ "$ACTION_K" = true ] || [ "$ACTION_T" = true ] || [ "$ACTION_E" = true ] || [ "$ACTION_F" = true ] || [ "$ACTION_O" = true ] || [ "$ACTION_M" = true ] || [ "$HELP" = true ]; then
+                echo "Options -c, -p, -b, -a, -k, -t, -e and --help cannot be used together."
                 usage
             fi
             ACTION_A=true
             shift
             ;;
+        -k|--kmer)
+            if [ "$ACTION_C" = true ] || [ "$ACTION_P" = true ] || [ "$ACTION_B" = true ] || [ "$ACTION_A" = true ] || [ "$ACTION_T" = true ] || [ "$ACTION_E" = true ] || [ "$ACTION_F" = true ] || [ "$ACTION_O" = true ] || [ "$ACTION_M" = true ] || [ "$HELP" = true ]; then
+                echo "Options -c, -p, -b, -a, -k, -t, -e and --help cannot be used together."
+                usage
+            fi
+            ACTION_K=true
+            shift
+            ;;
         -t|--train)
-            if [ "$ACTION_P" = true ] || [ "$ACTION_B" = true ] || [ "$ACTION_A" = true ] || [ "$ACTION_C" = true ] || [ "$ACTION_E" = true ] || [ "$ACTION_F" = true ] || [ "$ACTION_O" = true ] || [ "$ACTION_M" = true ] || [ "$HELP" = true ]; then
-                echo "Options -c, -p, -b, -a, -t, -e and --help cannot be used together."
+            if [ "$ACTION_P" = true ] || [ "$ACTION_B" = true ] || [ "$ACTION_A" = true ] || [ "$ACTION_K" = true ] || [ "$ACTION_C" = true ] || [ "$ACTION_E" = true ] || [ "$ACTION_F" = true ] || [ "$ACTION_O" = true ] || [ "$ACTION_M" = true ] || [ "$HELP" = true ]; then
+                echo "Options -c, -p, -b, -a, -k, -t, -e and --help cannot be used together."
                 usage
             fi
             ACTION_T=true
             shift
             ;;
         -e|--evaluate)
-            if [ "$ACTION_P" = true ] || [ "$ACTION_B" = true ] || [ "$ACTION_A" = true ] || [ "$ACTION_C" = true ] || [ "$ACTION_T" = true ] || [ "$HELP" = true ]; then
-                echo "Options -c, -p, -b, -a, -t, -e and --help cannot be used together."
+            if [ "$ACTION_P" = true ] || [ "$ACTION_B" = true ] || [ "$ACTION_A" = true ] || [ "$ACTION_K" = true ] || [ "$ACTION_C" = true ] || [ "$ACTION_T" = true ] || [ "$HELP" = true ]; then
+                echo "Options -c, -p, -b, -a, -k, -t, -e and --help cannot be used together."
                 usage
             fi
             ACTION_E=true
@@ -98,11 +109,20 @@ while [[ $# -gt 0 ]]; do
                 usage
             fi
             ;;
+        -s|--samples)
+            if [ "$ACTION_E" = true ]; then
+                SAMPLE_SHEET="$2"
+                shift 2
+            else
+                echo "Option -s can only be used with -e."
+                usage
+            fi
+            ;;
         -m|--mode)
             if [ "$ACTION_E" = true ]; then
                 MODE="$2"
-                if [ "$MODE" != "Kraken2" ] && [ "$MODE" != "Kraken2_ML" ] && [ "$MODE" != "Kraken2_BWA" ]; then
-                    echo "Invalid option for the -m flag. Please use 'Kraken2', 'Kraken2_ML', or Kraken2_BWA."
+                if [ "$MODE" != "Kraken2" ] && [ "$MODE" != "Kraken2_ML" ] && [ "$MODE" != "Kraken2_BWA" ] && [ "$MODE" != "Kraken2_ML_BWA" ] && [ "$MODE" != "Kraken2_AUTO" ] && [ "$MODE" != "Kraken2_KMER" ] && [ "$MODE" != "Kraken2_BOTH" ]; then
+                    echo "Invalid option for the -m flag. Please use 'Kraken2', 'Kraken2_ML', 'Kraken2_BWA', 'Kraken2_ML_BWA', 'Kraken2_AUTO', 'Kraken2_KMER' or 'Kraken2_BOTH'."
                     usage
                     exit 1
                 fi
@@ -113,8 +133,8 @@ while [[ $# -gt 0 ]]; do
             fi
             ;;
         --help)
-            if [ "$ACTION_P" = true ] || [ "$ACTION_B" = true ] || [ "$ACTION_C" = true ] || [ "$ACTION_A" = true ] || [ "$ACTION_T" = true ] || [ "$ACTION_E" = true ] || [ "$ACTION_F" = true ] || [ "$ACTION_O" = true ] || [ "$ACTION_M" = true ] || [ "$HELP" = true ]; then
-                echo "Options -c, -p, -b, -a, -t, -e and --help cannot be used together."
+            if [ "$ACTION_P" = true ] || [ "$ACTION_B" = true ] || [ "$ACTION_C" = true ] || [ "$ACTION_A" = true ] || [ "$ACTION_K" = true ] || [ "$ACTION_T" = true ] || [ "$ACTION_E" = true ] || [ "$ACTION_F" = true ] || [ "$ACTION_O" = true ] || [ "$ACTION_M" = true ] || [ "$HELP" = true ]; then
+                echo "Options -c, -p, -b, -a, -k, -t, -e and --help cannot be used together."
                 usage
             fi
             HELP=true
@@ -144,7 +164,12 @@ fi
 
 if [ "$ACTION_A" = true ]; then
     echo "Generating BWA indices"
-    ./scripts/align.sh $GENUS_NAMES $BWA_PATH $OUTPUT_PATH 
+    ./scripts/align.sh $GENUS_NAMES $BWA_PATH $OUTPUT_PATH "$BWA_COMBINED" "$BWA_SHARD_GB" $NUM_OF_THREADS "$BWA_BLOOM_FP" 
+fi
+
+if [ "$ACTION_K" = true ]; then
+    echo "Generating k-mer tables"
+    ./scripts/kmer.sh $GENUS_NAMES $KMER_PATH $OUTPUT_PATH
 fi
 
 if [ "$ACTION_T" = true ]; then
@@ -153,22 +178,36 @@ if [ "$ACTION_T" = true ]; then
 fi
 
 if [ "$ACTION_E" == true ]; then
-    if [ -n "$SEQUENCE_FILE" ] && [ -n "$MODE" ] && [ -n "$REPORT_NAME" ]; then
+    if [ -n "$SAMPLE_SHEET" ] && [ -n "$MODE" ]; then
+        echo "Evaluating samples of $SAMPLE_SHEET"
+        if [ "$ASSEMBLY_SUMMARY" = "default" ]; then
+            ASSEMBLY_SUMMARY="$OUTPUT_PATH/assembly_summary.txt"
+        fi
+        if [ "$MODE" = "Kraken2_ML" ]; then
+            ./scripts/batch_evaluation.sh $KRAKEN_NAME $KRAKEN_PATH $MODE $MODEL_PATH $NUM_OF_THREADS $ASSEMBLY_SUMMARY $REPORT_PATH $SAMPLE_SHEET "$OUTPUT_FORMAT"
+        else
+            ./scripts/batch_evaluation.sh $KRAKEN_NAME $KRAKEN_PATH $MODE $BWA_PATH $NUM_OF_THREADS $ASSEMBLY_SUMMARY $REPORT_PATH $SAMPLE_SHEET "$OUTPUT_FORMAT"
+        fi
+    elif [ -n "$SEQUENCE_FILE" ] && [ -n "$MODE" ] && [ -n "$REPORT_NAME" ]; then
         echo "Evaluating sequence data"
         if [ "$ASSEMBLY_SUMMARY" = "default" ]; then
             ASSEMBLY_SUMMARY="$OUTPUT_PATH/assembly_summary.txt"
         fi
         if [ "$MODE" = "Kraken2_ML" ]; then
-            ./scripts/evaluation.sh $KRAKEN_NAME $KRAKEN_PATH $MODE $MODEL_PATH $NUM_OF_THREADS $ASSEMBLY_SUMMARY $REPORT_NAME $REPORT_PATH $SEQUENCE_FILE 
+            ./scripts/evaluation.sh $KRAKEN_NAME $KRAKEN_PATH $MODE $MODEL_PATH $NUM_OF_THREADS $ASSEMBLY_SUMMARY $REPORT_NAME $REPORT_PATH $SEQUENCE_FILE "$PREDICTION_CACHE" "$BWA_ALIGNMENT" "$BWA_PATH" "$KRAKEN_SUPPORT" "$KRAKEN_STREAM" "$SHARDS" "$CHECKPOINT" "$OUTPUT_FORMAT"
+        elif [ "$MODE" = "Kraken2_ML_BWA" ] || [ "$MODE" = "Kraken2_AUTO" ] || [ "$MODE" = "Kraken2_BOTH" ]; then
+            ./scripts/evaluation.sh $KRAKEN_NAME $KRAKEN_PATH $MODE $MODEL_PATH $NUM_OF_THREADS $ASSEMBLY_SUMMARY $REPORT_NAME $REPORT_PATH $SEQUENCE_FILE "$PREDICTION_CACHE" "$BWA_ALIGNMENT" "$BWA_PATH" "$KRAKEN_SUPPORT" "$KRAKEN_STREAM" "$SHARDS" "$CHECKPOINT" "$OUTPUT_FORMAT"
+        elif [ "$MODE" = "Kraken2_KMER" ]; then
+            ./scripts/evaluation.sh $KRAKEN_NAME $KRAKEN_PATH $MODE $KMER_PATH $NUM_OF_THREADS $ASSEMBLY_SUMMARY $REPORT_NAME $REPORT_PATH $SEQUENCE_FILE "$PREDICTION_CACHE" "$BWA_ALIGNMENT" "$BWA_PATH" "$KRAKEN_SUPPORT" "$KRAKEN_STREAM" "$SHARDS" "$CHECKPOINT" "$OUTPUT_FORMAT"
         else
-            ./scripts/evaluation.sh $KRAKEN_NAME $KRAKEN_PATH $MODE $BWA_PATH $NUM_OF_THREADS $ASSEMBLY_SUMMARY $REPORT_NAME $REPORT_PATH $SEQUENCE_FILE
+            ./scripts/evaluation.sh $KRAKEN_NAME $KRAKEN_PATH $MODE $BWA_PATH $NUM_OF_THREADS $ASSEMBLY_SUMMARY $REPORT_NAME $REPORT_PATH $SEQUENCE_FILE "$PREDICTION_CACHE" "$BWA_ALIGNMENT" "$BWA_PATH" "$KRAKEN_SUPPORT" "$KRAKEN_STREAM" "$SHARDS" "$CHECKPOINT" "$OUTPUT_FORMAT"
         fi
     else
-        echo "-f, -m, -o are required."
+        echo "-f, -m, -o (or -s, -m) are required."
     fi
 fi
 
-if [ "$ACTION_C" != true ] && [ "$ACTION_P" != true ] && [ "$ACTION_A" != true ] && [ "$ACTION_B" != true ] && [ "$ACTION_T" != true ] && [ "$ACTION_E" != true ] && [ "$HELP" != true ]; then
+if [ "$ACTION_C" != true ] && [ "$ACTION_P" != true ] && [ "$ACTION_A" != true ] && [ "$ACTION_K" != true ] && [ "$ACTION_B" != true ] && [ "$ACTION_T" != true ] && [ "$ACTION_E" != true ] && [ "$HELP" != true ]; then
     usage
 fi
                                                                       
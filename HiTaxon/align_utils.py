@@ -1,4 +1,18 @@
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
 from Bio import SeqIO
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+#Location of the combined genus-tagged index within the BWA directory
+COMBINED_INDEX = "combined/combined.fa"
 
 def bwa_FASTA_generator(species, output_path, bwa_path):
     """
@@ -17,3 +31,419 @@ def bwa_FASTA_generator(species, output_path, bwa_path):
         bwa_fasta.write(f">sequence{counter}|{species}" + "\n" + str(record.seq) + "\n")
         counter +=1
     bwa_fasta.close()
+
+def shard_FASTA(bwa_path, genus, max_bytes):
+    """
+    Split the BWA FASTA of a genus into shards of whole species, each at most max_bytes unless a single species is larger, replacing {genus}.fa and its index files with {genus}.shard{i}.fa
+    Args:
+        bwa_path: path in which bwa fasta are stored
+        genus: genus of interest
+        max_bytes: maximum size of a shard
+    """
+    #Species are written one after another, so sizes are measured in order before assigning species to shards
+    species_bytes = {}
+    for line in open(f"{bwa_path}/{genus}.fa"):
+        if line.startswith(">"):
+            species = line.rstrip("\n").split("|")[1]
+        species_bytes[species] = species_bytes.get(species, 0) + len(line)
+    shard_of = {}
+    shard = 0
+    shard_bytes = 0
+    for species, size in species_bytes.items():
+        if shard_bytes > 0 and shard_bytes + size > max_bytes:
+            shard += 1
+            shard_bytes = 0
+        shard_of[species] = shard
+        shard_bytes += size
+    for old_shard in glob.glob(f"{bwa_path}/{genus}.shard*.fa*"):
+        os.remove(old_shard)
+    shards = [open(f"{bwa_path}/{genus}.shard{index}.fa", "w") for index in range(shard + 1)]
+    for line in open(f"{bwa_path}/{genus}.fa"):
+        if line.startswith(">"):
+            species = line.rstrip("\n").split("|")[1]
+        shards[shard_of[species]].write(line)
+    for shard_fasta in shards:
+        shard_fasta.close()
+    #Index files of the unsharded FASTA would otherwise still be picked up as an index of the genus
+    for unsharded in [f"{bwa_path}/{genus}.fa"] + glob.glob(f"{bwa_path}/{genus}.fa.*"):
+        os.remove(unsharded)
+    return len(shards)
+
+def combined_FASTA_generator(bwa_path, genera):
+    """
+    Concatenate the BWA FASTA files of several genera into a single genus-tagged FASTA, with headers of structure sequence|species|genus
+    Args:
+        bwa_path: path in which bwa fasta are stored
+        genera: genera to include in the combined FASTA
+    """
+    os.makedirs(os.path.dirname(f"{bwa_path}/{COMBINED_INDEX}"), exist_ok = True)
+    combined_fasta = open(f"{bwa_path}/{COMBINED_INDEX}", "w")
+    for genus in genera:
+        for fasta in genus_indices(bwa_path, genus):
+            for line in open(fasta):
+                if line.startswith(">"):
+                    line = line.rstrip("\n") + f"|{genus}\n"
+                combined_fasta.write(line)
+    combined_fasta.close()
+
+def resolve_species(best):
+    """
+    Assign the species with the highest alignment score, or NA if several species share the highest score. Returns the assigned reference and the highest score
+    Args:
+        best: dictionary with structure {species => (reference, best alignment score)}
+    """
+    top = max([score for reference, score in best.values()])
+    references = [reference for reference, score in best.values() if score == top]
+    return (references[0] if len(references) == 1 else "|NA"), top
+
+def parse_sam(lines, keep = None):
+    """
+    Resolve BWA alignments into species calls as they are read, keeping the best alignment score per read and species. BWA writes all records of a read together, so only the records of the current read are held in memory
+    Args:
+        lines: iterable of SAM lines
+        keep: if provided, function of (read name, reference name) deciding whether an alignment is considered
+    """
+    read = None
+    best = {}
+    for line in lines:
+        if line.startswith("@"):
+            continue
+        fields = line.rstrip("\n").split("\t")
+        #Skip unmapped reads and records without an alignment score
+        if len(fields) < 11 or fields[2] == "*":
+            continue
+        score = None
+        for tag in fields[11:]:
+            if tag.startswith("AS:i:"):
+                score = int(tag[5:])
+                break
+        if score is None or (keep is not None and not(keep(fields[0], fields[2]))):
+            continue
+        if fields[0] != read:
+            if read is not None:
+                yield (read,) + resolve_species(best)
+            read = fields[0]
+            best = {}
+        species = fields[2].split("|")[1]
+        if species not in best or score > best[species][1]:
+            best[species] = (fields[2], score)
+    if read is not None:
+        yield (read,) + resolve_species(best)
+
+def write_reads(stream, positions, fetch, chunk_size = 100000):
+    """
+    Write reads as FASTA to a stream, naming each read after its position, then close the stream
+    Args:
+        stream: writable text stream (i.e stdin of BWA)
+        positions: positions in FASTA of the reads to write
+        fetch: function returning the sequences of reads at a list of positions
+        chunk_size: number of reads fetched at a time
+    """
+    try:
+        for start in range(0, len(positions), chunk_size):
+            chunk = positions[start:start + chunk_size]
+            stream.write("".join([">_" + str(position) + "\n" + sequence + "\n" for position, sequence in zip(chunk, fetch(chunk))]))
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            stream.close()
+        except BrokenPipeError:
+            pass
+
+def align_reads(index, positions, fetch, num_threads = 1, options = [], keep = None):
+    """
+    Align reads against a BWA index, returning {position in FASTA => (reference, best alignment score)} for mapped reads, with "|NA" as reference for tied reads
+    Args:
+        index: file path of the indexed BWA FASTA
+        positions: positions in FASTA of the reads to align
+        fetch: function returning the sequences of reads at a list of positions
+        num_threads: number of threads used by BWA
+        options: additional options passed to bwa mem
+        keep: if provided, function of (read name, reference name) deciding whether an alignment is considered
+    """
+    #Reads are piped into BWA and its output is parsed as it is written, without temporary files
+    process = subprocess.Popen(["bwa", "mem", "-t", str(num_threads)] + options + [index, "-"], stdin = subprocess.PIPE, stdout = subprocess.PIPE, text = True)
+    writer = threading.Thread(target = write_reads, args = (process.stdin, positions, fetch))
+    writer.start()
+    alignments = {}
+    for read, reference, score in parse_sam(process.stdout, keep):
+        alignments[int(read.split("_")[1])] = (reference, score)
+    writer.join()
+    if process.wait() != 0:
+        raise RuntimeError(f"bwa mem failed for {index} with exit code {process.returncode}")
+    return alignments
+
+def merge_shards(shard_alignments, positions):
+    """
+    Merge alignments of reads against the shards of a genus index, applying the same tie rule across shards as within an index. Returns {position in FASTA => "reference|species"}, with "|NA" for unmapped or tied reads
+    Args:
+        shard_alignments: list of dictionaries with structure {position in FASTA => (reference, best alignment score)}, one per shard
+        positions: positions in FASTA of the aligned reads
+    """
+    positions_dict = {}
+    for position in positions:
+        hits = [alignments[position] for alignments in shard_alignments if position in alignments]
+        #Reads which were not mapped by BWA are left unclassified
+        if len(hits) == 0:
+            positions_dict[position] = "|NA"
+            continue
+        top = max([score for reference, score in hits])
+        references = [reference for reference, score in hits if score == top]
+        positions_dict[position] = references[0] if len(references) == 1 else "|NA"
+    return positions_dict
+
+def genus_indices(specialized_path, genus):
+    """
+    Return the BWA indices of a genus, either its shards or its single index
+    Args:
+        specialized_path: path in which BWA indices are stored
+        genus: genus of interest
+    """
+    shards = sorted(glob.glob(f"{specialized_path}/{genus}.shard*.fa"))
+    return shards if len(shards) > 0 else [f"{specialized_path}/{genus}.fa"]
+
+def align_combined(specialized_path, jobs, fetch, num_threads = 1):
+    """
+    Align reads of all genera in a single pass against the combined genus-tagged index, keeping only alignments to species of the genus each read was routed to
+    Args:
+        specialized_path: path in which BWA indices are stored
+        jobs: list of tuples with structure (genus, positions in FASTA of reads to align)
+        fetch: function returning the sequences of reads at a list of positions
+        num_threads: number of threads used by BWA
+    Returns:
+        dictionary with structure {genus => {position in FASTA => "reference|species"}}
+    """
+    genus_of = {position: genus for genus, positions in jobs for position in positions}
+    keep = lambda read, reference: reference.split("|")[2] == genus_of[int(read.split("_")[1])]
+    #Secondary alignments are reported (-a) so that alignments within the routed genus are not hidden by better alignments to other genera
+    alignments = align_reads(f"{specialized_path}/{COMBINED_INDEX}", sorted(genus_of), fetch, num_threads, ["-a"], keep)
+    return {genus: merge_shards([alignments], positions) for genus, positions in jobs}
+
+def report_alignment_modes(genus_aligned, genus_seconds, combined_aligned, combined_seconds):
+    """
+    Print the time taken by the per-genus and combined alignment passes, and how often their species calls agree
+    Args:
+        genus_aligned: species calls of the per-genus pass, with structure {genus => {position in FASTA => "reference|species"}}
+        genus_seconds: seconds spent on the per-genus pass
+        combined_aligned: species calls of the combined pass, with the same structure
+        combined_seconds: seconds spent on the combined pass
+    """
+    calls = [(positions_dict[position].split("|")[1], combined_aligned[genus][position].split("|")[1]) for genus, positions_dict in genus_aligned.items() for position in positions_dict]
+    agreement = sum([genus_call == combined_call for genus_call, combined_call in calls]) / len(calls) if len(calls) > 0 else 1.0
+    faster = "combined" if combined_seconds < genus_seconds else "per-genus"
+    speedup = max(genus_seconds, combined_seconds) / max(min(genus_seconds, combined_seconds), 1e-9)
+    print(f"Per-genus alignment: {genus_seconds:.2f}s, combined alignment: {combined_seconds:.2f}s ({faster} pass {speedup:.2f}x faster), {agreement:.2%} of species calls agree")
+
+def index_bytes(index):
+    """
+    Estimate the memory needed to load a BWA index from the size of its index files
+    Args:
+        index: file path of the indexed BWA FASTA
+    """
+    return sum([os.path.getsize(file) for file in glob.glob(f"{index}.*")])
+
+def alignment_threads(num_reads, num_threads, reads_per_thread = 20000):
+    """
+    Number of threads given to the alignment of a genus, growing with the number of reads routed to it
+    Args:
+        num_reads: number of reads to align
+        num_threads: number of threads available
+        reads_per_thread: number of reads below which an additional thread is not worth starting
+    """
+    return max(1, min(num_threads, -(-num_reads // reads_per_thread)))
+
+def process_alive(pid):
+    """
+    Check whether a process of this machine is still running
+    Args:
+        pid: process id
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class IndexResidency:
+    """
+    Keep frequently used BWA indices staged in shared memory with bwa shm, evicting the least recently used indices once the memory budget is exceeded. Staged indices outlive the process, so later samples reuse indices staged by earlier ones
+    Args:
+        specialized_path: path in which BWA indices are stored
+        max_bytes: memory budget for staged indices (None for no limit)
+        usage_file: file recording when each index was last used and which running samples use it, shared between samples (kept in the temporary directory by default, outside the index directory)
+    """
+    def __init__(self, specialized_path, max_bytes = None, usage_file = None):
+        self.specialized_path = specialized_path
+        self.max_bytes = max_bytes
+        if usage_file is None:
+            #Shared memory belongs to the machine, so the usage of each index directory is recorded in the machine's temporary directory
+            usage_file = os.path.join(tempfile.gettempdir(), f"hitaxon_shm_{hashlib.md5(os.path.abspath(specialized_path).encode()).hexdigest()}.json")
+        self.usage_file = usage_file
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.skipped = 0
+        self.stage_seconds = 0.0
+
+    def update_usage(self, update):
+        """
+        Apply a change to the usage file while holding its lock, replacing the file atomically, and return the updated usage with structure {"last_used": {index name => time}, "holders": {index name => [process ids]}}
+        Args:
+            update: function changing the usage dictionary in place
+        """
+        with open(f"{self.usage_file}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                usage = json.load(open(self.usage_file)) if os.path.exists(self.usage_file) else {}
+            except ValueError:
+                usage = {}
+            usage = {"last_used": usage.get("last_used", {}), "holders": usage.get("holders", {})}
+            update(usage)
+            temporary = f"{self.usage_file}.{os.getpid()}.tmp"
+            with open(temporary, "w") as usage_out:
+                json.dump(usage, usage_out)
+            os.replace(temporary, self.usage_file)
+        return usage
+
+    def record_use(self, usage, name):
+        """
+        Mark an index as last used now and held by this process, forgetting holders which stopped running
+        Args:
+            usage: usage dictionary
+            name: index name
+        """
+        usage["last_used"][name] = time.time()
+        for other in usage["holders"]:
+            usage["holders"][other] = [pid for pid in usage["holders"][other] if process_alive(pid)]
+        if not(os.getpid() in usage["holders"].setdefault(name, [])):
+            usage["holders"][name].append(os.getpid())
+
+    def held_elsewhere(self, usage, names):
+        """
+        Return the indices among names held by other running samples
+        Args:
+            usage: usage dictionary
+            names: index names
+        """
+        return [name for name in names if any([pid != os.getpid() and process_alive(pid) for pid in usage["holders"].get(name, [])])]
+
+    def staged(self):
+        """
+        Return indices currently staged in shared memory, with structure {index name => bytes}
+        """
+        listing = subprocess.run(["bwa", "shm", "-l"], capture_output = True, text = True).stdout
+        staged = {}
+        for line in listing.splitlines():
+            fields = line.split("\t")
+            if len(fields) >= 2 and fields[1].isdigit():
+                staged[fields[0]] = int(fields[1])
+        return staged
+
+    def stage(self, index):
+        """
+        Make sure an index is staged in shared memory, returning whether it is
+        Args:
+            index: file path of the indexed BWA FASTA
+        """
+        name = os.path.basename(index)
+        usage = self.update_usage(lambda usage: self.record_use(usage, name))
+        staged = self.staged()
+        if name in staged:
+            self.hits += 1
+            return True
+        self.misses += 1
+        size = index_bytes(index)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return False
+        start = time.time()
+        if self.max_bytes is not None and sum(staged.values()) + size > self.max_bytes:
+            if len(self.held_elsewhere(usage, staged)) > 0:
+                #bwa shm can only drop every staged index, which would pull indices from under other running samples, so this index is read from disk instead
+                self.skipped += 1
+                return False
+            #The most recently used indices which still fit are staged again after dropping every index
+            keep = []
+            total = size
+            for other in sorted(staged, key = lambda other: usage["last_used"].get(other, 0), reverse = True):
+                if total + staged[other] <= self.max_bytes and os.path.exists(f"{self.specialized_path}/{other}.bwt"):
+                    keep.append(other)
+                    total += staged[other]
+            self.evictions += len(staged) - len(keep)
+            subprocess.run(["bwa", "shm", "-d"], capture_output = True)
+            for other in keep:
+                subprocess.run(["bwa", "shm", f"{self.specialized_path}/{other}"], capture_output = True)
+        staged = subprocess.run(["bwa", "shm", index], capture_output = True).returncode == 0
+        self.stage_seconds += time.time() - start
+        return staged
+
+    def release(self):
+        """
+        Stop holding the indices used by this process, so that other samples may evict them
+        """
+        def drop_holder(usage):
+            for name in usage["holders"]:
+                usage["holders"][name] = [pid for pid in usage["holders"][name] if pid != os.getpid()]
+        self.update_usage(drop_holder)
+
+    def report(self):
+        """
+        Print hit, miss, eviction and staging-time counters
+        """
+        staged = self.staged()
+        print(f"Index residency: {self.hits} hits, {self.misses} misses, {self.evictions} evictions, {self.skipped} indices read from disk to keep those of other samples staged, {self.stage_seconds:.2f}s staging, {len(staged)} indices staged ({sum(staged.values()) / 1e9:.2f} GB)")
+
+
+def parallel_align(specialized_path, jobs, fetch, num_threads = 1, max_memory = None, residency = None, on_genus = None):
+    """
+    Align reads of several genera at once, starting the largest genera first and only starting an alignment once its threads and index fit within the remaining budget. Shards of a genus are aligned in parallel and merged
+    Args:
+        specialized_path: path in which BWA indices are stored
+        jobs: list of tuples with structure (genus, positions in FASTA of reads to align)
+        fetch: function returning the sequences of reads at a list of positions
+        num_threads: number of threads shared by all alignments
+        max_memory: memory budget in bytes for indices loaded at the same time (None for no limit)
+        residency: IndexResidency staging indices in shared memory before they are used
+        on_genus: if provided, function of (genus, {position in FASTA => "reference|species"}) called as each genus completes
+    Returns:
+        dictionary with structure {genus => {position in FASTA => "reference|species"}}
+    """
+    pending = [(genus, index, positions) for genus, positions in jobs for index in genus_indices(specialized_path, genus)]
+    pending = sorted(pending, key = lambda task: len(task[2]), reverse = True)
+    shard_alignments = {genus: [] for genus, positions in jobs}
+    num_indices = {genus: len(genus_indices(specialized_path, genus)) for genus, positions in jobs}
+    job_positions = dict(jobs)
+    running = {}
+    free_threads = num_threads
+    free_memory = max_memory
+    shared = set() if residency is None else set(residency.staged())
+    with ThreadPoolExecutor(max_workers = max(1, len(pending))) as executor:
+        while len(pending) > 0 or len(running) > 0:
+            for genus, index, positions in list(pending):
+                #Alignments wait for their full share of threads rather than starting with whatever is free
+                threads = alignment_threads(len(positions), num_threads)
+                #Indices staged in shared memory are not loaded again by each alignment
+                memory = index_bytes(index) if os.path.basename(index) not in shared else 0
+                fits = free_threads >= threads and (max_memory is None or free_memory >= memory)
+                #An index too large for the budget still runs, once nothing else is running
+                if fits or len(running) == 0:
+                    if residency is not None and residency.stage(index):
+                        memory = 0
+                    future = executor.submit(align_reads, index, positions, fetch, threads)
+                    running[future] = (genus, threads, memory)
+                    free_threads -= threads
+                    if max_memory is not None:
+                        free_memory -= memory
+                    pending.remove((genus, index, positions))
+            done, _ = wait(list(running), return_when = FIRST_COMPLETED)
+            for future in done:
+                genus, threads, memory = running.pop(future)
+                shard_alignments[genus].append(future.result())
+                if on_genus is not None and len(shard_alignments[genus]) == num_indices[genus]:
+                    on_genus(genus, merge_shards(shard_alignments[genus], job_positions[genus]))
+                free_threads += threads
+                if max_memory is not None:
+                    free_memory += memory
+    return {genus: merge_shards(shard_alignments[genus], positions) for genus, positions in jobs}
@@ -0,0 +1,134 @@
+import time
+import numpy as np
+
+from HiTaxon.align_utils import align_reads, genus_indices, merge_shards
+from HiTaxon.fasttext_utils import load_model
+from HiTaxon.kraken_utils import RANKS
+from HiTaxon.prediction_utils import batch_predict, fan_out, report_throughput, report_deduplication
+from HiTaxon.sequence_utils import KmerBatches, ReadStore, deduplicate_positions
+
+
+class SampleStores:
+    """
+    Read stores of several samples, addressed by a global position running through the reads of each sample in turn
+    Args:
+        read_stores: directories of the read stores, one per sample
+    """
+    def __init__(self, read_stores):
+        self.read_stores = read_stores
+        self.stores = [ReadStore(read_store) for read_store in read_stores]
+        self.offsets = np.cumsum([0] + [len(store) for store in self.stores])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def split(self, positions):
+        """
+        Group global positions by sample, returning {sample index => (indices in positions, positions within the sample)}
+        Args:
+            positions: global positions of reads
+        """
+        positions = np.asarray(positions, dtype = np.int64)
+        sample_of = np.searchsorted(self.offsets, positions, side = "right") - 1
+        groups = {}
+        for sample in np.unique(sample_of):
+            indices = np.flatnonzero(sample_of == sample)
+            groups[int(sample)] = (indices, positions[indices] - self.offsets[sample])
+        return groups
+
+    def fetch(self, positions):
+        """
+        Decode the reads at the given global positions
+        Args:
+            positions: global positions of reads
+        """
+        sequences = [None] * len(positions)
+        for sample, (indices, local) in self.split(positions).items():
+            for index, sequence in zip(indices, self.stores[sample].fetch(local)):
+                sequences[index] = sequence
+        return sequences
+
+    def hashes(self, positions):
+        """
+        Return the digest of the reads at the given global positions
+        Args:
+            positions: global positions of reads
+        """
+        digests = np.zeros(len(positions), dtype = "S16")
+        for sample, (indices, local) in self.split(positions).items():
+            digests[indices] = self.stores[sample].hashes(local)
+        return digests
+
+
+def route_samples(samples_calls, genera, offsets):
+    """
+    Gather the reads of every sample routed to each genus with a specialized classifier, returning {genus => global positions}
+    Args:
+        samples_calls: KrakenCalls of each sample
+        genera: genera with a specialized classifier
+        offsets: global position of the first read of each sample
+    """
+    genus_index = RANKS.index("genus")
+    genus_positions = {}
+    for kraken_calls, offset in zip(samples_calls, offsets):
+        genus_codes = kraken_calls.codes[:, genus_index]
+        for code in np.unique(genus_codes):
+            genus = kraken_calls.names[genus_index][code]
+            if genus in genera:
+                genus_positions.setdefault(genus, []).append(np.flatnonzero(genus_codes == code) + offset)
+    return {genus: np.sort(np.concatenate(positions)) for genus, positions in genus_positions.items()}
+
+def batch_classify(classifier, specialized_path, genus_positions, stores, model_cache = None, backend = "fasttext", ksize = 13, num_threads = 1, dedup = True):
+    """
+    Classify the reads of all samples genus by genus, so that each model or index is loaded once for every sample. Returns predictions with structure [(prediction, score, global position)...]
+    Args:
+        classifier: either "ML" or "BWA"
+        specialized_path: path in which models or BWA indices are stored
+        genus_positions: dictionary with structure {genus => global positions of reads routed to it}
+        stores: SampleStores of the samples
+        model_cache: ModelCache loading each model (None to load each model directly, as every model is used once per batch)
+        backend: ML inference backend, either "fasttext" or "numpy"
+        ksize: size of k-mers used by ML models
+        num_threads: number of threads used by BWA
+        dedup: classify each distinct read once per genus across all samples, copying its prediction to identical reads
+    """
+    pred_tracker = []
+    num_distinct = 0
+    start = time.time()
+    #Classify the largest genera first
+    for genus, positions in sorted(genus_positions.items(), key = lambda item: len(item[1]), reverse = True):
+        genus_start = time.time()
+        distinct = positions.tolist()
+        if dedup:
+            distinct, representative_of = deduplicate_positions(positions, stores.hashes(positions))
+            num_distinct += len(distinct)
+        preds = []
+        if classifier == "ML":
+            model_file = f"{specialized_path}/{genus}_model.bin"
+            model = load_model(model_file, backend) if model_cache is None else model_cache.get(model_file)
+            for sample, (indices, local) in stores.split(distinct).items():
+                labels, scores = batch_predict(model, KmerBatches(stores.read_stores[sample], local.tolist(), ksize, kmerize = backend != "numpy"))
+                preds.extend(zip(labels, scores, np.asarray(distinct)[indices].tolist()))
+        else:
+            #A single BWA process per index aligns the reads of every sample
+            shard_alignments = [align_reads(index, distinct, stores.fetch, num_threads) for index in genus_indices(specialized_path, genus)]
+            aligned = merge_shards(shard_alignments, distinct)
+            preds = [(aligned[position].split("|")[1], 1, position) for position in distinct]
+        report_throughput(genus, len(positions), time.time() - genus_start)
+        pred_tracker.extend(fan_out(preds, positions, representative_of) if dedup else preds)
+    if dedup:
+        report_deduplication(sum([len(positions) for positions in genus_positions.values()]), num_distinct, time.time() - start)
+    return pred_tracker
+
+def split_samples(preds, offsets):
+    """
+    Split predictions made on global positions into predictions of each sample, on positions within the sample
+    Args:
+        preds: predictions with structure [(prediction, score, global position)...]
+        offsets: global position of the first read of each sample, followed by the total number of reads
+    """
+    samples_preds = [[] for sample in range(len(offsets) - 1)]
+    for pred, score, position in preds:
+        sample = int(np.searchsorted(offsets, position, side = "right")) - 1
+        samples_preds[sample].append((pred, score, position - int(offsets[sample])))
+    return samples_preds
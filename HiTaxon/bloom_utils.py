@@ -0,0 +1,146 @@
+import math
+import numpy as np
+
+from HiTaxon.sequence_utils import canonical_kmers, reference_chunks
+
+#Constants of the two hashes combined by double hashing
+HASH_1 = np.uint64(0x9E3779B97F4A7C15)
+HASH_2 = np.uint64(0xC2B2AE3D27D4EB4F)
+
+
+class BloomFilter:
+    """
+    Bloom filter of canonical k-mers, stored as a packed bit array
+    Args:
+        num_bits: number of bits of the filter
+        num_hashes: number of bits set per k-mer
+        ksize: size of k-mers
+        bits: packed bit array, empty if not provided
+    """
+    def __init__(self, num_bits, num_hashes, ksize = 19, bits = None):
+        self.num_bits = int(num_bits)
+        self.num_hashes = int(num_hashes)
+        self.ksize = int(ksize)
+        self.bits = bits if bits is not None else np.zeros((self.num_bits + 7) // 8, dtype = np.uint8)
+
+    @classmethod
+    def for_capacity(cls, num_kmers, fp_rate = 0.01, ksize = 19):
+        """
+        Create an empty filter sized for a number of k-mers and a false-positive rate
+        Args:
+            num_kmers: expected number of distinct k-mers
+            fp_rate: false-positive rate of the filter once full
+            ksize: size of k-mers
+        """
+        num_kmers = max(1, num_kmers)
+        num_bits = max(64, math.ceil(-num_kmers * math.log(fp_rate) / math.log(2) ** 2))
+        num_hashes = max(1, round(num_bits / num_kmers * math.log(2)))
+        return cls(num_bits, num_hashes, ksize)
+
+    @classmethod
+    def load(cls, filter_file):
+        """
+        Load a filter written by save
+        Args:
+            filter_file: file path of the filter
+        """
+        saved = np.load(filter_file)
+        return cls(saved["num_bits"], saved["num_hashes"], saved["ksize"], saved["bits"])
+
+    def save(self, filter_file):
+        """
+        Write the filter to a .npz file
+        Args:
+            filter_file: file path of the filter
+        """
+        np.savez(filter_file, bits = self.bits, num_bits = self.num_bits, num_hashes = self.num_hashes, ksize = self.ksize)
+
+    def positions(self, kmers):
+        """
+        Return the bit positions of each k-mer, with shape (number of hashes, number of k-mers)
+        Args:
+            kmers: array of canonical k-mers
+        """
+        first = kmers * HASH_1
+        first ^= first >> np.uint64(31)
+        second = (kmers * HASH_2) | np.uint64(1)
+        second ^= second >> np.uint64(29)
+        return np.stack([(first + np.uint64(index) * second) % np.uint64(self.num_bits) for index in range(self.num_hashes)])
+
+    def add(self, kmers):
+        """
+        Add k-mers to the filter
+        Args:
+            kmers: array of canonical k-mers
+        """
+        positions = np.unique(self.positions(kmers))
+        byte_index = positions >> np.uint64(3)
+        masks = (np.uint8(1) << (positions & np.uint64(7)).astype(np.uint8)).astype(np.uint8)
+        #Positions are distinct, so summing the masks of a byte sets each bit once
+        starts = np.flatnonzero(np.concatenate([[True], byte_index[1:] != byte_index[:-1]])) if len(positions) > 0 else np.zeros(0, dtype = np.int64)
+        if len(starts) > 0:
+            self.bits[byte_index[starts].astype(np.int64)] |= np.add.reduceat(masks, starts).astype(np.uint8)
+
+    def contains(self, kmers):
+        """
+        Return whether each k-mer may be in the filter
+        Args:
+            kmers: array of canonical k-mers
+        """
+        positions = self.positions(kmers)
+        found = (self.bits[(positions >> np.uint64(3)).astype(np.int64)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+        return found.all(axis = 0)
+
+    def kmer_hits(self, sequences):
+        """
+        Count the k-mers of each sequence found in the filter
+        Args:
+            sequences: list of sequences, as str or bytes
+        """
+        kmers, owners = canonical_kmers(sequences, self.ksize)
+        return np.bincount(owners[self.contains(kmers)], minlength = len(sequences))
+
+
+def build_bloom_filter(fasta_files, filter_file, fp_rate = 0.01, ksize = 19):
+    """
+    Build a Bloom filter of the k-mers of a genus's BWA FASTA files, sized from their number of bases
+    Args:
+        fasta_files: BWA FASTA files of the genus (single index or shards)
+        filter_file: file path of the filter
+        fp_rate: false-positive rate of the filter
+        ksize: size of k-mers, 19 by default to match the minimum seed length of bwa mem
+    """
+    num_bases = sum([sum([len(sequence) for sequence in chunk]) for chunk in reference_chunks(fasta_files)])
+    bloom = BloomFilter.for_capacity(num_bases, fp_rate, ksize)
+    for chunk in reference_chunks(fasta_files):
+        kmers, owners = canonical_kmers(chunk, ksize)
+        bloom.add(kmers)
+    bloom.save(filter_file)
+    return bloom
+
+def bloom_file(bwa_path, genus):
+    """
+    Return the file path of the Bloom filter of a genus, stored next to its BWA index
+    Args:
+        bwa_path: path in which BWA indices are stored
+        genus: genus of interest
+    """
+    return f"{bwa_path}/{genus}.bloom.npz"
+
+def prescreen_reads(filter_file, positions, fetch, min_kmer_hits = 1, chunk_size = 100000):
+    """
+    Return the positions of reads with at least min_kmer_hits k-mers found in a genus's Bloom filter
+    Args:
+        filter_file: file path of the filter
+        positions: positions in FASTA of the reads to screen
+        fetch: function returning the sequences of reads at a list of positions
+        min_kmer_hits: minimum number of k-mers found in the filter for a read to be aligned
+        chunk_size: number of reads screened at a time
+    """
+    bloom = BloomFilter.load(filter_file)
+    passed = []
+    for start in range(0, len(positions), chunk_size):
+        chunk = positions[start:start + chunk_size]
+        hits = bloom.kmer_hits(fetch(chunk))
+        passed.extend([position for position, num_hits in zip(chunk, hits) if num_hits >= min_kmer_hits])
+    return passed
@@ -0,0 +1,212 @@
+import glob
+import hashlib
+import os
+import shutil
+import sqlite3
+import time
+import numpy as np
+
+from HiTaxon.align_utils import COMBINED_INDEX
+
+
+def file_fingerprint(files):
+    """
+    Fingerprint a model or index from the name, size and modification time of its files, so that cached predictions are invalidated when it is rebuilt
+    Args:
+        files: file paths making up the model or index
+    """
+    digest = hashlib.blake2b(digest_size = 16)
+    for file in sorted(files):
+        stat = os.stat(file)
+        digest.update(f"{os.path.basename(file)}\t{stat.st_size}\t{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+def model_fingerprint(model_file):
+    """
+    Fingerprint a genus FastText model
+    Args:
+        model_file: file path of the FastText model
+    """
+    return file_fingerprint([model_file])
+
+def index_fingerprint(specialized_path, genus):
+    """
+    Fingerprint the BWA index of a genus, including the reference FASTA and all index files of the genus or of its shards
+    Args:
+        specialized_path: path in which BWA indices are stored
+        genus: genus of interest
+    """
+    return file_fingerprint(glob.glob(f"{specialized_path}/{genus}.fa*") + glob.glob(f"{specialized_path}/{genus}.shard*.fa*"))
+
+def combined_index_fingerprint(specialized_path, genus):
+    """
+    Fingerprint the combined BWA index for reads routed to a genus, since only alignments within that genus are kept
+    Args:
+        specialized_path: path in which BWA indices are stored
+        genus: genus of interest
+    """
+    return file_fingerprint(glob.glob(f"{specialized_path}/{COMBINED_INDEX}*")) + f":{genus}"
+
+
+class PredictionCache:
+    """
+    On-disk SQLite cache of predictions made for reads in earlier samples, keyed by read digest and the fingerprint of the model or index which classified them
+    Args:
+        cache_file: file path of the SQLite database, created if missing
+        max_entries: maximum number of cached predictions, the least recently used being evicted first (None for no limit)
+    """
+    #Number of digests per query, below SQLite's limit on bound parameters
+    chunk_size = 500
+
+    def __init__(self, cache_file, max_entries = None):
+        self.cache_file = cache_file
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.connection = sqlite3.connect(cache_file)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS predictions (read_hash BLOB, fingerprint TEXT, species TEXT, score REAL, last_used REAL, PRIMARY KEY (read_hash, fingerprint))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS classifiers (name TEXT PRIMARY KEY, fingerprint TEXT)")
+        self.connection.commit()
+
+    def register(self, name, fingerprint):
+        """
+        Record the current fingerprint of a model or index, dropping predictions made by a previous version of it
+        Args:
+            name: file path of the model or index
+            fingerprint: current fingerprint of the model or index
+        """
+        row = self.connection.execute("SELECT fingerprint FROM classifiers WHERE name = ?", (name,)).fetchone()
+        if row is not None and row[0] != fingerprint:
+            self.connection.execute("DELETE FROM predictions WHERE fingerprint = ?", (row[0],))
+        self.connection.execute("INSERT OR REPLACE INTO classifiers VALUES (?, ?)", (name, fingerprint))
+        self.connection.commit()
+        return fingerprint
+
+    def lookup(self, read_hashes, fingerprint):
+        """
+        Return cached predictions, with structure {read digest => (species, score)}
+        Args:
+            read_hashes: digests of reads to look up
+            fingerprint: fingerprint of the model or index classifying the reads
+        """
+        read_hashes = [bytes(read_hash) for read_hash in read_hashes]
+        found = {}
+        now = time.time()
+        for start in range(0, len(read_hashes), self.chunk_size):
+            chunk = read_hashes[start:start + self.chunk_size]
+            placeholders = ",".join(["?"] * len(chunk))
+            rows = self.connection.execute(f"SELECT read_hash, species, score FROM predictions WHERE fingerprint = ? AND read_hash IN ({placeholders})", [fingerprint] + chunk).fetchall()
+            for read_hash, species, score in rows:
+                found[bytes(read_hash)] = (species, score)
+            self.connection.execute(f"UPDATE predictions SET last_used = ? WHERE fingerprint = ? AND read_hash IN ({placeholders})", [now, fingerprint] + chunk)
+        self.connection.commit()
+        self.hits += len(found)
+        self.misses += len(set(read_hashes)) - len(found)
+        return found
+
+    def store(self, read_hashes, fingerprint, species, scores):
+        """
+        Cache new predictions, evicting the least recently used predictions if the cache is full
+        Args:
+            read_hashes: digests of classified reads
+            fingerprint: fingerprint of the model or index which classified the reads
+            species: predicted species of each read
+            scores: score of each prediction
+        """
+        now = time.time()
+        rows = [(bytes(read_hash), fingerprint, pred, float(score), now) for read_hash, pred, score in zip(read_hashes, species, scores)]
+        self.connection.executemany("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?)", rows)
+        if self.max_entries is not None:
+            excess = self.connection.execute("SELECT COUNT(*) FROM predictions").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self.connection.execute("DELETE FROM predictions WHERE rowid IN (SELECT rowid FROM predictions ORDER BY last_used LIMIT ?)", (excess,))
+                self.evictions += excess
+        self.connection.commit()
+
+    def report(self):
+        """
+        Print hit, miss and eviction counters
+        """
+        total = self.hits + self.misses
+        rate = self.hits / total if total > 0 else 0.0
+        print(f"Prediction cache: {self.hits} hits, {self.misses} misses ({rate:.1%} hit rate), {self.evictions} evictions")
+
+    def close(self):
+        self.connection.close()
+
+
+def checkpoint_fingerprint(classifier_fingerprint, positions, read_digests, options = ""):
+    """
+    Fingerprint the work of a genus from the fingerprint of its model or index, the positions and content digests of the reads it classifies and the classification options, so that a checkpoint is only reused for identical work
+    Args:
+        classifier_fingerprint: fingerprint of the model or index of the genus
+        positions: positions in FASTA of the reads classified
+        read_digests: content digest of each read classified
+        options: classification options affecting predictions
+    """
+    digest = hashlib.blake2b(digest_size = 16)
+    digest.update(f"{classifier_fingerprint}\t{options}\n".encode())
+    digest.update(np.asarray(positions, dtype = np.int64).tobytes())
+    for read_digest in read_digests:
+        digest.update(bytes(read_digest))
+    return digest.hexdigest()
+
+
+class GenusCheckpoints:
+    """
+    Per-genus checkpoints of an evaluation, written as each genus completes so that an interrupted run can skip genera already classified
+    Args:
+        checkpoint_path: directory in which checkpoints are written
+    """
+    def __init__(self, checkpoint_path):
+        self.checkpoint_path = checkpoint_path
+        os.makedirs(checkpoint_path, exist_ok = True)
+        self.resumed = 0
+        self.resumed_reads = 0
+        self.saved = 0
+
+    def load(self, genus, fingerprint):
+        """
+        Return the predictions checkpointed for a genus, with structure [(prediction, score, position in FASTA)...], or None if there is no checkpoint or it was made for different work
+        Args:
+            genus: genus of interest
+            fingerprint: fingerprint of the work of the genus, from checkpoint_fingerprint
+        """
+        checkpoint_file = f"{self.checkpoint_path}/{genus}.npz"
+        if not(os.path.exists(checkpoint_file)):
+            return None
+        saved = np.load(checkpoint_file)
+        if str(saved["fingerprint"]) != fingerprint:
+            return None
+        preds = list(zip(saved["labels"].tolist(), saved["scores"].tolist(), saved["positions"].tolist()))
+        self.resumed += 1
+        self.resumed_reads += len(preds)
+        return preds
+
+    def save(self, genus, fingerprint, preds):
+        """
+        Checkpoint the predictions of a genus
+        Args:
+            genus: genus of interest
+            fingerprint: fingerprint of the work of the genus, from checkpoint_fingerprint
+            preds: predictions with structure [(prediction, score, position in FASTA)...]
+        """
+        #Write to a temporary file first, so that an interrupted write never leaves a truncated checkpoint
+        temp_file = f"{self.checkpoint_path}/{genus}.tmp.npz"
+        np.savez(temp_file, fingerprint = fingerprint, labels = np.array([pred[0] for pred in preds], dtype = str), scores = np.array([pred[1] for pred in preds], dtype = np.float64), positions = np.array([pred[2] for pred in preds], dtype = np.int64))
+        os.replace(temp_file, f"{self.checkpoint_path}/{genus}.npz")
+        self.saved += 1
+
+    def clear(self):
+        """
+        Remove all checkpoints, once the outputs they lead to are written
+        """
+        shutil.rmtree(self.checkpoint_path, ignore_errors = True)
+
+    def report(self):
+        """
+        Print the number of genera resumed from checkpoints and checkpointed
+        """
+        print(f"Checkpoints: {self.resumed} genera ({self.resumed_reads} reads) resumed, {self.saved} genera checkpointed")
@@ -0,0 +1,113 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ThreadPoolExecutor
+from HiTaxon.align_utils import parallel_align
+from HiTaxon.bloom_utils import bloom_file, prescreen_reads
+from HiTaxon.evaluation_utils import kraken_genus, route_genera
+from HiTaxon.pipeline_utils import routed_predictions, trained_genera
+from HiTaxon.prediction_utils import genus_parallel_predict, fan_out, report_deduplication, prediction_scores
+from HiTaxon.sequence_utils import KmerBatches, ReadStore, deduplicate_positions
+
+
+def evaluation_both(report_path, report_name, model_path, bwa_path, read_store, min_threshold = 0.5, num_workers = 1, num_threads = 1, model_cache = None, backend = "fasttext", dedup = True, prescreen = False, min_kmer_hits = 1, ksize = 13, kraken_calls = None):
+    """
+    Given Kraken2's genus classifications, generate species-level predictions with both ML classifiers and BWA, routing and deduplicating reads once and running both classifiers at the same time on the same partitions. Returns predictions in the format of evaluation and of evaluation_bwa
+    Args:
+        report_path: path to store classifer output
+        report_name: file name of output
+        model_path: path in which models are stored
+        bwa_path: path in which BWA indices are stored
+        read_store: directory of the read store of the FASTA file
+        min_threshold: minimum softmax score needed to use ML prediction
+        num_workers: number of genera classified by ML at the same time
+        num_threads: number of threads shared by all BWA alignments, which run alongside the ML workers so that both together should fit the available threads
+        model_cache: ModelCache used to keep models resident between samples
+        backend: ML inference backend, either "fasttext" or "numpy"
+        dedup: classify each distinct read once per genus, copying its predictions to identical reads
+        prescreen: skip the alignment of reads with fewer than min_kmer_hits k-mers in the Bloom filter of their genus
+        min_kmer_hits: minimum number of k-mers found in the Bloom filter for a read to be aligned
+        ksize: size of k-mers used by ML models
+        kraken_calls: KrakenCalls ingested from Kraken2's output, used instead of {report_name}_lineage_kraken.csv
+    """
+    store = ReadStore(read_store)
+    genus_codes, genus_names = kraken_genus(report_path, report_name, kraken_calls)
+    ml_genera = trained_genera("ML", model_path)
+    bwa_genera = trained_genera("BWA", bwa_path)
+
+    #Route reads once into a partition per genus, shared by both classifiers
+    partitions = route_genera(genus_codes, genus_names, ml_genera | bwa_genera)[1]
+    ml_jobs = []
+    bwa_jobs = []
+    ml_duplicates = []
+    bwa_duplicates = []
+    screened = []
+    start = time.time()
+    for genus, positions in partitions.items():
+        if not(genus in ml_genera or genus in bwa_genera):
+            continue
+        distinct = positions
+        representative_of = positions
+        if dedup:
+            distinct, representative_of = deduplicate_positions(positions, store.hashes(positions))
+        if genus in ml_genera:
+            ml_jobs.append((genus, f"{model_path}/{genus}_model.bin", KmerBatches(read_store, distinct, ksize, kmerize = backend != "numpy"), distinct))
+            ml_duplicates.append((positions, representative_of))
+        if genus in bwa_genera:
+            bwa_duplicates.append((positions, representative_of))
+            aligned_positions = distinct
+            if prescreen and os.path.exists(bloom_file(bwa_path, genus)):
+                #Reads sharing too few k-mers with the genus cannot align, so they are left unclassified without running BWA
+                aligned_positions = prescreen_reads(bloom_file(bwa_path, genus), distinct, store.fetch, min_kmer_hits)
+                passed = set(aligned_positions)
+                screened.extend([position for position in distinct if position not in passed])
+            if len(aligned_positions) > 0:
+                bwa_jobs.append((genus, aligned_positions))
+
+    #BWA alignments run as subprocesses driven from a background thread, while ML runs from the main thread in worker processes or in-process
+    with ThreadPoolExecutor(max_workers = 1) as executor:
+        bwa_future = executor.submit(parallel_align, bwa_path, bwa_jobs, store.fetch, num_threads)
+        #Forking while the alignment threads hold locks is unsafe, so ML workers are spawned and load their models themselves
+        ml_preds = genus_parallel_predict(ml_jobs, num_workers, model_cache, backend, start_method = "spawn")
+        aligned = bwa_future.result()
+    bwa_preds = [(aligned[genus][position].split("|")[1], 1, position) for genus, positions in bwa_jobs for position in positions]
+    bwa_preds.extend([("NA", 1, position) for position in screened])
+    if dedup:
+        ml_positions = np.concatenate([positions for positions, _ in ml_duplicates]) if ml_duplicates else []
+        bwa_positions = np.concatenate([positions for positions, _ in bwa_duplicates]) if bwa_duplicates else []
+        report_deduplication(len(ml_positions) + len(bwa_positions), len(ml_preds) + len(bwa_preds), time.time() - start)
+        ml_preds = fan_out(ml_preds, ml_positions, np.concatenate([representative_of for _, representative_of in ml_duplicates]) if ml_duplicates else [])
+        bwa_preds = fan_out(bwa_preds, bwa_positions, np.concatenate([representative_of for _, representative_of in bwa_duplicates]) if bwa_duplicates else [])
+    ml_output = routed_predictions(genus_codes, genus_names, ml_preds, ml_genera, min_threshold)
+    bwa_output = routed_predictions(genus_codes, genus_names, bwa_preds, bwa_genera)
+    return ml_output, bwa_output, prediction_scores(ml_preds, len(genus_codes))
+
+def agreement_table(ml_ensemble, bwa_ensemble, ml_output, bwa_output, ml_scores):
+    """
+    Compare ML and BWA calls of each read, labelling each read "agree" or "disagree" when both classifiers assign a species, "ml_only" or "bwa_only" when one does, "neither" when none does and "kraken2" when no classifier handles its genus
+    Args:
+        ml_ensemble: ensemble of Kraken2 and ML predictions
+        bwa_ensemble: ensemble of Kraken2 and BWA predictions
+        ml_output: ML predictions returned by evaluation_both
+        bwa_output: BWA predictions returned by evaluation_both
+        ml_scores: softmax score of the ML prediction of each read, NaN for reads not classified by a model
+    """
+    ml_species = ml_output["species"].values.astype(str)
+    bwa_species = bwa_output["species"].values.astype(str)
+    routed = (ml_output["genus"].values.astype(str) != "nan") | (bwa_output["genus"].values.astype(str) != "nan")
+    ml_call = ml_species != "NA"
+    bwa_call = bwa_species != "NA"
+    agreement = np.select([~routed, ml_call & bwa_call & (ml_species == bwa_species), ml_call & bwa_call, ml_call, bwa_call], ["kraken2", "agree", "disagree", "ml_only", "bwa_only"], default = "neither")
+    return pd.DataFrame({"genus": ml_ensemble["genus"].values, "ml": ml_species, "ml_score": ml_scores, "bwa": bwa_species, "ensemble_ml": ml_ensemble["species"].values, "ensemble_bwa": bwa_ensemble["species"].values, "agreement": agreement})
+
+def report_agreement(agreement):
+    """
+    Print the number and fraction of reads in each agreement category
+    Args:
+        agreement: agreement table returned by agreement_table
+    """
+    counts = agreement["agreement"].value_counts()
+    total = len(agreement)
+    print("Agreement: " + ", ".join([f"{category} {counts.get(category, 0)} ({counts.get(category, 0) / total if total > 0 else 0.0:.1%})" for category in ["agree", "disagree", "ml_only", "bwa_only", "neither", "kraken2"]]))
@@ -2,10 +2,18 @@ import numpy as np
 import pandas as pd
 import fasttext as ft
 import os
+import time
 
 from Bio import SeqIO
 from ete3 import NCBITaxa
 from HiTaxon.train_utils import build_kmers
+from HiTaxon.prediction_utils import genus_parallel_predict, split_batches, fan_out, report_deduplication, prediction_scores
+from HiTaxon.sequence_utils import ReadStore, KmerBatches, deduplicate_positions, read_hashes, fasta_hashes
+from HiTaxon.cache_utils import model_fingerprint, index_fingerprint, combined_index_fingerprint, checkpoint_fingerprint
+from HiTaxon.align_utils import parallel_align, align_combined, report_alignment_modes, COMBINED_INDEX
+from HiTaxon.bloom_utils import bloom_file, prescreen_reads
+from HiTaxon.kmer_utils import KmerTable, table_exists
+from HiTaxon.table_utils import table_path, read_table
 
 
 def expand_lineage(prediction, ncbi, reference_assembly):
@@ -51,6 +59,118 @@ def expand_predictions(predictions, ncbi, reference_assembly):
     kraken2_expanded = pd.DataFrame(kraken2_expanded)
     return kraken2_expanded
 
+def hit_support(prediction, hits, lineages, ncbi):
+    """
+    Return the fraction of a read's non-ambiguous k-mers that Kraken2 mapped to its predicted taxon or to a descendant of it
+    Args:
+        prediction: taxid predicted by Kraken2
+        hits: Kraken2 hit list of the read, as taxid:number of k-mers separated by spaces
+        lineages: dictionary with structure {taxid => set of taxids in its lineage}, filled as taxids are seen
+        ncbi: NCBITaxa()
+    """
+    if prediction == 0:
+        return 0.0
+    matched = 0
+    total = 0
+    #Hits are listed as taxid:number of k-mers, with A marking ambiguous k-mers and |:| separating mates
+    for hit in str(hits).split(" "):
+        if hit == "|:|" or hit.startswith("A:") or ":" not in hit:
+            continue
+        taxid, count = hit.split(":")
+        taxid = int(taxid)
+        total += int(count)
+        if taxid == 0:
+            continue
+        if not(taxid in lineages):
+            try:
+                lineages[taxid] = set(ncbi.get_lineage(taxid) or [taxid])
+            except:
+                lineages[taxid] = {taxid}
+        if prediction in lineages[taxid]:
+            matched += int(count)
+    return matched / total if total > 0 else 0.0
+
+def kraken_species_support(predictions, ncbi):
+    """
+    Return, for each read, the fraction of its non-ambiguous k-mers that Kraken2 mapped to its predicted taxon or to a descendant of it
+    Args:
+        predictions: file path of Kraken2 output
+        ncbi: NCBITaxa()
+    """
+    kraken_predictions = pd.read_csv(predictions, delimiter = "\t", header = None, usecols = [2, 4])
+    lineages = {}
+    return np.array([hit_support(prediction, hits, lineages, ncbi) for prediction, hits in zip(kraken_predictions[2].values, kraken_predictions[4].values)])
+
+def kraken_lineage(report_path, report_name, kraken_calls = None):
+    """
+    Return Kraken2's lineage of each read, from calls ingested while Kraken2 ran if given, else from {report_name}_lineage_kraken.csv or .parquet
+    Args:
+        report_path: path to store classifer output
+        report_name: file name of output
+        kraken_calls: KrakenCalls ingested from Kraken2's output
+    """
+    if kraken_calls is not None:
+        return kraken_calls.lineage()
+    return read_table(table_path(report_path, report_name, "lineage_kraken"))
+
+def kraken_genus(report_path, report_name, kraken_calls = None):
+    """
+    Return Kraken2's genus of each read as integer codes, alongside the name of each code ("NA" for reads without a genus), without expanding the name of every read
+    Args:
+        report_path: path to store classifer output
+        report_name: file name of output
+        kraken_calls: KrakenCalls ingested from Kraken2's output
+    """
+    if kraken_calls is not None:
+        return kraken_calls.genus_codes()
+    genus = read_table(table_path(report_path, report_name, "lineage_kraken"), columns = ["genus"], categorical = True)["genus"].astype("category")
+    names = np.append(genus.cat.categories.values.astype(object), "NA")
+    codes = genus.cat.codes.values.astype(np.int64)
+    return np.where(codes < 0, len(names) - 1, codes), names
+
+def route_genera(genus_codes, genus_names, trained_genus, subset = None):
+    """
+    Route reads on their Kraken2 genus codes to the genera with a specialized classifier, only the names of the codes being compared to trained genera. Returns the routed genus of each read ("nan" for reads without a classifier) and a dictionary with structure {genus => [position in FASTA ... position in FASTA]}, reads not routed being listed under "nan"
+    Args:
+        genus_codes: Kraken2 genus code of each read
+        genus_names: name of each genus code
+        trained_genus: genera with a specialized classifier
+        subset: positions in FASTA of the only reads to route, the genus of other reads being kept (None to route all reads)
+    """
+    trained_genus = set(trained_genus)
+    trained = np.array([name in trained_genus for name in genus_names], dtype = bool)
+    routed_names = np.where(trained, genus_names, "nan").astype(object)
+    routed = trained[genus_codes]
+    if subset is not None:
+        in_subset = np.zeros(len(genus_codes), dtype = bool)
+        in_subset[subset] = True
+        routed &= in_subset
+    positions = np.flatnonzero(routed)
+    order = np.argsort(genus_codes[positions], kind = "stable")
+    codes, starts = np.unique(genus_codes[positions][order], return_index = True)
+    genus_positions = {genus_names[code]: group.tolist() for code, group in zip(codes, np.split(positions[order], starts[1:]))}
+    unrouted = np.flatnonzero(~routed)
+    if len(unrouted) > 0:
+        genus_positions["nan"] = unrouted.tolist()
+    return routed_names[genus_codes], genus_positions
+
+def confident_species_calls(report_path, report_name, min_support, ncbi, kraken_calls = None):
+    """
+    Return whether each read has a Kraken2 species call supported by at least min_support of its k-mers, in which case specialized classification can be skipped
+    Args:
+        report_path: path to store classifer output
+        report_name: file name of output
+        min_support: minimum fraction of non-ambiguous k-mers mapped to the predicted species
+        ncbi: NCBITaxa()
+        kraken_calls: KrakenCalls ingested from Kraken2's output with k-mer support, used instead of {report_name}.kraken
+    """
+    reference = kraken_lineage(report_path, report_name, kraken_calls)
+    support = kraken_calls.support if kraken_calls is not None and kraken_calls.support is not None else kraken_species_support(f"{report_path}/{report_name}.kraken", ncbi)
+    confident = (support >= min_support) & reference["species"].notna().values & (reference["species"].astype(str).values != "NA")
+    fraction = confident.sum() / len(confident) if len(confident) > 0 else 0.0
+    print(f"Kraken2 species support: {confident.sum()} of {len(confident)} reads ({fraction:.1%}) skipped specialized classification")
+    return confident
+
 def fasta2kmer(fasta, report_path, report_name, ksize = 13):
     """
     K-merize FASTA file 
@@ -84,7 +204,7 @@ def fasta2bwa(fasta, report_path, report_name):
         counter +=1
    f.close()
 
-def evaluation(report_path, report_name, model_path, min_threshold = 0.5):
+def evaluation(report_path, report_name, model_path, min_threshold = 0.5, num_workers = 1, batch_size = 100000, read_store = None, ksize = 13, model_cache = None, backend = "fasttext", dedup = True, prediction_cache = None, subset = None, kraken_calls = None, checkpoints = None, return_scores = False, sequence_file = None):
     """
     Given Kraken2's genus classifications, generate species-level predictions using machine learning classifiers
     Args:
@@ -92,51 +212,116 @@ def evaluation(report_path, report_name, model_path, min_threshold = 0.5):
         report_name: file name of output
         model_path: path in which models are stored
         min_threshold: minimum softmax score needed to use ML prediction
+        num_workers: number of genera classified at the same time
+        batch_size: number of reads sent to FastText per call
+        read_store: if provided, reads are fetched from this read store and k-merized one batch at a time instead of loading {report_name}_kmer.txt
+        ksize: size of k-mers to be created from sequence data when using a read store
+        model_cache: ModelCache used to keep models resident between samples
+        backend: inference backend, either "fasttext" or "numpy" (vectorized NumPy inference on the same models)
+        dedup: classify each distinct read once per genus, copying its prediction to identical reads
+        prediction_cache: PredictionCache holding predictions made for reads of earlier samples
+        subset: positions in FASTA of the only reads to classify, the others being left unclassified (None to classify all reads)
+        kraken_calls: KrakenCalls ingested from Kraken2's output, used instead of {report_name}_lineage_kraken.csv
+        checkpoints: GenusCheckpoints in which the predictions of each genus are saved as it completes, and from which genera classified by an interrupted run are resumed
+        return_scores: also return the softmax score of each read's prediction, NaN for reads not classified by a model
+        sequence_file: FASTA file from which {report_name}_kmer.txt was made, whose reads key the prediction cache and checkpoints when no read store is given
     """
-    #Create tuple of sequences and position for k-merized FASTA file
-    evaluation_file = open(f"{report_path}/{report_name}_kmer.txt", "r")
-    counter = 0
-    seqs = []
-    for sequence in evaluation_file:
-            seqs.append((sequence[:-1], counter))
-            counter += 1
+    if read_store is None:
+        #Create tuple of sequences and position for k-merized FASTA file
+        evaluation_file = open(f"{report_path}/{report_name}_kmer.txt", "r")
+        counter = 0
+        seqs = []
+        for sequence in evaluation_file:
+                seqs.append((sequence[:-1], counter))
+                counter += 1
+        if prediction_cache is not None or checkpoints is not None:
+            #Predictions are keyed on read bases rather than k-merized reads, so that runs with and without a read store share them
+            if sequence_file is None:
+                raise ValueError("The prediction cache and checkpoints need the FASTA file of the reads when no read store is given")
+            hashes = fasta_hashes(sequence_file)
+            if len(hashes) != counter:
+                raise ValueError(f"{sequence_file} holds {len(hashes)} reads, but {report_name}_kmer.txt holds {counter}")
+        key_hashes = lambda positions: hashes[np.asarray(positions, dtype = np.int64)]
+    else:
+        #Reads are fetched by position and k-merized per batch
+        store = ReadStore(read_store)
+        counter = len(store)
+        key_hashes = store.hashes
     
     ranks = ['phylum', 'class', 'order', 'family', 'genus', "species"]
     model_preds = np.zeros(shape = (counter, 6))
     model_preds = pd.DataFrame(model_preds, columns = ranks)
 
     #Generate predictions for only those genera in which trained classifiers are present
-    trained_genus = [model.split("_")[0] for model in os.listdir(model_path)]
-    reference = pd.read_csv(f"{report_path}/{report_name}_lineage_kraken.csv")
-    reference["genus"] = reference["genus"].apply(lambda x: x if x in trained_genus else "nan")
-    model_preds["genus"] = reference["genus"]
-    
-    #Create dictionary with structure: {Prediction1 => [(Kraken2_Prediction, position in FASTA) ... (Kraken2_Prediction, position in FASTA)], Prediction2 => [(Kraken2_Prediction, position in FASTA) ... (Kraken2_Prediction, position in FASTA)] }
-    genus_preds_dict = {}
-    position = 0
-    for genus in model_preds["genus"].values:
-        pred = genus
-        if not(pred in genus_preds_dict.keys()):
-            genus_preds_dict[pred] = []
-        genus_preds_dict[pred].append((pred, position))
-        position +=1
+    trained_genus = [model.split("_")[0] for model in os.listdir(model_path) if not(model.startswith("."))]
+    genus_codes, genus_names = kraken_genus(report_path, report_name, kraken_calls)
+    #Create dictionary with structure: {Prediction1 => [position in FASTA ... position in FASTA], Prediction2 => [position in FASTA ... position in FASTA]}, reads outside the subset not being routed to any model
+    model_preds["genus"], genus_preds_dict = route_genera(genus_codes, genus_names, trained_genus, subset)
 
     #Create list of precictons with structure: => [(prediction, score, position in FASTA)...(prediction, score, position in FASTA)]
     pred_tracker = []
-    for genus, seq_list in genus_preds_dict.items():
+    jobs = []
+    duplicates = []
+    cached_preds = []
+    uncached_reads = []
+    resumed_preds = []
+    fingerprints = {}
+    for genus, positions in genus_preds_dict.items():
         if str(genus) == "nan":
-            for seq in seq_list:
+            for position in positions:
                 pred = "NA"
                 score = 0.49
-                pred_tracker.append((pred, score, seq[1]))
+                pred_tracker.append((pred, score, position))
             continue
         else:
-            model = ft.load_model(f"{model_path}/{genus}_model.bin")
-            for seq in seq_list:
-                model_prediction = model.predict(seqs[seq[1]][0])
-                pred = model_prediction[0][0].split("label__")[1]
-                score = model_prediction[1][0]
-                pred_tracker.append((pred, score, seq[1]))
+            if dedup:
+                #Only classify the first copy of identical reads
+                keys = [seqs[position][0] for position in positions] if read_store is None else store.hashes(positions)
+                distinct_positions, representative_of = deduplicate_positions(positions, keys)
+                duplicates.append((positions, representative_of))
+                positions = distinct_positions
+            model_file = f"{model_path}/{genus}_model.bin"
+            if prediction_cache is not None:
+                #Reuse predictions made by the same model for reads seen in earlier samples
+                fingerprint = prediction_cache.register(model_file, model_fingerprint(model_file))
+                keys = key_hashes(positions)
+                cached = prediction_cache.lookup(keys, fingerprint)
+                is_cached = [bytes(key) in cached for key in keys]
+                cached_preds.extend([cached[bytes(key)] + (position,) for key, position, hit in zip(keys, positions, is_cached) if hit])
+                positions = [position for position, hit in zip(positions, is_cached) if not(hit)]
+                uncached_reads.append((fingerprint, [key for key, hit in zip(keys, is_cached) if not(hit)], positions))
+                if len(positions) == 0:
+                    continue
+            if checkpoints is not None:
+                #Skip genera already classified by an interrupted run on the same reads and model
+                keys = key_hashes(positions)
+                fingerprints[genus] = checkpoint_fingerprint(model_fingerprint(model_file), positions, keys, f"{backend}\t{ksize}")
+                saved = checkpoints.load(genus, fingerprints[genus])
+                if saved is not None:
+                    resumed_preds.extend(saved)
+                    continue
+            if read_store is None:
+                batches = split_batches([seqs[position][0] for position in positions], batch_size)
+            else:
+                batches = KmerBatches(read_store, positions, ksize, batch_size, kmerize = backend != "numpy")
+            jobs.append((genus, model_file, batches, positions))
+    #Classify reads of each genus in batches, running several genera at once
+    start = time.time()
+    on_genus = None if checkpoints is None else lambda genus, preds: checkpoints.save(genus, fingerprints[genus], preds)
+    genus_preds = genus_parallel_predict(jobs, num_workers, model_cache, backend, on_genus)
+    genus_preds.extend(resumed_preds)
+    if prediction_cache is not None:
+        preds_by_position = {pred[2]: pred for pred in genus_preds}
+        for fingerprint, keys, positions in uncached_reads:
+            preds = [preds_by_position[position] for position in positions]
+            prediction_cache.store(keys, fingerprint, [pred[0] for pred in preds], [pred[1] for pred in preds])
+        genus_preds.extend(cached_preds)
+    if dedup:
+        positions = np.concatenate([positions for positions, _ in duplicates]) if duplicates else []
+        representative_of = np.concatenate([representative_of for _, representative_of in duplicates]) if duplicates else []
+        report_deduplication(len(positions), len(genus_preds), time.time() - start)
+        genus_preds = fan_out(genus_preds, positions, representative_of)
+    pred_tracker.extend(genus_preds)
     #Resort predictions based on original position in FASTA
     pred_tracker = sorted(pred_tracker, key = lambda model_output: model_output[2])
     species_pred = []
@@ -147,92 +332,144 @@ def evaluation(report_path, report_name, model_path, min_threshold = 0.5):
         else:
             species_pred.append("NA")
     model_preds["species"] = species_pred
+    if return_scores:
+        return model_preds, prediction_scores(genus_preds, counter)
     return model_preds
 
-def evaluation_bwa(report_path, report_name, specialized_path):
+def evaluation_bwa(report_path, report_name, specialized_path, read_store = None, dedup = True, prediction_cache = None, num_threads = 1, max_memory = None, residency = None, alignment = "genus", prescreen = False, min_kmer_hits = 1, subset = None, kraken_calls = None, checkpoints = None):
     """
     Given Kraken2's genus classifications, generate species-level predictions using BWA
     Args:
         report_path: path to store classifer output
         report_name: file name of output
         model_path: path in which BWA indices are stored
+        read_store: if provided, reads are fetched from this read store instead of loading {report_name}_bwa.fa
+        dedup: align each distinct read once per genus, copying its alignment to identical reads
+        prediction_cache: PredictionCache holding species calls made for reads of earlier samples
+        num_threads: number of threads shared by all BWA alignments
+        max_memory: memory budget in bytes for BWA indices loaded at the same time (None for no limit)
+        residency: IndexResidency keeping BWA indices staged in shared memory between samples
+        alignment: "genus" to align reads against the index of their genus, "combined" to align all reads in a single pass against the combined genus-tagged index, or "compare" to run both, report which is faster and keep per-genus calls
+        prescreen: skip the alignment of reads with fewer than min_kmer_hits k-mers in the Bloom filter of their genus, leaving them unclassified
+        min_kmer_hits: minimum number of k-mers found in the Bloom filter for a read to be aligned
+        subset: positions in FASTA of the only reads to align, the others being left unclassified (None to align all reads)
+        kraken_calls: KrakenCalls ingested from Kraken2's output, used instead of {report_name}_lineage_kraken.csv
+        checkpoints: GenusCheckpoints in which the alignments of each genus are saved as it completes, and from which genera aligned by an interrupted run are resumed
     """
-    #Create tuple of sequences and position for BWA FASTA file
-    evaluation_file = open(f"{report_path}/{report_name}_bwa.fa", "r")
-    counter = 0
-    seqs = []
-    for record in SeqIO.parse(evaluation_file, "fasta"):
-        seqs.append((str(record.seq), counter))
-        counter += 1
+    if read_store is None:
+        #Create tuple of sequences and position for BWA FASTA file
+        evaluation_file = open(f"{report_path}/{report_name}_bwa.fa", "r")
+        counter = 0
+        seqs = []
+        for record in SeqIO.parse(evaluation_file, "fasta"):
+            seqs.append((str(record.seq), counter))
+            counter += 1
+        fetch = lambda positions: [seqs[position][0] for position in positions]
+    else:
+        store = ReadStore(read_store)
+        counter = len(store)
+        fetch = store.fetch
 
     ranks = ['phylum', 'class', 'order', 'family', 'genus', "species"]
     model_preds = np.zeros(shape = (counter, 6))
     model_preds = pd.DataFrame(model_preds, columns = ranks)
 
     #Generate predictions for only those genera in which BWA indices are present
-    trained_genus = np.unique([indices.split(".")[0] for indices in os.listdir(specialized_path)])
-    reference = pd.read_csv(f"{report_path}/{report_name}_lineage_kraken.csv")
-    reference["genus"] = reference["genus"].apply(lambda x: x if x in trained_genus else "nan")
-    model_preds["genus"] = reference["genus"]
-
-    #Create dictionary with structure: {Prediction1 => [(Kraken2_Prediction, position in FASTA) ... (Kraken2_Prediction, position in FASTA)], Prediction2 => [(Kraken2_Prediction, position in FASTA) ... (Kraken2_Prediction, position in FASTA)] }
-    genus_preds_dict = {}
-    position = 0
-    for genus in model_preds["genus"].values:
-        pred = genus
-        if not(pred in genus_preds_dict.keys()):
-            genus_preds_dict[pred] = []
-        genus_preds_dict[pred].append((pred, position))
-        position +=1
+    trained_genus = np.unique([indices.split(".")[0] for indices in os.listdir(specialized_path) if not(indices.startswith("."))])
+    genus_codes, genus_names = kraken_genus(report_path, report_name, kraken_calls)
+    #Create dictionary with structure: {Prediction1 => [position in FASTA ... position in FASTA], Prediction2 => [position in FASTA ... position in FASTA]}, reads outside the subset not being routed to any index
+    model_preds["genus"], genus_preds_dict = route_genera(genus_codes, genus_names, trained_genus, subset)
 
     #Create list of precictons with structure: => [(prediction, score, position in FASTA)...(prediction, score, position in FASTA)]
     pred_tracker = []
-    for genus, seq_list in genus_preds_dict.items():
+    jobs = []
+    genus_calls = {}
+    duplicates = {}
+    uncached_reads = {}
+    resumed_jobs = []
+    resumed = {}
+    fingerprints = {}
+    screened = [0, 0, 0]
+    for genus, positions in genus_preds_dict.items():
         if str(genus) == "nan":
-            for seq in seq_list:
+            for position in positions:
                 pred = "NA"
                 score = 0.49
-                pred_tracker.append((pred, score, seq[1]))
+                pred_tracker.append((pred, score, position))
             continue
         else:
-            #Create temporary fasta file composed of reads predicted to be in the genera of interest
-            temp_fasta = open(f"{report_path}/temp.fasta", "w")
-            counters_seen = []
-            for seq in seq_list:
-                temp_fasta.write(">"+"_"+str(seq[1])+"\n"+seqs[seq[1]][0]+"\n")
-                counters_seen.append(seq[1])
-            temp_fasta.close()
-            #Generate alignments using BWA and returns alignment scores 
-            os.system(f"bwa mem -t 80 {specialized_path}/{genus}.fa {report_path}/temp.fasta > {report_path}/{report_name}_{genus}_aligned.sam")
-            os.system(f"awk '($1 !~ /^@/ && $3 != \"*\") {{score = \"NA\"; for(i = 12; i <= NF; i++) {{if($i ~ /^AS:i:/) {{split($i, arr, \":\"); score = arr[3]; break;}}}} print $1 \"\t\" $3 \"\t\" score}}' {report_path}/{report_name}_{genus}_aligned.sam > {report_path}/{report_name}_{genus}_reads_to_reference.tsv")
-            read_2_reference = pd.read_csv(f"{report_path}/{report_name}_{genus}_reads_to_reference.tsv", header = None, sep = "\t")
-            read_2_reference["species"] = read_2_reference[1].apply(lambda x: x.split("|")[1])
-            #Retain highest alignment for read,species pair 
-            read_2_reference = read_2_reference.sort_values(2, ascending=False).drop_duplicates((0, "species")).sort_index()
-            #Only assign species classification if alignment score for read X,species X pair  != alignment score for read X,species Y pair 
-            r2r_dict_holder = {}
-            for index, row in read_2_reference.iterrows():
-                if row[0] not in r2r_dict_holder.keys():
-                          r2r_dict_holder[row[0]] = (row[1], row[2])
+            counters_seen = positions
+            if dedup:
+                #Only align the first copy of identical reads
+                keys = [seqs[position][0] for position in counters_seen] if read_store is None else store.hashes(counters_seen)
+                counters_seen, representative_of = deduplicate_positions(counters_seen, keys)
+                duplicates[genus] = dict(zip(positions, representative_of.tolist()))
+            genus_calls[genus] = {}
+            if prediction_cache is not None:
+                #Reuse species calls made by the same index for reads seen in earlier samples
+                if alignment == "combined":
+                    fingerprint = prediction_cache.register(f"{specialized_path}/{COMBINED_INDEX}|{genus}", combined_index_fingerprint(specialized_path, genus))
                 else:
-                          if row[2] >  r2r_dict_holder[row[0]][1]:
-                                    r2r_dict_holder[row[0]] = (row[1], row[2])
-                          elif row[2] == r2r_dict_holder[row[0]][1]:
-                                    r2r_dict_holder[row[0]] = ("|NA", row[2])
-                          else:
-                                    continue
-            new_read_2_reference = pd.DataFrame(r2r_dict_holder).T
-            new_read_2_reference = new_read_2_reference.reset_index()
-            new_read_2_reference  = new_read_2_reference.rename(columns ={"index":0, 0:1, 1:2})
-            read_2_reference = new_read_2_reference
-            #Add back reads which were not mapped by BWA
-            positions_mapped = [int(z.split("_")[1])for z in read_2_reference[0].values]
-            positions_missing = list(set(counters_seen) - set(positions_mapped))
-            positions_dict = dict(zip(positions_mapped, read_2_reference[1].values))
-            for missing_read_position in positions_missing:
-                positions_dict[missing_read_position] = "|NA"
-            for seq in seq_list:
-                pred_tracker.append((positions_dict[seq[1]].split("|")[1], 1, seq[1]))
+                    fingerprint = prediction_cache.register(f"{specialized_path}/{genus}.fa", index_fingerprint(specialized_path, genus))
+                keys = read_hashes(fetch(counters_seen)) if read_store is None else store.hashes(counters_seen)
+                cached = prediction_cache.lookup(keys, fingerprint)
+                genus_calls[genus] = {position: "|" + cached[bytes(key)][0] for key, position in zip(keys, counters_seen) if bytes(key) in cached}
+                uncached_reads[genus] = (fingerprint, {position: key for key, position in zip(keys, counters_seen) if bytes(key) not in cached})
+                counters_seen = [position for position in counters_seen if position not in genus_calls[genus]]
+            if prescreen and len(counters_seen) > 0 and os.path.exists(bloom_file(specialized_path, genus)):
+                #Reads sharing too few k-mers with the genus cannot align, so they are left unclassified without running BWA
+                passed = prescreen_reads(bloom_file(specialized_path, genus), counters_seen, fetch, min_kmer_hits)
+                passed_set = set(passed)
+                genus_calls[genus].update({position: "|NA" for position in counters_seen if position not in passed_set})
+                screened[0] += len(counters_seen)
+                screened[1] += len(counters_seen) - len(passed)
+                screened[2] += len(passed) == 0
+                counters_seen = passed
+            if len(counters_seen) > 0 and checkpoints is not None:
+                #Skip genera already aligned by an interrupted run on the same reads and index
+                keys = read_hashes(fetch(counters_seen)) if read_store is None else store.hashes(counters_seen)
+                index = combined_index_fingerprint(specialized_path, genus) if alignment == "combined" else index_fingerprint(specialized_path, genus)
+                fingerprints[genus] = checkpoint_fingerprint(index, counters_seen, keys, alignment)
+                saved = checkpoints.load(genus, fingerprints[genus])
+                if saved is not None:
+                    resumed[genus] = {position: reference for reference, score, position in saved}
+                    resumed_jobs.append((genus, counters_seen))
+                    continue
+            if len(counters_seen) > 0:
+                jobs.append((genus, counters_seen))
+
+    if prescreen:
+        print(f"Prescreen: {screened[1]} of {screened[0]} reads skipped alignment, {screened[2]} genera needed no alignment")
+    start = time.time()
+    save = lambda genus, positions_dict: checkpoints.save(genus, fingerprints[genus], [(reference, 1, position) for position, reference in positions_dict.items()])
+    if alignment == "combined":
+        #Align reads of all genera in a single BWA process
+        aligned = align_combined(specialized_path, jobs, fetch, num_threads)
+        print(f"Combined alignment: {sum([len(positions) for genus, positions in jobs])} reads in {time.time() - start:.2f}s")
+        if checkpoints is not None:
+            for genus, counters_seen in jobs:
+                save(genus, aligned[genus])
+    else:
+        #Align reads of each genus, running several genera at once within the thread and memory budget
+        aligned = parallel_align(specialized_path, jobs, fetch, num_threads, max_memory, residency, None if checkpoints is None else save)
+    if alignment == "compare":
+        genus_seconds = time.time() - start
+        combined_start = time.time()
+        combined_aligned = align_combined(specialized_path, jobs, fetch, num_threads)
+        report_alignment_modes(aligned, genus_seconds, combined_aligned, time.time() - combined_start)
+    aligned.update(resumed)
+    for genus, counters_seen in jobs + resumed_jobs:
+        if prediction_cache is not None:
+            fingerprint, key_of = uncached_reads[genus]
+            prediction_cache.store([key_of[position] for position in counters_seen], fingerprint, [aligned[genus][position].split("|")[1] for position in counters_seen], [1] * len(counters_seen))
+        genus_calls[genus].update(aligned[genus])
+    if dedup:
+        report_deduplication(sum([len(representative_of) for representative_of in duplicates.values()]), sum([len(set(representative_of.values())) for representative_of in duplicates.values()]), time.time() - start)
+    for genus, positions_dict in genus_calls.items():
+        if dedup:
+            positions_dict = {position: positions_dict[representative] for position, representative in duplicates[genus].items()}
+        for position, reference in positions_dict.items():
+            pred_tracker.append((reference.split("|")[1], 1, position))
 
     #Resort predictions based on original position in FASTA
     pred_tracker = sorted(pred_tracker, key = lambda model_output: model_output[2])
@@ -243,30 +480,231 @@ def evaluation_bwa(report_path, report_name, specialized_path):
     model_preds["species"] = species_pred
     return model_preds
 
-def ensemble(report_path, report_name, mode):
+def report_tiers(num_reads, num_ml, num_bwa, num_bwa_classified):
+    """
+    Print the fraction of reads settled at each tier of the ML-then-BWA cascade
+    Args:
+        num_reads: number of reads evaluated
+        num_ml: number of reads classified by ML with a score of at least min_threshold
+        num_bwa: number of low-confidence reads sent to BWA
+        num_bwa_classified: number of reads sent to BWA which were assigned a species
+    """
+    fraction = lambda count: count / num_reads if num_reads > 0 else 0.0
+    num_other = num_reads - num_ml - num_bwa
+    print(f"Cascade: {num_ml} reads ({fraction(num_ml):.1%}) classified by ML, {num_bwa} reads ({fraction(num_bwa):.1%}) sent to BWA of which {num_bwa_classified} were classified, {num_other} reads ({fraction(num_other):.1%}) left to Kraken2")
+
+def evaluation_cascade(report_path, report_name, model_path, bwa_path, min_threshold = 0.5, num_workers = 1, read_store = None, model_cache = None, backend = "fasttext", dedup = True, prediction_cache = None, num_threads = 1, max_memory = None, residency = None, alignment = "genus", prescreen = False, min_kmer_hits = 1, subset = None, kraken_calls = None, sequence_file = None):
+    """
+    Given Kraken2's genus classifications, generate species-level predictions using machine learning classifiers, then align only the reads whose softmax score is below min_threshold with BWA
+    Args:
+        report_path: path to store classifer output
+        report_name: file name of output
+        model_path: path in which models are stored
+        bwa_path: path in which BWA indices are stored
+        min_threshold: minimum softmax score needed to use ML prediction, reads below it being sent to BWA
+        num_workers: number of genera classified by ML at the same time
+        read_store: if provided, reads are fetched from this read store instead of loading {report_name}_kmer.txt and {report_name}_bwa.fa
+        model_cache: ModelCache used to keep models resident between samples
+        backend: ML inference backend, either "fasttext" or "numpy"
+        dedup: classify each distinct read once per genus, copying its prediction to identical reads
+        prediction_cache: PredictionCache holding predictions made for reads of earlier samples
+        num_threads: number of threads shared by all BWA alignments
+        max_memory: memory budget in bytes for BWA indices loaded at the same time (None for no limit)
+        residency: IndexResidency keeping BWA indices staged in shared memory between samples
+        alignment: BWA alignment mode, either "genus", "combined" or "compare"
+        prescreen: skip the alignment of reads with fewer than min_kmer_hits k-mers in the Bloom filter of their genus
+        min_kmer_hits: minimum number of k-mers found in the Bloom filter for a read to be aligned
+        subset: positions in FASTA of the only reads to classify, the others being left unclassified (None to classify all reads)
+        kraken_calls: KrakenCalls ingested from Kraken2's output, used instead of {report_name}_lineage_kraken.csv
+        sequence_file: FASTA file from which {report_name}_kmer.txt was made, whose reads key the prediction cache when no read store is given
+    """
+    model_preds = evaluation(report_path, report_name, model_path, min_threshold, num_workers, read_store = read_store, model_cache = model_cache, backend = backend, dedup = dedup, prediction_cache = prediction_cache, subset = subset, kraken_calls = kraken_calls, sequence_file = sequence_file)
+    #Reads left unclassified by ML, including those of genera without a model, fall through to BWA
+    low_confidence = np.flatnonzero(model_preds["species"].values == "NA")
+    if subset is not None:
+        low_confidence = np.intersect1d(low_confidence, subset)
+    bwa_preds = evaluation_bwa(report_path, report_name, bwa_path, read_store, dedup = dedup, prediction_cache = prediction_cache, num_threads = num_threads, max_memory = max_memory, residency = residency, alignment = alignment, prescreen = prescreen, min_kmer_hits = min_kmer_hits, subset = low_confidence, kraken_calls = kraken_calls)
+    sent = low_confidence[bwa_preds["genus"].values[low_confidence] != "nan"]
+    model_preds.loc[sent, "species"] = bwa_preds["species"].values[sent]
+    model_preds.loc[sent, "genus"] = bwa_preds["genus"].values[sent]
+    num_reads = len(model_preds) if subset is None else len(subset)
+    report_tiers(num_reads, num_reads - len(low_confidence), len(sent), int((bwa_preds["species"].values[sent] != "NA").sum()))
+    return model_preds
+
+def evaluation_planned(report_path, report_name, plan, model_path, bwa_path, min_threshold = 0.5, num_workers = 1, read_store = None, model_cache = None, backend = "fasttext", dedup = True, prediction_cache = None, num_threads = 1, max_memory = None, residency = None, alignment = "genus", prescreen = False, min_kmer_hits = 1, subset = None, kraken_calls = None, sequence_file = None):
+    """
+    Given Kraken2's genus classifications, generate species-level predictions with the classifier chosen for each genus by a routing plan, reads of genera routed to Kraken2 being left unclassified
+    Args:
+        report_path: path to store classifer output
+        report_name: file name of output
+        plan: dictionary with structure {genus => "ML", "BWA" or "Kraken2"}
+        model_path: path in which models are stored
+        bwa_path: path in which BWA indices are stored
+        min_threshold: minimum softmax score needed to use ML prediction
+        num_workers: number of genera classified by ML at the same time
+        read_store: if provided, reads are fetched from this read store instead of loading {report_name}_kmer.txt and {report_name}_bwa.fa
+        model_cache: ModelCache used to keep models resident between samples
+        backend: ML inference backend, either "fasttext" or "numpy"
+        dedup: classify each distinct read once per genus, copying its prediction to identical reads
+        prediction_cache: PredictionCache holding predictions made for reads of earlier samples
+        num_threads: number of threads shared by all BWA alignments
+        max_memory: memory budget in bytes for BWA indices loaded at the same time (None for no limit)
+        residency: IndexResidency keeping BWA indices staged in shared memory between samples
+        alignment: BWA alignment mode, either "genus", "combined" or "compare"
+        prescreen: skip the alignment of reads with fewer than min_kmer_hits k-mers in the Bloom filter of their genus
+        min_kmer_hits: minimum number of k-mers found in the Bloom filter for a read to be aligned
+        subset: positions in FASTA of the only reads to classify, the others being left unclassified (None to classify all reads)
+        kraken_calls: KrakenCalls ingested from Kraken2's output, used instead of {report_name}_lineage_kraken.csv
+        sequence_file: FASTA file from which {report_name}_kmer.txt was made, whose reads key the prediction cache when no read store is given
+    """
+    genus_codes, genus_names = kraken_genus(report_path, report_name, kraken_calls)
+    #Look up the plan once per genus code rather than once per read
+    routes = np.array([plan.get(genus, "Kraken2") for genus in genus_names], dtype = object)[genus_codes]
+    if subset is not None:
+        routed = np.zeros(len(routes), dtype = bool)
+        routed[subset] = True
+        routes[~routed] = "Kraken2"
+    ml_subset = np.flatnonzero(routes == "ML")
+    bwa_subset = np.flatnonzero(routes == "BWA")
+    start = time.time()
+    model_preds = evaluation(report_path, report_name, model_path, min_threshold, num_workers, read_store = read_store, model_cache = model_cache, backend = backend, dedup = dedup, prediction_cache = prediction_cache, subset = ml_subset, kraken_calls = kraken_calls, sequence_file = sequence_file)
+    ml_seconds = time.time() - start
+    start = time.time()
+    bwa_preds = evaluation_bwa(report_path, report_name, bwa_path, read_store, dedup = dedup, prediction_cache = prediction_cache, num_threads = num_threads, max_memory = max_memory, residency = residency, alignment = alignment, prescreen = prescreen, min_kmer_hits = min_kmer_hits, subset = bwa_subset, kraken_calls = kraken_calls)
+    bwa_seconds = time.time() - start
+    model_preds.loc[bwa_subset, "species"] = bwa_preds["species"].values[bwa_subset]
+    model_preds.loc[bwa_subset, "genus"] = bwa_preds["genus"].values[bwa_subset]
+    print(f"Plan: {len(ml_subset)} reads classified by ML in {ml_seconds:.2f}s, {len(bwa_subset)} reads aligned with BWA in {bwa_seconds:.2f}s, {len(routes) - len(ml_subset) - len(bwa_subset)} reads left to Kraken2")
+    return model_preds
+
+def report_plan_baseline(planned, planned_seconds, baseline, baseline_seconds):
+    """
+    Print the agreement of species predictions made following a routing plan with those of always running a classifier, and the time of both
+    Args:
+        planned: predictions made following the plan
+        planned_seconds: seconds spent following the plan
+        baseline: predictions made by always running the classifier
+        baseline_seconds: seconds spent always running the classifier
+    """
+    agreement = (planned["species"].astype(str).values == baseline["species"].astype(str).values).mean() if len(planned) > 0 else 1.0
+    speedup = baseline_seconds / planned_seconds if planned_seconds > 0 else float("inf")
+    print(f"Plan vs always-run baseline: {agreement:.1%} of species predictions agree, {planned_seconds:.2f}s vs {baseline_seconds:.2f}s ({speedup:.2f}x)")
+
+def evaluation_kmer(report_path, report_name, specialized_path, read_store, min_hits = 1, dedup = True, batch_size = 100000, kraken_calls = None):
+    """
+    Given Kraken2's genus classifications, generate species-level predictions by exact lookup of read k-mers in per-genus k-mer tables
+    Args:
+        report_path: path to store classifer output
+        report_name: file name of output
+        specialized_path: path in which k-mer tables are stored
+        read_store: read store from which reads are fetched
+        min_hits: minimum number of k-mers supporting a species for it to be assigned
+        dedup: classify each distinct read once per genus, copying its prediction to identical reads
+        batch_size: number of reads classified at a time
+        kraken_calls: KrakenCalls ingested from Kraken2's output, used instead of {report_name}_lineage_kraken.csv
+    """
+    store = ReadStore(read_store)
+    counter = len(store)
+
+    ranks = ['phylum', 'class', 'order', 'family', 'genus', "species"]
+    model_preds = np.zeros(shape = (counter, 6))
+    model_preds = pd.DataFrame(model_preds, columns = ranks)
+
+    #Generate predictions for only those genera in which k-mer tables are present
+    trained_genus = [genus for genus in os.listdir(specialized_path) if table_exists(f"{specialized_path}/{genus}")]
+    genus_codes, genus_names = kraken_genus(report_path, report_name, kraken_calls)
+    #Create dictionary with structure: {Prediction1 => [position in FASTA ... position in FASTA], Prediction2 => [position in FASTA ... position in FASTA]}
+    model_preds["genus"], genus_preds_dict = route_genera(genus_codes, genus_names, trained_genus)
+
+    #Create list of precictons with structure: => [(prediction, score, position in FASTA)...(prediction, score, position in FASTA)]
+    pred_tracker = []
+    num_reads = 0
+    num_distinct = 0
+    start = time.time()
+    for genus, positions in genus_preds_dict.items():
+        if str(genus) == "nan":
+            pred_tracker.extend([("NA", 0.49, position) for position in positions])
+            continue
+        counters_seen = positions
+        representative_of = None
+        if dedup:
+            #Only classify the first copy of identical reads
+            counters_seen, representative_of = deduplicate_positions(positions, store.hashes(positions))
+            num_reads += len(positions)
+            num_distinct += len(counters_seen)
+        table = KmerTable(f"{specialized_path}/{genus}")
+        preds = []
+        for batch_start in range(0, len(counters_seen), batch_size):
+            batch = counters_seen[batch_start:batch_start + batch_size]
+            species, scores = table.classify(store.fetch(batch), min_hits)
+            preds.extend(zip(species, scores, batch))
+        pred_tracker.extend(fan_out(preds, positions, representative_of) if dedup else preds)
+    if dedup:
+        report_deduplication(num_reads, num_distinct, time.time() - start)
+
+    #Resort predictions based on original position in FASTA
+    pred_tracker = sorted(pred_tracker, key = lambda model_output: model_output[2])
+    model_preds["species"] = [model_output[0] for model_output in pred_tracker]
+    return model_preds
+
+def missing_calls(calls):
+    """
+    Return a mask of the rows of a rank column without a call, either missing or the string "nan"
+    Args:
+        calls: column of taxa at one rank
+    """
+    missing = calls.isna().values
+    if calls.dtype == object:
+        missing = missing | (calls.values == "nan")
+    return missing
+
+def ensemble_species(reference, specialized_species):
+    """
+    Ensemble species calls of a specialized classifier with those of the classifier routing reads to it, leaving species unclassified where the reference has no genus, using the reference species where the specialized classifier has no call and the specialized call otherwise. Spaces in species names are replaced by underscores
+    Args:
+        reference: lineage of each read from the routing classifier (Kraken2 or Kaiju)
+        specialized_species: species column of the specialized predictions
+    """
+    species = specialized_species.astype(str).to_numpy(dtype = object, copy = True)
+    fallback = missing_calls(specialized_species)
+    species[fallback] = reference["species"][fallback].astype(str).values
+    species[missing_calls(reference["genus"])] = "nan"
+    #Species names are few, so replace spaces once per distinct name
+    codes, names = pd.factorize(species)
+    names = np.array([name.replace(" ", "_") for name in names], dtype = object)
+    return names[codes]
+
+def ensemble_lineages(primary, fallback, ranks):
+    """
+    Ensemble the lineages of two classifiers, using the fallback lineage where only the fallback classifier calls a species and the primary lineage otherwise
+    Args:
+        primary: lineage of each read from the preferred classifier
+        fallback: lineage of each read from the other classifier
+        ranks: rank columns of the ensembled lineage
+    """
+    use_fallback = missing_calls(primary["species"]) & ~missing_calls(fallback["species"])
+    return pd.DataFrame({rank: np.where(use_fallback, fallback[rank].values, primary[rank].values) for rank in ranks}, index = primary.index)
+
+def ensemble(report_path, report_name, mode, kraken_calls = None):
     """
     Ensemble Kraken2-informed specialized classifiers predictions and Kraken2 classifications
     Args:
         report_path: path to store classifer output
         report_name: file name of output
+        kraken_calls: KrakenCalls ingested from Kraken2's output, used instead of {report_name}_lineage_kraken.csv
     """
     if mode == "Kraken2_ML":
-        specialized_species = pd.read_csv(f"{report_path}/{report_name}_ml.csv")
+        suffix = "ml"
+    elif mode == "Kraken2_ML_BWA":
+        suffix = "ml_bwa"
+    elif mode == "Kraken2_AUTO":
+        suffix = "auto"
+    elif mode == "Kraken2_KMER":
+        suffix = "kmer"
     else:
-        specialized_species = pd.read_csv(f"{report_path}/{report_name}_bwa.csv")
-    reference = pd.read_csv(f"{report_path}/{report_name}_lineage_kraken.csv")
-    ensemble_preds = []
-    for i in range(0, len(reference)):
-        #If Kraken2 has no genus predictions, ensemble leaves species unclassified
-        if str(reference["genus"].iloc[i]) == "nan":
-            ensemble_preds.append("nan")
-        #IF specialized model has no species prediction, ensemble uses Kraken2 prediction
-        elif str(specialized_species["species"].iloc[i]) == "nan":
-            ensemble_preds.append(reference["species"].iloc[i])
-        #By default, uses specialized model predictions
-        else:
-            ensemble_preds.append(str(specialized_species["species"].iloc[i]))
-    ensemble_preds = [str(i).replace(" ","_") for i in ensemble_preds]
-    reference["species"] = ensemble_preds
+        suffix = "bwa"
+    #Only species calls of the specialized classifier are ensembled
+    specialized_species = read_table(table_path(report_path, report_name, suffix), columns = ["species"], categorical = True)["species"]
+    reference = kraken_lineage(report_path, report_name, kraken_calls)
+    reference["species"] = ensemble_species(reference, specialized_species)
     return reference
-
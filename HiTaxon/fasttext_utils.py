@@ -0,0 +1,351 @@
+import mmap
+import struct
+import numpy as np
+
+#FastText binary format constants
+FASTTEXT_MAGIC = 793712314
+LOSS_SOFTMAX = 3
+LOSS_OVA = 4
+EOS = b"</s>"
+MAX_SIGMOID = 8
+SIGMOID_TABLE_SIZE = 512
+SIGMOID_TABLE = (1.0 / (1.0 + np.exp(-(np.arange(SIGMOID_TABLE_SIZE + 1, dtype = np.float32) * 2 * MAX_SIGMOID / SIGMOID_TABLE_SIZE - MAX_SIGMOID)))).astype(np.float32)
+
+#Lookup tables between bases and their 2-bit codes
+BASES = np.frombuffer(b"ACGT", dtype = np.uint8)
+CODES = np.zeros(256, dtype = np.uint64)
+CODES[BASES] = np.arange(4, dtype = np.uint64)
+VALID = np.zeros(256, dtype = bool)
+VALID[BASES] = True
+
+
+def fnv_hash(buf, starts, lengths):
+    """
+    Vectorized version of FastText's 32-bit FNV-1a hash of each token
+    Args:
+        buf: uint8 array holding the tokens
+        starts: start of each token in buf
+        lengths: length of each token
+    """
+    hashes = np.full(len(starts), 2166136261, dtype = np.uint32)
+    for i in range(int(lengths.max()) if len(lengths) > 0 else 0):
+        mask = lengths > i
+        #FastText sign-extends each byte before xor-ing it into the hash
+        byte = buf[starts[mask] + i].astype(np.int8).astype(np.int32).astype(np.uint32)
+        hashes[mask] = (hashes[mask] ^ byte) * np.uint32(16777619)
+    return hashes
+
+class NumpyFastText:
+    """
+    Vectorized, NumPy-only inference for supervised FastText models saved as .bin files
+    Args:
+        model_file: file path of the FastText model
+    """
+    def __init__(self, model_file):
+        self.model_file = model_file
+        with open(model_file, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        magic, version = struct.unpack_from("<ii", data, 0)
+        if magic != FASTTEXT_MAGIC:
+            raise ValueError(f"{model_file} is not a FastText model")
+        #Args: dim, ws, epoch, minCount, neg, wordNgrams, loss, model, bucket, minn, maxn, lrUpdateRate, t
+        args = struct.unpack_from("<12id", data, 8)
+        self.dim, self.word_ngrams, self.loss, self.bucket, self.maxn = args[0], args[5], args[6], args[8], args[10]
+        if self.loss not in (LOSS_SOFTMAX, LOSS_OVA):
+            raise ValueError(f"{model_file} uses a loss which is not supported by the NumPy backend, only softmax and one-vs-all are")
+        if self.maxn > 0:
+            raise ValueError(f"{model_file} uses character n-grams, which are not supported by the NumPy backend")
+        pos = 8 + 12 * 4 + 8
+        #Dictionary: size, nwords, nlabels, ntokens, pruneidx_size, then (word, count, type) entries
+        size, self.nwords, self.nlabels, _, pruneidx_size = struct.unpack_from("<iiiqq", data, pos)
+        pos += 4 * 3 + 8 * 2
+        words = []
+        for i in range(size):
+            end = data.find(b"\0", pos)
+            words.append(data[pos:end])
+            pos = end + 1 + 8 + 1
+        pos += max(pruneidx_size, 0) * 8
+        quant_input = data[pos]
+        pos += 1
+        if quant_input or pruneidx_size > 0:
+            raise ValueError(f"{model_file} is quantized, which is not supported by the NumPy backend")
+        self.input_matrix, pos = self.load_matrix(model_file, data, pos)
+        pos += 1
+        self.output_matrix, pos = self.load_matrix(model_file, data, pos)
+        data.close()
+        self.labels = [word.decode() for word in words[self.nwords:]]
+        self.build_vocabulary(words[:self.nwords])
+
+    @staticmethod
+    def load_matrix(model_file, data, pos):
+        """
+        Memory-map a dense matrix stored at a byte offset of the model file
+        Args:
+            model_file: file path of the FastText model
+            data: memory-mapped model file
+            pos: byte offset of the matrix
+        """
+        m, n = struct.unpack_from("<qq", data, pos)
+        pos += 16
+        matrix = np.memmap(model_file, dtype = np.float32, mode = "r", offset = pos, shape = (m, n))
+        return matrix, pos + m * n * 4
+
+    def build_vocabulary(self, words):
+        """
+        Index vocabulary by 2-bit code for k-mers composed only of A, C, G and T, keeping a dictionary for all other words
+        Args:
+            words: list of words in the model's dictionary, in id order
+        """
+        self.eos = words.index(EOS) if EOS in words else -1
+        lengths = np.array([len(word) for word in words], dtype = np.int64)
+        candidates = np.array([len(word) for word in words if word != EOS], dtype = np.int64)
+        #Words are k-mers, so the most common word length is the k-mer size the model was trained with
+        self.ksize = int(np.bincount(candidates).argmax()) if len(candidates) > 0 else 0
+        ids = np.flatnonzero(lengths == self.ksize)
+        if len(ids) > 0 and 0 < self.ksize <= 32:
+            kmers = np.frombuffer(b"".join([words[i] for i in ids]), dtype = np.uint8).reshape(-1, self.ksize)
+            valid = VALID[kmers].all(axis = 1)
+            ids = ids[valid]
+            codes = self.encode(kmers[valid])
+        else:
+            ids = np.zeros(0, dtype = np.int64)
+            codes = np.zeros(0, dtype = np.uint64)
+        order = np.argsort(codes)
+        self.codes = codes[order]
+        self.code_ids = ids[order]
+        coded = set(ids.tolist())
+        self.other_words = {word: i for i, word in enumerate(words) if i not in coded}
+
+    def encode(self, kmers):
+        """
+        Convert an array of k-mers (one per row) into 2-bit codes
+        Args:
+            kmers: uint8 array of shape (number of k-mers, ksize)
+        """
+        codes = np.zeros(len(kmers), dtype = np.uint64)
+        for i in range(kmers.shape[1]):
+            codes = (codes << np.uint64(2)) | CODES[kmers[:, i]]
+        return codes
+
+    def token_ids(self, buf, starts, lengths):
+        """
+        Map tokens to word ids, with -1 for out-of-vocabulary tokens
+        Args:
+            buf: uint8 array holding the tokens
+            starts: start of each token in buf
+            lengths: length of each token
+        """
+        ids = np.full(len(starts), -1, dtype = np.int64)
+        if len(starts) == 0:
+            return ids
+        #Tokens of length k composed only of A, C, G and T are looked up by 2-bit code
+        invalid = np.concatenate([[0], np.cumsum(~VALID[buf])])
+        coded = (lengths == self.ksize) & (invalid[starts + lengths] - invalid[starts] == 0)
+        if coded.any() and len(self.codes) > 0:
+            kmers = buf[starts[coded][:, None] + np.arange(self.ksize)]
+            codes = self.encode(kmers)
+            found = np.minimum(np.searchsorted(self.codes, codes), len(self.codes) - 1)
+            ids[coded] = np.where(self.codes[found] == codes, self.code_ids[found], -1)
+        #All other tokens are looked up one at a time
+        if len(self.other_words) > 0:
+            data = buf.tobytes()
+            for i in np.flatnonzero(~coded):
+                ids[i] = self.other_words.get(data[starts[i]:starts[i] + lengths[i]], -1)
+        return ids
+
+    def hidden(self, ids, buf, starts, lengths, sentence_index, num_sentences):
+        """
+        Average input embeddings of the words (and word n-grams) of each sentence
+        Args:
+            ids: word id of each token
+            buf: uint8 array holding the tokens
+            starts: start of each token in buf
+            lengths: length of each token
+            sentence_index: sentence each token belongs to, in increasing order
+            num_sentences: number of sentences
+        """
+        #Every line read by FastText ends with the end-of-sentence token
+        if self.eos >= 0:
+            ids = np.concatenate([ids, np.full(num_sentences, self.eos, dtype = np.int64)])
+            rows = np.concatenate([sentence_index, np.arange(num_sentences)])
+        else:
+            rows = sentence_index
+        if self.word_ngrams > 1:
+            ngram_ids, ngram_rows = self.ngram_ids(buf, starts, lengths, sentence_index, num_sentences)
+            ids = np.concatenate([ids, ngram_ids])
+            rows = np.concatenate([rows, ngram_rows])
+        keep = ids >= 0
+        order = np.argsort(rows[keep], kind = "stable")
+        ids = ids[keep][order]
+        rows = rows[keep][order]
+        counts = np.bincount(rows, minlength = num_sentences)
+        present = counts > 0
+        hidden = np.zeros((num_sentences, self.dim), dtype = np.float32)
+        if len(ids) > 0:
+            #Sum embeddings of each sentence, then divide by the number of words as FastText does
+            hidden[present] = np.add.reduceat(self.input_matrix[ids], np.cumsum(counts)[present] - counts[present], axis = 0)
+            hidden[present] *= (np.float32(1.0) / counts[present].astype(np.float32))[:, None]
+        return hidden, present
+
+    def ngram_ids(self, buf, starts, lengths, sentence_index, num_sentences):
+        """
+        Compute bucket ids of word n-grams in the same way as FastText's addWordNgrams
+        Args:
+            buf: uint8 array holding the tokens
+            starts: start of each token in buf
+            lengths: length of each token
+            sentence_index: sentence each token belongs to, in increasing order
+            num_sentences: number of sentences
+        """
+        hashes = fnv_hash(buf, starts, lengths)
+        eos_hash = fnv_hash(np.frombuffer(EOS, dtype = np.uint8), np.zeros(1, dtype = np.int64), np.array([len(EOS)]))[0]
+        #Insert the end-of-sentence hash after the last token of each sentence
+        token_counts = np.bincount(sentence_index, minlength = num_sentences)
+        ends = np.cumsum(token_counts)
+        hashes = np.insert(hashes, ends, eos_hash)
+        sentences = np.insert(sentence_index, ends, np.arange(num_sentences))
+        #FastText stores hashes as int32 and sign-extends them to 64 bits
+        hashes = hashes.astype(np.int32).astype(np.int64).astype(np.uint64)
+        ids = []
+        rows = []
+        combined = hashes.copy()
+        for n in range(2, self.word_ngrams + 1):
+            span = len(hashes) - n + 1
+            if span <= 0:
+                break
+            combined = combined[:span] * np.uint64(116049371) + hashes[n - 1:n - 1 + span]
+            within = sentences[:span] == sentences[n - 1:n - 1 + span]
+            ids.append(self.nwords + (combined[within] % np.uint64(self.bucket)).astype(np.int64))
+            rows.append(sentences[:span][within])
+        if len(ids) == 0:
+            return np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64)
+        return np.concatenate(ids), np.concatenate(rows)
+
+    def scores(self, hidden):
+        """
+        Compute label probabilities from averaged embeddings with a single matrix multiplication
+        Args:
+            hidden: averaged embeddings, one row per sentence
+        """
+        output = hidden @ np.asarray(self.output_matrix).T
+        if self.loss == LOSS_SOFTMAX:
+            output = np.exp(output - output.max(axis = 1, keepdims = True))
+            output /= output.sum(axis = 1, keepdims = True)
+        else:
+            #FastText's one-vs-all loss reads sigmoids from a lookup table
+            index = ((np.clip(output, -MAX_SIGMOID, MAX_SIGMOID) + np.float32(MAX_SIGMOID)) * np.float32(SIGMOID_TABLE_SIZE) / np.float32(MAX_SIGMOID) / np.float32(2)).astype(np.int64)
+            sigmoid = SIGMOID_TABLE[index]
+            sigmoid[output < -MAX_SIGMOID] = 0.0
+            sigmoid[output > MAX_SIGMOID] = 1.0
+            output = sigmoid
+        return output
+
+    def top_k(self, probabilities, present, k = 1, threshold = 0.0):
+        """
+        Return the k best labels and scores of each sentence, reproducing FastText's log(p + 1e-5) scoring
+        Args:
+            probabilities: label probabilities, one row per sentence
+            present: whether each sentence contained any known word
+            k: number of labels to return
+            threshold: minimum score for a label to be returned
+        """
+        k = len(self.labels) if k == -1 else min(k, len(self.labels))
+        probabilities = probabilities.astype(np.float32)
+        log_scores = np.log(probabilities + np.float32(1e-5))
+        scores = np.exp(log_scores)
+        #Rank labels by log score; like FastText's heap, later labels win ties
+        order = np.argsort(-log_scores[:, ::-1], axis = 1, kind = "stable")[:, :k]
+        order = log_scores.shape[1] - 1 - order
+        all_labels = []
+        all_scores = []
+        for i in range(len(scores)):
+            #As in FastText, the threshold is applied to probabilities rather than scores
+            best = order[i][probabilities[i][order[i]] >= threshold] if present[i] else order[i][:0]
+            all_labels.append(tuple(self.labels[j] for j in best))
+            all_scores.append(scores[i][best].astype(np.float64))
+        return all_labels, all_scores
+
+    def predict_tokens(self, buf, starts, lengths, sentence_index, num_sentences, k = 1, threshold = 0.0, chunk_size = 512):
+        """
+        Predict labels of tokenized sentences, a chunk of sentences at a time to bound memory use
+        Args:
+            buf: uint8 array holding the tokens
+            starts: start of each token in buf
+            lengths: length of each token
+            sentence_index: sentence each token belongs to, in increasing order
+            num_sentences: number of sentences
+            k: number of labels to return
+            threshold: minimum score for a label to be returned
+            chunk_size: number of sentences whose embeddings are averaged at a time
+        """
+        all_labels = []
+        all_scores = []
+        ids = self.token_ids(buf, starts, lengths)
+        bounds = np.searchsorted(sentence_index, np.arange(0, num_sentences + chunk_size, chunk_size))
+        for chunk, start in enumerate(range(0, num_sentences, chunk_size)):
+            size = min(chunk_size, num_sentences - start)
+            tokens = slice(bounds[chunk], bounds[chunk + 1])
+            hidden, present = self.hidden(ids[tokens], buf, starts[tokens], lengths[tokens], sentence_index[tokens] - start, size)
+            labels, scores = self.top_k(self.scores(hidden), present, k, threshold)
+            all_labels.extend(labels)
+            all_scores.extend(scores)
+        return all_labels, all_scores
+
+    def predict(self, text, k = 1, threshold = 0.0):
+        """
+        Predict labels of a sentence or a list of sentences, with the same outputs as FastText's predict
+        Args:
+            text: sentence or list of sentences of whitespace-separated words
+            k: number of labels to return
+            threshold: minimum score for a label to be returned
+        """
+        single = isinstance(text, str)
+        sentences = [text] if single else text
+        for sentence in sentences:
+            if "\n" in sentence:
+                raise ValueError("predict processes one line at a time (remove '\\n')")
+        #Tokenize all sentences at once, splitting on the same whitespace characters as FastText
+        buf = np.frombuffer(("\n".join(sentences) + "\n").encode(), dtype = np.uint8)
+        separator = np.zeros(256, dtype = bool)
+        separator[np.frombuffer(b" \n\r\t\v\f\0", dtype = np.uint8)] = True
+        is_separator = np.concatenate([[True], separator[buf], [True]])
+        starts = np.flatnonzero(~is_separator[1:-1] & is_separator[:-2])
+        ends = np.flatnonzero(~is_separator[1:-1] & is_separator[2:]) + 1
+        sentence_index = np.cumsum(buf == ord("\n"))[starts]
+        labels, scores = self.predict_tokens(buf, starts, ends - starts, sentence_index, len(sentences), k, threshold)
+        if single:
+            return labels[0], scores[0]
+        return labels, scores
+
+    def predict_reads(self, sequences, ksize, k = 1, threshold = 0.0):
+        """
+        Predict labels of reads directly, with the same outputs as predicting their k-merized sentences
+        Args:
+            sequences: list of reads
+            ksize: size of k-mers to be created from sequence data
+            k: number of labels to return
+            threshold: minimum score for a label to be returned
+        """
+        lengths = np.array([len(sequence) for sequence in sequences], dtype = np.int64)
+        buf = np.frombuffer("".join(sequences).encode(), dtype = np.uint8)
+        read_starts = np.cumsum(lengths) - lengths
+        #Every position of a read at which a full k-mer starts is a token
+        num_kmers = np.maximum(lengths - ksize + 1, 0)
+        sentence_index = np.repeat(np.arange(len(sequences)), num_kmers)
+        starts = np.repeat(read_starts - np.cumsum(num_kmers) + num_kmers, num_kmers) + np.arange(num_kmers.sum())
+        return self.predict_tokens(buf, starts, np.full(len(starts), ksize, dtype = np.int64), sentence_index, len(sequences), k, threshold)
+
+def load_model(model_file, backend = "fasttext"):
+    """
+    Load a supervised FastText model with the requested inference backend
+    Args:
+        model_file: file path of the FastText model
+        backend: "fasttext" for the FastText library or "numpy" for NumpyFastText
+    """
+    if backend == "numpy":
+        return NumpyFastText(model_file)
+    elif backend == "fasttext":
+        import fasttext as ft
+        return ft.load_model(model_file)
+    else:
+        raise ValueError(f"Unknown inference backend: {backend}")
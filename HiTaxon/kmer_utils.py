@@ -0,0 +1,143 @@
+import json
+import os
+import numpy as np
+
+from HiTaxon.sequence_utils import canonical_kmers, reference_chunks
+
+
+def species_kmers(fasta_files, ksize = 31):
+    """
+    Return the distinct canonical k-mers of the sequences of a species
+    Args:
+        fasta_files: FASTA files of the species
+        ksize: size of k-mers (at most 31)
+    """
+    kmers = [np.unique(canonical_kmers(chunk, ksize)[0]) for chunk in reference_chunks(fasta_files)]
+    return np.unique(np.concatenate(kmers)) if len(kmers) > 0 else np.zeros(0, dtype = np.uint64)
+
+def run_offsets(sizes):
+    """
+    Return the offset of each element within its run, for runs of the given sizes laid end to end
+    Args:
+        sizes: array of run sizes
+    """
+    return np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+
+def table_exists(table_path):
+    """
+    Check whether a complete k-mer table is present
+    Args:
+        table_path: directory of the k-mer table
+    """
+    return os.path.exists(f"{table_path}/table.json")
+
+def build_kmer_table(species_fastas, table_path, ksize = 31, block_size = 1000000):
+    """
+    Build the k-mer table of a genus, composed of:
+        kmers.npy: sorted canonical k-mers found in the genus
+        sets.npy: id of the set of species containing each k-mer (ids below the number of species are single species)
+        set_offsets.npy / set_members.npy: species of each set
+        species.txt: species names, in the order of their ids
+        table.json: k-mer size and number of species, written last to mark the table as complete
+    Args:
+        species_fastas: dictionary with structure {species => list of FASTA files}
+        table_path: directory in which the k-mer table is written
+        ksize: size of k-mers (at most 31)
+        block_size: number of k-mers shared by several species whose species sets are resolved at a time
+    """
+    os.makedirs(table_path, exist_ok = True)
+    species = sorted(species_fastas)
+    kmers = []
+    owners = []
+    for index, name in enumerate(species):
+        kmers.append(species_kmers(species_fastas[name], ksize))
+        owners.append(np.full(len(kmers[-1]), index, dtype = np.uint32))
+    kmers = np.concatenate(kmers) if len(kmers) > 0 else np.zeros(0, dtype = np.uint64)
+    owners = np.concatenate(owners) if len(owners) > 0 else np.zeros(0, dtype = np.uint32)
+    order = np.argsort(kmers, kind = "stable")
+    kmers = kmers[order]
+    owners = owners[order]
+    #Each distinct k-mer is a run of one entry per species containing it
+    starts = np.flatnonzero(np.concatenate([[True], kmers[1:] != kmers[:-1]])) if len(kmers) > 0 else np.zeros(0, dtype = np.int64)
+    counts = np.diff(np.append(starts, len(kmers)))
+    sets = owners[starts].copy()
+    set_members = [[index] for index in range(len(species))]
+    known = {}
+    num_words = (len(species) + 63) // 64
+    shared = np.flatnonzero(counts > 1)
+    for block in range(0, len(shared), block_size):
+        runs = shared[block:block + block_size]
+        #Encode the species of each shared k-mer as a bitmask, so that identical species sets are found with np.unique
+        run_of = np.repeat(np.arange(len(runs)), counts[runs])
+        members = owners[np.repeat(starts[runs], counts[runs]) + run_offsets(counts[runs])]
+        masks = np.zeros((len(runs), num_words), dtype = np.uint64)
+        np.bitwise_or.at(masks, (run_of, members // 64), np.left_shift(np.uint64(1), (members % 64).astype(np.uint64)))
+        unique_masks, inverse = np.unique(masks, axis = 0, return_inverse = True)
+        ids = np.zeros(len(unique_masks), dtype = np.uint32)
+        for index, mask in enumerate(unique_masks):
+            key = mask.tobytes()
+            if key not in known:
+                known[key] = len(set_members)
+                set_members.append([word * 64 + bit for word in range(num_words) for bit in range(64) if (int(mask[word]) >> bit) & 1])
+            ids[index] = known[key]
+        sets[runs] = ids[inverse.reshape(-1)]
+    np.save(f"{table_path}/kmers.npy", kmers[starts])
+    np.save(f"{table_path}/sets.npy", sets)
+    np.save(f"{table_path}/set_offsets.npy", np.concatenate([[0], np.cumsum([len(members) for members in set_members])]).astype(np.int64))
+    np.save(f"{table_path}/set_members.npy", np.array([member for members in set_members for member in members], dtype = np.int64))
+    with open(f"{table_path}/species.txt", "w") as f:
+        for name in species:
+            f.write(name + "\n")
+    #Metadata is written last, marking the table as complete
+    json.dump({"ksize": ksize, "num_species": len(species), "num_kmers": int(len(starts))}, open(f"{table_path}/table.json", "w"))
+
+
+class KmerTable:
+    """
+    Memory-mapped k-mer table of a genus written by build_kmer_table
+    Args:
+        table_path: directory of the k-mer table
+    """
+    def __init__(self, table_path):
+        metadata = json.load(open(f"{table_path}/table.json"))
+        self.ksize = metadata["ksize"]
+        self.kmers = np.load(f"{table_path}/kmers.npy", mmap_mode = "r")
+        self.sets = np.load(f"{table_path}/sets.npy", mmap_mode = "r")
+        self.set_offsets = np.load(f"{table_path}/set_offsets.npy")
+        self.set_members = np.load(f"{table_path}/set_members.npy")
+        self.species = open(f"{table_path}/species.txt").read().splitlines()
+
+    def classify(self, sequences, min_hits = 1):
+        """
+        Assign each read the species supported by the most of its k-mers, or NA if no species reaches min_hits or several species share the most k-mers. Returns predicted species and the fraction of k-mers of each read supporting its prediction
+        Args:
+            sequences: list of reads
+            min_hits: minimum number of k-mers supporting a species for it to be assigned
+        """
+        preds = ["NA"] * len(sequences)
+        scores = np.zeros(len(sequences))
+        kmers, owners = canonical_kmers(sequences, self.ksize)
+        if len(kmers) == 0 or len(self.kmers) == 0:
+            return preds, scores
+        total = np.bincount(owners, minlength = len(sequences))
+        index = np.minimum(np.searchsorted(self.kmers, kmers), len(self.kmers) - 1)
+        found = self.kmers[index] == kmers
+        #Every k-mer found votes for each species of its set
+        set_ids = self.sets[index[found]].astype(np.int64)
+        sizes = self.set_offsets[set_ids + 1] - self.set_offsets[set_ids]
+        reads = np.repeat(owners[found], sizes)
+        members = self.set_members[np.repeat(self.set_offsets[set_ids], sizes) + run_offsets(sizes)]
+        num_species = len(self.species)
+        keys, votes = np.unique(reads * num_species + members, return_counts = True)
+        read_of = keys // num_species
+        species_of = keys % num_species
+        #Order votes of each read from most to least supported species
+        order = np.lexsort((-votes, read_of))
+        read_of, species_of, votes = read_of[order], species_of[order], votes[order]
+        first = np.flatnonzero(np.concatenate([[True], read_of[1:] != read_of[:-1]])) if len(read_of) > 0 else np.zeros(0, dtype = np.int64)
+        second = np.minimum(first + 1, len(read_of) - 1)
+        tied = (second != first) & (read_of[second] == read_of[first]) & (votes[second] == votes[first])
+        for index in first[~tied & (votes[first] >= min_hits)]:
+            preds[read_of[index]] = self.species[species_of[index]]
+            scores[read_of[index]] = votes[index] / total[read_of[index]]
+        return preds, scores
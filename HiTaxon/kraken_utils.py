@@ -0,0 +1,175 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+from HiTaxon.evaluation_utils import expand_lineage, hit_support
+from HiTaxon.table_utils import MISSING_CALLS, require_arrow
+
+#Ranks of lineage codes, in the column order of {report_name}_lineage_kraken.csv
+RANKS = ["species", "genus", "family", "order", "class", "phylum"]
+
+
+def load_reference_assembly(assembly_summary):
+    """
+    Load the RefSeq assembly summary used to name taxids missing from NCBI's taxonomy
+    Args:
+        assembly_summary: file path to assembly summary
+    """
+    refseq = pd.read_csv(assembly_summary, delimiter = "\t", skiprows = 1)
+    refseq = refseq[["#assembly_accession", "refseq_category", "species_taxid", "organism_name", "infraspecific_name", "assembly_level", "genome_rep"]]
+    refseq["species"] = refseq["organism_name"].apply(lambda x: " ".join(x.replace("_"," ").split(" ")[:2]))
+    return refseq
+
+
+class LineageTable:
+    """
+    Precompiled table mapping Kraken2 taxids to integer codes of their name at each rank, saved between runs so that each taxid is only expanded once
+    Args:
+        table_file: .npz file of the table, loaded if it exists (None to keep the table in memory)
+        read_only: never write the table back to table_file, for tables shared by concurrent processes
+    """
+    def __init__(self, table_file = None, read_only = False):
+        self.table_file = table_file
+        self.read_only = read_only
+        self.taxids = np.zeros(0, dtype = np.int64)
+        self.codes = np.zeros((0, len(RANKS)), dtype = np.int32)
+        self.names = [["NA"] for rank in RANKS]
+        if table_file is not None and os.path.exists(table_file):
+            saved = np.load(table_file)
+            self.taxids = saved["taxids"]
+            self.codes = saved["codes"]
+            self.names = [saved[f"names_{rank}"].tolist() for rank in RANKS]
+        self.name_codes = [{name: code for code, name in enumerate(names)} for names in self.names]
+
+    def code(self, rank_index, name):
+        """
+        Return the code of a name at a rank, adding it if unseen
+        Args:
+            rank_index: index of the rank in RANKS
+            name: taxon name at that rank
+        """
+        if not(name in self.name_codes[rank_index]):
+            self.name_codes[rank_index][name] = len(self.names[rank_index])
+            self.names[rank_index].append(name)
+        return self.name_codes[rank_index][name]
+
+    def add(self, taxids, ncbi, reference_assembly):
+        """
+        Expand the lineage of taxids missing from the table
+        Args:
+            taxids: array of Kraken2 taxids
+            ncbi: NCBITaxa()
+            reference_assembly: RefSeq assembly summary
+        """
+        missing = np.setdiff1d(np.unique(taxids), self.taxids)
+        if len(missing) == 0:
+            return
+        rows = []
+        for taxid in missing:
+            #Unclassified reads have no lineage
+            lineage = {rank: "NA" for rank in RANKS} if taxid == 0 else expand_lineage(int(taxid), ncbi, reference_assembly)
+            rows.append([self.code(rank_index, lineage[rank]) for rank_index, rank in enumerate(RANKS)])
+        taxids = np.concatenate([self.taxids, missing])
+        codes = np.concatenate([self.codes, np.array(rows, dtype = np.int32)])
+        order = np.argsort(taxids)
+        self.taxids = taxids[order]
+        self.codes = codes[order]
+
+    def lookup(self, taxids):
+        """
+        Return the lineage codes of taxids already in the table, with shape (number of taxids, number of ranks)
+        Args:
+            taxids: array of Kraken2 taxids
+        """
+        return self.codes[np.searchsorted(self.taxids, taxids)]
+
+    def save(self):
+        """
+        Write the table to its .npz file
+        """
+        if self.table_file is not None and not(self.read_only):
+            np.savez(self.table_file, taxids = self.taxids, codes = self.codes, **{f"names_{rank}": np.array(names) for rank, names in zip(RANKS, self.names)})
+
+
+class KrakenCalls:
+    """
+    Kraken2's calls for every read of a sample, held as integer lineage codes
+    Args:
+        codes: array of lineage codes with shape (number of reads, number of ranks)
+        names: names of the codes at each rank
+        support: fraction of each read's k-mers supporting its call (None if not computed)
+    """
+    def __init__(self, codes, names, support = None):
+        self.codes = codes
+        self.names = [np.array(rank_names, dtype = object) for rank_names in names]
+        self.support = support
+
+    def __len__(self):
+        return len(self.codes)
+
+    def genus_codes(self):
+        """
+        Return Kraken2's genus of each read as integer codes, alongside the name of each code
+        """
+        genus_index = RANKS.index("genus")
+        return self.codes[:, genus_index], self.names[genus_index]
+
+    def named_lineage(self):
+        """
+        Return Kraken2's lineage of each read with missing ranks named "NA", as written to {report_name}_lineage_kraken.csv
+        """
+        return pd.DataFrame({rank: self.names[rank_index][self.codes[:, rank_index]] for rank_index, rank in enumerate(RANKS)})
+
+    def lineage(self):
+        """
+        Return Kraken2's lineage of each read, as read back from {report_name}_lineage_kraken.csv
+        """
+        lineage = self.named_lineage().replace("NA", np.nan)
+        #Match the columns of the lineage CSV read back with pandas, so that ensemble outputs are unchanged
+        lineage.insert(0, "Unnamed: 0", np.arange(len(lineage)))
+        return lineage
+
+    def write_lineage(self, lineage_file):
+        """
+        Write Kraken2's lineage of each read in the format of {report_name}_lineage_kraken.csv, or as a Parquet table for .parquet files
+        Args:
+            lineage_file: file path of the lineage CSV or Parquet table
+        """
+        if not(lineage_file.endswith(".parquet")):
+            self.named_lineage().to_csv(lineage_file)
+            return
+        #Lineage codes are already dictionary-encoded, so categoricals are built without expanding names per read
+        require_arrow()
+        columns = {}
+        for rank_index, rank in enumerate(RANKS):
+            named = ~np.isin(self.names[rank_index], MISSING_CALLS)
+            recoded = np.where(named, np.cumsum(named) - 1, -1)
+            columns[rank] = pd.Categorical.from_codes(recoded[self.codes[:, rank_index]], self.names[rank_index][named])
+        pd.DataFrame(columns).to_parquet(lineage_file, engine = "pyarrow", index = False, compression = "zstd")
+
+
+def ingest_kraken(source, table, ncbi, reference_assembly, chunk_size = 1000000, support = False):
+    """
+    Read Kraken2's per-read output in chunks, from a file or from standard input while Kraken2 runs, and map each call to lineage codes
+    Args:
+        source: file path of Kraken2 output, or "-" for standard input
+        table: LineageTable mapping taxids to lineage codes, extended and saved as new taxids are seen
+        ncbi: NCBITaxa()
+        reference_assembly: RefSeq assembly summary
+        chunk_size: number of reads parsed at a time
+        support: also compute the fraction of each read's k-mers supporting its call
+    """
+    stream = sys.stdin if source == "-" else source
+    codes = []
+    supports = []
+    lineages = {}
+    for chunk in pd.read_csv(stream, delimiter = "\t", header = None, usecols = [2, 4], chunksize = chunk_size):
+        taxids = chunk[2].values.astype(np.int64)
+        table.add(taxids, ncbi, reference_assembly)
+        codes.append(table.lookup(taxids))
+        if support:
+            supports.append(np.array([hit_support(prediction, hits, lineages, ncbi) for prediction, hits in zip(taxids, chunk[4].values)]))
+    table.save()
+    codes = np.concatenate(codes) if len(codes) > 0 else np.zeros((0, len(RANKS)), dtype = np.int32)
+    return KrakenCalls(codes, table.names, np.concatenate(supports) if support and len(supports) > 0 else None)
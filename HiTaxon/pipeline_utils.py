@@ -0,0 +1,283 @@
+import asyncio
+import os
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+from HiTaxon.align_utils import parallel_align
+from HiTaxon.evaluation_utils import route_genera
+from HiTaxon.kraken_utils import KrakenCalls, RANKS
+from HiTaxon.fasttext_utils import load_model
+from HiTaxon.prediction_utils import batch_predict
+from HiTaxon.sequence_utils import KmerBatches, ReadStore, build_read_store, read_store_exists
+
+
+class StageMetrics:
+    """
+    Queue depth and backpressure of a pipeline stage, measured on the queue the stage feeds
+    Args:
+        name: name of the stage
+    """
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.max_depth = 0
+        self.depth_total = 0
+        self.blocked_seconds = 0.0
+        self.busy_seconds = 0.0
+
+    async def put(self, queue, item):
+        """
+        Put an item on the queue fed by the stage, recording the queue depth and the time spent waiting for space
+        Args:
+            queue: asyncio.Queue fed by the stage
+            item: item to put on the queue
+        """
+        depth = queue.qsize()
+        self.max_depth = max(self.max_depth, depth)
+        self.depth_total += depth
+        self.items += 1
+        start = time.time()
+        await queue.put(item)
+        self.blocked_seconds += time.time() - start
+
+    def summary(self):
+        return {"items": self.items, "max_depth": self.max_depth, "mean_depth": self.depth_total / self.items if self.items > 0 else 0.0, "blocked_seconds": self.blocked_seconds, "busy_seconds": self.busy_seconds}
+
+
+def trained_genera(classifier, specialized_path):
+    """
+    Return the genera with a specialized classifier
+    Args:
+        classifier: either "ML" or "BWA"
+        specialized_path: path in which models or BWA indices are stored
+    """
+    if classifier == "ML":
+        return set([model.split("_")[0] for model in os.listdir(specialized_path) if not(model.startswith("."))])
+    return set([indices.split(".")[0] for indices in os.listdir(specialized_path) if not(indices.startswith("."))])
+
+def classify_batch(classifier, specialized_path, genus, positions, read_store, model_cache = None, model_lock = None, backend = "fasttext", ksize = 13, num_threads = 1, max_memory = None, residency = None):
+    """
+    Classify a batch of reads routed to a genus, returning predictions with structure [(prediction, score, position in FASTA)...]
+    Args:
+        classifier: either "ML" or "BWA"
+        specialized_path: path in which models or BWA indices are stored
+        genus: genus of interest
+        positions: positions in FASTA of the reads of the batch
+        read_store: directory of the read store
+        model_cache: ModelCache keeping models loaded between batches (None to load the model of each batch directly)
+        model_lock: lock serializing model loading between workers sharing model_cache (None when a single worker uses it)
+        backend: ML inference backend, either "fasttext" or "numpy"
+        ksize: size of k-mers used by ML models
+        num_threads: number of threads shared by the alignments of the shards of the genus
+        max_memory: memory budget in bytes for the shards of the genus loaded at the same time (None for no limit)
+        residency: IndexResidency staging the index in shared memory, so that later batches of the genus do not load it again
+    """
+    if classifier == "ML":
+        model_file = f"{specialized_path}/{genus}_model.bin"
+        if model_cache is None:
+            model = load_model(model_file, backend)
+        elif model_lock is None:
+            model = model_cache.get(model_file)
+        else:
+            with model_lock:
+                model = model_cache.get(model_file)
+        labels, scores = batch_predict(model, KmerBatches(read_store, positions, ksize, len(positions), kmerize = backend != "numpy"))
+        return list(zip(labels, scores, positions))
+    aligned = parallel_align(specialized_path, [(genus, positions)], ReadStore(read_store).fetch, num_threads, max_memory, residency)[genus]
+    return [(aligned[position].split("|")[1], 1, position) for position in positions]
+
+async def read_kraken(command, calls, metrics, chunk_size = 10000):
+    """
+    Launch Kraken2 and put chunks of its per-read calls, with structure [(taxid, hit list)...], on the calls queue as they are written
+    Args:
+        command: Kraken2 command writing per-read output to standard output
+        calls: asyncio.Queue of chunks of calls, ended by None
+        metrics: StageMetrics of the Kraken2 stage
+        chunk_size: number of calls put on the queue at a time
+    """
+    process = await asyncio.create_subprocess_exec(*command, stdout = asyncio.subprocess.PIPE)
+    try:
+        chunk = []
+        async for line in process.stdout:
+            fields = line.decode().rstrip("\n").split("\t")
+            chunk.append((int(fields[2]), fields[4] if len(fields) > 4 else ""))
+            if len(chunk) == chunk_size:
+                await metrics.put(calls, chunk)
+                chunk = []
+        if len(chunk) > 0:
+            await metrics.put(calls, chunk)
+        await metrics.put(calls, None)
+        if await process.wait() != 0:
+            raise RuntimeError(f"Kraken2 exited with status {process.returncode}")
+    finally:
+        #Stop Kraken2 when a downstream stage failed or the pipeline was cancelled
+        if process.returncode is None:
+            process.kill()
+            #Drain what Kraken2 wrote before it was stopped, so that its pipe closes and the process is reaped
+            await process.communicate()
+
+async def route_reads(calls, batches, table, ncbi, reference_assembly, genera, codes, metrics, batch_size = 20000, num_workers = 1, hold = False):
+    """
+    Map calls to lineage codes and fill a queue per genus with the positions of its reads, putting full queues on the batch queue while Kraken2 is still running
+    Args:
+        calls: asyncio.Queue of chunks of calls, ended by None
+        batches: asyncio.Queue of batches with structure (genus, positions in FASTA), ended by one None per worker
+        table: LineageTable mapping taxids to lineage codes
+        ncbi: NCBITaxa()
+        reference_assembly: RefSeq assembly summary
+        genera: genera with a specialized classifier
+        codes: list to which lineage codes of each chunk are appended
+        metrics: StageMetrics of the routing stage
+        batch_size: number of reads per batch
+        num_workers: number of classification workers
+        hold: keep all reads of a genus in a single batch put once Kraken2 is done, instead of putting batches of batch_size reads
+    """
+    loop = asyncio.get_running_loop()
+    genus_index = RANKS.index("genus")
+    queues = {}
+    position = 0
+    while True:
+        chunk = await calls.get()
+        if chunk is None:
+            break
+        start = time.time()
+        taxids = np.array([taxid for taxid, hits in chunk], dtype = np.int64)
+        #Expanding unseen taxids queries the NCBI taxonomy, so it runs off the event loop
+        await loop.run_in_executor(None, table.add, taxids, ncbi, reference_assembly)
+        chunk_codes = table.lookup(taxids)
+        codes.append(chunk_codes)
+        genus_names = [table.names[genus_index][code] for code in chunk_codes[:, genus_index]]
+        for offset, genus in enumerate(genus_names):
+            if genus in genera:
+                queues.setdefault(genus, []).append(position + offset)
+        position += len(chunk)
+        metrics.busy_seconds += time.time() - start
+        if hold:
+            continue
+        for genus in list(queues):
+            if len(queues[genus]) >= batch_size:
+                await metrics.put(batches, (genus, queues.pop(genus)))
+    #Flush partially filled queues once Kraken2 is done
+    for genus, positions in queues.items():
+        await metrics.put(batches, (genus, positions))
+    for worker in range(num_workers):
+        await batches.put(None)
+
+async def classify_batches(batches, store_ready, classify, preds, metrics):
+    """
+    Classify batches as they are routed, once the read store is ready
+    Args:
+        batches: asyncio.Queue of batches with structure (genus, positions in FASTA), ended by None
+        store_ready: asyncio.Event set once the read store is complete
+        classify: function classifying a batch, with arguments (genus, positions)
+        preds: list to which predictions are appended
+        metrics: StageMetrics of the classification stage
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = await batches.get()
+        if batch is None:
+            break
+        await store_ready.wait()
+        start = time.time()
+        preds.extend(await loop.run_in_executor(None, classify, *batch))
+        metrics.busy_seconds += time.time() - start
+        metrics.items += 1
+
+async def pipeline(command, sequence_file, read_store, classifier, specialized_path, table, ncbi, reference_assembly, model_cache = None, backend = "fasttext", batch_size = 20000, queue_depth = 4, num_workers = 2, num_threads = 1, ksize = 13, max_memory = None, residency = None):
+    """
+    Run Kraken2, routing and specialized classification concurrently, building the read store while Kraken2 runs
+    Args:
+        command: Kraken2 command writing per-read output to standard output
+        sequence_file: file path of FASTA file to analyze
+        read_store: directory of the read store, built if missing
+        classifier: either "ML" or "BWA"
+        specialized_path: path in which models or BWA indices are stored
+        table: LineageTable mapping taxids to lineage codes
+        ncbi: NCBITaxa()
+        reference_assembly: RefSeq assembly summary
+        model_cache: ModelCache keeping models loaded between batches
+        backend: ML inference backend, either "fasttext" or "numpy"
+        batch_size: number of reads of a genus classified at a time, BWA reads of a genus being classified in a single batch unless its index is staged by residency
+        queue_depth: maximum number of chunks or batches waiting between stages, beyond which the upstream stage waits
+        num_workers: number of batches classified at the same time
+        num_threads: number of threads shared by all BWA alignments, split evenly between workers
+        ksize: size of k-mers used by ML models
+        max_memory: memory budget in bytes for BWA indices loaded at the same time, split evenly between workers (None for no limit)
+        residency: IndexResidency staging BWA indices in shared memory
+    """
+    calls = asyncio.Queue(maxsize = queue_depth)
+    batches = asyncio.Queue(maxsize = queue_depth)
+    metrics = {stage: StageMetrics(stage) for stage in ["kraken", "route", "classify"]}
+    store_ready = asyncio.Event()
+    codes = []
+    preds = []
+    model_lock = threading.Lock()
+    #Workers align at the same time, so each gets its share of the thread and memory budgets
+    worker_threads = max(1, num_threads // num_workers)
+    worker_memory = None if max_memory is None else max_memory // num_workers
+    classify = lambda genus, positions: classify_batch(classifier, specialized_path, genus, positions, read_store, model_cache, model_lock, backend, ksize, worker_threads, worker_memory, residency)
+    #Without shared memory, each batch of a genus would load its index again, so BWA reads of a genus are aligned together once Kraken2 is done
+    hold = classifier == "BWA" and residency is None
+
+    async def build_store():
+        if not(read_store_exists(read_store)):
+            await asyncio.get_running_loop().run_in_executor(None, build_read_store, sequence_file, read_store)
+        store_ready.set()
+
+    start = time.time()
+    await asyncio.gather(
+        build_store(),
+        read_kraken(command, calls, metrics["kraken"]),
+        route_reads(calls, batches, table, ncbi, reference_assembly, trained_genera(classifier, specialized_path), codes, metrics["route"], batch_size, num_workers, hold),
+        *[classify_batches(batches, store_ready, classify, preds, metrics["classify"]) for worker in range(num_workers)])
+    table.save()
+    codes = np.concatenate(codes) if len(codes) > 0 else np.zeros((0, len(RANKS)), dtype = np.int32)
+    summary = {stage: stage_metrics.summary() for stage, stage_metrics in metrics.items()}
+    summary["seconds"] = time.time() - start
+    return KrakenCalls(codes, table.names), preds, summary
+
+def routed_predictions(genus_codes, genus_names, preds, genera, min_threshold = 0.5):
+    """
+    Arrange predictions made on routed reads in the format written by evaluation and evaluation_bwa
+    Args:
+        genus_codes: Kraken2 genus code of each read
+        genus_names: name of each genus code
+        preds: predictions with structure [(prediction, score, position in FASTA)...]
+        genera: genera with a specialized classifier
+        min_threshold: minimum score needed to use a prediction
+    """
+    ranks = ['phylum', 'class', 'order', 'family', 'genus', "species"]
+    model_preds = pd.DataFrame(np.zeros(shape = (len(genus_codes), 6)), columns = ranks)
+    model_preds["genus"] = route_genera(genus_codes, genus_names, genera)[0]
+    species = np.full(len(genus_codes), "NA", dtype = object)
+    for pred, score, position in preds:
+        if score >= min_threshold:
+            species[position] = pred
+    model_preds["species"] = species
+    return model_preds
+
+def pipeline_predictions(kraken_calls, preds, genera, min_threshold = 0.5):
+    """
+    Arrange pipeline predictions in the format written by evaluation and evaluation_bwa
+    Args:
+        kraken_calls: KrakenCalls of the sample
+        preds: predictions with structure [(prediction, score, position in FASTA)...]
+        genera: genera with a specialized classifier
+        min_threshold: minimum score needed to use a prediction
+    """
+    genus_codes, genus_names = kraken_calls.genus_codes()
+    return routed_predictions(genus_codes, genus_names, preds, genera, min_threshold)
+
+def report_pipeline(summary):
+    """
+    Print queue depth and backpressure of each pipeline stage
+    Args:
+        summary: pipeline metrics returned by pipeline
+    """
+    for stage in ["kraken", "route", "classify"]:
+        metrics = summary[stage]
+        print(f"{stage}: {metrics['items']} items, queue depth max {metrics['max_depth']} mean {metrics['mean_depth']:.1f}, {metrics['blocked_seconds']:.2f}s blocked on a full queue, {metrics['busy_seconds']:.2f}s busy")
+    print(f"Pipeline: {summary['seconds']:.2f}s")
@@ -0,0 +1,96 @@
+import json
+import os
+
+from HiTaxon.align_utils import genus_indices, index_bytes
+from HiTaxon.table_utils import read_table
+
+
+def lineage_genus_counts(lineage_file):
+    """
+    Count reads assigned to each genus by Kraken2
+    Args:
+        lineage_file: file path of {report_name}_lineage_kraken.csv or .parquet
+    """
+    reference = read_table(lineage_file, columns = ["genus"])
+    return {str(genus): int(count) for genus, count in reference["genus"].value_counts().items()}
+
+def kreport_genus_counts(kreport_file):
+    """
+    Count reads assigned to each genus or below by Kraken2, from the clade counts of a Kraken2 report
+    Args:
+        kreport_file: file path of {report_name}.kreport2
+    """
+    counts = {}
+    for line in open(kreport_file):
+        fields = line.rstrip("\n").split("\t")
+        if len(fields) >= 6 and fields[3] == "G":
+            counts[fields[5].strip()] = int(fields[1])
+    return counts
+
+def classifier_costs(num_reads, model_bytes, index_bytes, ml_load_rate = 5e8, ml_read_rate = 1e4, bwa_load_rate = 2e8, bwa_read_rate = 1e3):
+    """
+    Estimate seconds needed to classify the reads of a genus with its ML model and its BWA index, as loading time plus classification time (None where the classifier is missing)
+    Args:
+        num_reads: number of reads assigned to the genus
+        model_bytes: size of the genus FastText model, None if missing
+        index_bytes: size of the genus BWA index files, None if missing
+        ml_load_rate: bytes of model loaded per second
+        ml_read_rate: reads classified by a FastText model per second
+        bwa_load_rate: bytes of index loaded per second
+        bwa_read_rate: reads aligned by BWA per second
+    """
+    ml_cost = None if model_bytes is None else model_bytes / ml_load_rate + num_reads / ml_read_rate
+    bwa_cost = None if index_bytes is None else index_bytes / bwa_load_rate + num_reads / bwa_read_rate
+    return ml_cost, bwa_cost
+
+def plan_routing(genus_counts, model_path = None, bwa_path = None, max_seconds_per_read = 0.01, prefer = "BWA", rates = None):
+    """
+    Decide for each genus whether reads are classified with ML, BWA or left to Kraken2's call. The preferred classifier is used when its cost per read is within max_seconds_per_read, else the other classifier, else Kraken2
+    Args:
+        genus_counts: dictionary with structure {genus => number of reads}
+        model_path: path in which models are stored (None if ML is not available)
+        bwa_path: path in which BWA indices are stored (None if BWA is not available)
+        max_seconds_per_read: highest estimated cost per read, including loading, worth paying for a species call
+        prefer: classifier tried first, either "BWA" (more accurate) or "ML" (faster)
+        rates: dictionary of loading and classification rates passed to classifier_costs (None for the default rates)
+    """
+    rates = {} if rates is None else rates
+    plan = {}
+    for genus, num_reads in sorted(genus_counts.items()):
+        model_file = None if model_path is None else f"{model_path}/{genus}_model.bin"
+        model_size = os.path.getsize(model_file) if model_file is not None and os.path.exists(model_file) else None
+        indices = [] if bwa_path is None else genus_indices(bwa_path, genus)
+        index_size = sum([index_bytes(index) for index in indices]) if len(indices) > 0 and os.path.exists(f"{indices[0]}.ann") else None
+        ml_cost, bwa_cost = classifier_costs(num_reads, model_size, index_size, **rates)
+        costs = {"ML": ml_cost, "BWA": bwa_cost}
+        route = "Kraken2"
+        for classifier in ([prefer] + [name for name in costs if name != prefer]):
+            if costs[classifier] is not None and num_reads > 0 and costs[classifier] / num_reads <= max_seconds_per_read:
+                route = classifier
+                break
+        plan[genus] = {"reads": num_reads, "route": route, "ml_seconds": ml_cost, "bwa_seconds": bwa_cost}
+    return plan
+
+def write_plan(plan, plan_file):
+    """
+    Write a routing plan as JSON, with the estimated seconds of the plan and of always running each classifier
+    Args:
+        plan: routing plan returned by plan_routing
+        plan_file: file path of the JSON plan
+    """
+    estimate = lambda route: sum([entry[f"{route.lower()}_seconds"] or 0.0 for entry in plan.values() if entry["route"] == route])
+    summary = {
+        "planned_seconds": estimate("ML") + estimate("BWA"),
+        "always_ml_seconds": sum([entry["ml_seconds"] or 0.0 for entry in plan.values()]),
+        "always_bwa_seconds": sum([entry["bwa_seconds"] or 0.0 for entry in plan.values()]),
+        "reads": {route: sum([entry["reads"] for entry in plan.values() if entry["route"] == route]) for route in ["ML", "BWA", "Kraken2"]},
+    }
+    json.dump({"summary": summary, "genera": plan}, open(plan_file, "w"), indent = 2)
+
+def read_plan(plan_file):
+    """
+    Read the per-genus routes of a JSON plan written by write_plan, with structure {genus => route}
+    Args:
+        plan_file: file path of the JSON plan
+    """
+    return {genus: entry["route"] for genus, entry in json.load(open(plan_file))["genera"].items()}
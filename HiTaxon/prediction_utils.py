@@ -0,0 +1,225 @@
+import multiprocessing
+import os
+import time
+import numpy as np
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from HiTaxon.fasttext_utils import load_model
+from HiTaxon.sequence_utils import KmerBatches
+
+#Models loaded by the parent process before forking workers; workers use these instead of reloading them
+shared_models = {}
+
+
+class ModelCache:
+    """
+    Keep loaded FastText models resident between samples, evicting the least recently used model once the memory budget is exceeded
+    Args:
+        max_bytes: memory budget for resident models, estimated from model file sizes (None to keep no model resident, loading each model when it is used)
+        backend: inference backend used to load models, either "fasttext" or "numpy"
+    """
+    def __init__(self, max_bytes = None, backend = "fasttext"):
+        self.max_bytes = max_bytes
+        self.backend = backend
+        self.models = OrderedDict()
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_seconds = 0.0
+
+    def __contains__(self, model_file):
+        return model_file in self.models
+
+    def get(self, model_file):
+        """
+        Return a loaded model, loading it from disk if it is not resident
+        Args:
+            model_file: file path of the FastText model
+        """
+        if model_file in self.models:
+            self.hits += 1
+            self.models.move_to_end(model_file)
+            return self.models[model_file][0]
+        self.misses += 1
+        start = time.time()
+        model = load_model(model_file, self.backend)
+        self.load_seconds += time.time() - start
+        #Without a budget, models are released once used, as when loading each model directly
+        if self.max_bytes is None:
+            return model
+        size = os.path.getsize(model_file)
+        self.models[model_file] = (model, size)
+        self.resident_bytes += size
+        #Evict least recently used models, always keeping the model that was just loaded
+        while self.resident_bytes > self.max_bytes and len(self.models) > 1:
+            _, (_, evicted_size) = self.models.popitem(last = False)
+            self.resident_bytes -= evicted_size
+            self.evictions += 1
+        return model
+
+    def stage(self, model_files):
+        """
+        Load models which fit within the memory budget together, returning {model file => model} for the staged models. Models which do not fit are left for their user to load
+        Args:
+            model_files: file paths of FastText models, in order of priority
+        """
+        staged = {}
+        if self.max_bytes is None:
+            return staged
+        staged_bytes = 0
+        for model_file in model_files:
+            size = os.path.getsize(model_file)
+            if model_file in staged or staged_bytes + size > self.max_bytes:
+                continue
+            staged[model_file] = self.get(model_file)
+            staged_bytes += size
+        return staged
+
+    def report(self):
+        """
+        Print hit, miss, eviction and load-time counters
+        """
+        print(f"Model cache: {self.hits} hits, {self.misses} misses, {self.evictions} evictions, {self.load_seconds:.2f}s loading, {len(self.models)} models resident ({self.resident_bytes / 1e9:.2f} GB)")
+
+
+def split_batches(sentences, batch_size = 100000):
+    """
+    Split a list of k-merized reads into batches
+    Args:
+        sentences: list of k-merized reads
+        batch_size: number of reads per batch
+    """
+    return [sentences[start:start + batch_size] for start in range(0, len(sentences), batch_size)]
+
+def batch_predict(model, batches):
+    """
+    Generate top-1 predictions for batches of k-merized reads, sending each batch to FastText as a list
+    Args:
+        model: loaded FastText model
+        batches: iterable of lists of k-merized reads
+    """
+    labels = []
+    scores = []
+    for batch in batches:
+        #Reads which were not k-merized are classified directly by the NumPy backend
+        if isinstance(batches, KmerBatches) and not batches.kmerize:
+            batch_labels, batch_scores = model.predict_reads(batch, batches.ksize)
+        else:
+            batch_labels, batch_scores = model.predict(batch)
+        labels.extend([label[0].split("label__")[1] for label in batch_labels])
+        scores.extend([score[0] for score in batch_scores])
+    return labels, scores
+
+def predict_genus(genus, model_file, batches, positions, backend = "fasttext"):
+    """
+    Load a genus model and classify all reads routed to it
+    Args:
+        genus: genus of interest
+        model_file: file path of the genus FastText model
+        batches: iterable of lists of k-merized reads routed to the genus
+        positions: position in FASTA of each read in batches
+        backend: inference backend, either "fasttext" or "numpy"
+    """
+    start = time.time()
+    if model_file in shared_models:
+        model = shared_models[model_file]
+    else:
+        model = load_model(model_file, backend)
+    labels, scores = batch_predict(model, batches)
+    elapsed = time.time() - start
+    return genus, list(zip(labels, scores, positions)), elapsed
+
+def report_throughput(genus, num_reads, elapsed):
+    """
+    Print number of reads classified per second for a genus
+    Args:
+        genus: genus of interest
+        num_reads: number of reads classified
+        elapsed: seconds spent loading the model and classifying reads
+    """
+    rate = num_reads / elapsed if elapsed > 0 else float("inf")
+    print(f"{genus}: {num_reads} reads in {elapsed:.2f}s ({rate:.0f} reads/sec)")
+
+def fan_out(preds, positions, representative_of):
+    """
+    Copy predictions of distinct reads to every read identical to them
+    Args:
+        preds: list of predictions with structure (prediction, score, position of distinct read)
+        positions: positions of all reads
+        representative_of: for each read, the position of its distinct read
+    """
+    distinct_preds = {pred[2]: pred for pred in preds}
+    return [(distinct_preds[representative][0], distinct_preds[representative][1], position) for position, representative in zip(positions, representative_of)]
+
+def prediction_scores(preds, num_reads):
+    """
+    Return the score of each read's prediction in original read order, NaN for reads without a prediction
+    Args:
+        preds: list of predictions with structure (prediction, score, position in FASTA)
+        num_reads: number of reads in FASTA
+    """
+    scores = np.full(num_reads, np.nan, dtype = np.float32)
+    if len(preds) > 0:
+        scores[[pred[2] for pred in preds]] = [pred[1] for pred in preds]
+    return scores
+
+def report_deduplication(num_reads, num_distinct, elapsed):
+    """
+    Print the ratio of reads to distinct reads and the classification time saved by classifying distinct reads only
+    Args:
+        num_reads: number of reads routed to classifiers
+        num_distinct: number of distinct reads classified
+        elapsed: seconds spent classifying distinct reads
+    """
+    ratio = num_reads / num_distinct if num_distinct > 0 else 1.0
+    saved = elapsed / num_distinct * (num_reads - num_distinct) if num_distinct > 0 else 0.0
+    print(f"Deduplication: {num_reads} reads, {num_distinct} distinct ({ratio:.2f}x), ~{saved:.2f}s saved")
+
+def genus_parallel_predict(jobs, num_workers = 1, model_cache = None, backend = "fasttext", on_genus = None, start_method = None):
+    """
+    Classify reads of several genera at once using a pool of worker processes
+    Args:
+        jobs: list of tuples with structure (genus, model file, batches of k-merized reads, positions in FASTA)
+        num_workers: maximum number of genera classified at the same time
+        model_cache: ModelCache used to keep models resident between samples
+        backend: inference backend, either "fasttext" or "numpy"
+        on_genus: if provided, function of (genus, predictions) called as each genus completes
+        start_method: start method of worker processes, e.g. "spawn" while other threads of this process hold locks, workers then loading every model themselves (None to fork workers sharing the models staged by model_cache)
+    """
+    pred_tracker = []
+    #Submit largest genera first so that they do not end up running alone at the end
+    jobs = sorted(jobs, key = lambda job: len(job[3]), reverse = True)
+    try:
+        #Run in-process when only a single worker is requested, avoiding the cost of copying reads to a worker
+        if num_workers <= 1 or len(jobs) <= 1:
+            for genus, model_file, batches, positions in jobs:
+                if model_cache is not None:
+                    shared_models[model_file] = model_cache.get(model_file)
+                genus, preds, elapsed = predict_genus(genus, model_file, batches, positions, backend)
+                report_throughput(genus, len(preds), elapsed)
+                if on_genus is not None:
+                    on_genus(genus, preds)
+                pred_tracker.extend(preds)
+                shared_models.pop(model_file, None)
+            return pred_tracker
+        context = None
+        if start_method is not None:
+            context = multiprocessing.get_context(start_method)
+        elif model_cache is not None:
+            #Models fitting within the cache budget are loaded by the parent process and shared with forked workers, which load the others themselves
+            shared_models.update(model_cache.stage([model_file for genus, model_file, batches, positions in jobs]))
+            if len(shared_models) > 0 and "fork" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(max_workers = min(num_workers, len(jobs)), mp_context = context) as executor:
+            futures = [executor.submit(predict_genus, genus, model_file, batches, positions, backend) for genus, model_file, batches, positions in jobs]
+            for future in as_completed(futures):
+                genus, preds, elapsed = future.result()
+                report_throughput(genus, len(preds), elapsed)
+                if on_genus is not None:
+                    on_genus(genus, preds)
+                pred_tracker.extend(preds)
+        return pred_tracker
+    finally:
+        shared_models.clear()
@@ -0,0 +1,290 @@
+import hashlib
+import numpy as np
+import os
+
+from HiTaxon.train_utils import build_kmers
+
+#Lookup tables between bases and their 2-bit codes; any other character is recorded as an exception
+BASES = np.frombuffer(b"ACGT", dtype = np.uint8)
+CODES = np.zeros(256, dtype = np.uint8)
+CODES[BASES] = np.arange(4, dtype = np.uint8)
+VALID = np.zeros(256, dtype = bool)
+VALID[BASES] = True
+
+
+def fasta_records(fasta, chunk_size = 100000):
+    """
+    Parse the sequences of a FASTA file in chunks, without Biopython or record identifiers
+    Args:
+        fasta: file path to fasta
+        chunk_size: number of sequences per chunk
+    """
+    chunk = []
+    lines = None
+    with open(fasta, "rb") as f:
+        for line in f:
+            if line.startswith(b">"):
+                if lines is not None:
+                    chunk.append(b"".join(lines).replace(b" ", b""))
+                    if len(chunk) == chunk_size:
+                        yield chunk
+                        chunk = []
+                lines = []
+            elif lines is not None:
+                lines.append(line.rstrip())
+    if lines is not None:
+        chunk.append(b"".join(lines).replace(b" ", b""))
+    if len(chunk) > 0:
+        yield chunk
+
+def reference_chunks(fasta_files, chunk_bases = 5000000):
+    """
+    Read reference sequences in chunks of roughly chunk_bases bases
+    Args:
+        fasta_files: FASTA files to read
+        chunk_bases: number of bases per chunk
+    """
+    chunk = []
+    num_bases = 0
+    for fasta in fasta_files:
+        for records in fasta_records(fasta, 1000):
+            for sequence in records:
+                chunk.append(sequence)
+                num_bases += len(sequence)
+                if num_bases >= chunk_bases:
+                    yield chunk
+                    chunk = []
+                    num_bases = 0
+    if len(chunk) > 0:
+        yield chunk
+
+def read_hashes(sequences):
+    """
+    Compute a 128-bit digest of each read, used to find identical reads
+    Args:
+        sequences: list of reads, as str or bytes
+    """
+    digests = [hashlib.blake2b(sequence if isinstance(sequence, bytes) else sequence.encode(), digest_size = 16).digest() for sequence in sequences]
+    return np.array(digests, dtype = "S16")
+
+def fasta_hashes(fasta, chunk_size = 100000):
+    """
+    Compute the digest of every read of a FASTA file, as recorded in a read store built from it
+    Args:
+        fasta: file path to fasta
+        chunk_size: number of reads hashed at a time
+    """
+    hashes = [read_hashes(chunk) for chunk in fasta_records(fasta, chunk_size)]
+    return np.concatenate(hashes) if hashes else np.zeros(0, dtype = "S16")
+
+def distinct_reads(keys):
+    """
+    Find distinct reads among the keys (digests or sequences) of a set of reads
+    Args:
+        keys: array of read digests or list of reads
+    Returns:
+        representatives: index of the first occurrence of each distinct read
+        inverse: for each read, the index of its distinct read in representatives
+    """
+    if len(keys) == 0:
+        return np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64)
+    _, representatives, inverse = np.unique(np.asarray(keys), return_index = True, return_inverse = True)
+    return representatives, inverse.reshape(-1)
+
+def deduplicate_positions(positions, keys):
+    """
+    Reduce a set of reads to one position per distinct read
+    Args:
+        positions: positions of reads in the original FASTA
+        keys: digest or sequence of each read
+    Returns:
+        distinct_positions: sorted positions of the first occurrence of each distinct read
+        representative_of: for each read, the position of its distinct read
+    """
+    positions = np.asarray(positions, dtype = np.int64)
+    representatives, inverse = distinct_reads(keys)
+    return np.sort(positions[representatives]).tolist(), positions[representatives][inverse]
+
+def canonical_kmers(sequences, ksize = 19):
+    """
+    Encode the k-mers of a list of sequences as 64-bit integers, taking the smaller of each k-mer and its reverse complement so that both strands match
+    Args:
+        sequences: list of sequences, as str or bytes
+        ksize: size of k-mers (at most 31)
+    Returns:
+        kmers: array of canonical k-mers, skipping k-mers which contain bases other than A, C, G or T
+        owners: index in sequences of the sequence each k-mer comes from
+    """
+    sequences = [sequence if isinstance(sequence, bytes) else sequence.encode() for sequence in sequences]
+    lengths = np.array([len(sequence) for sequence in sequences], dtype = np.int64)
+    data = np.frombuffer(b"".join(sequences), dtype = np.uint8)
+    if len(data) < ksize:
+        return np.zeros(0, dtype = np.uint64), np.zeros(0, dtype = np.int64)
+    codes = CODES[data].astype(np.uint64)
+    num_windows = len(data) - ksize + 1
+    forward = np.zeros(num_windows, dtype = np.uint64)
+    reverse = np.zeros(num_windows, dtype = np.uint64)
+    for offset in range(ksize):
+        window = codes[offset:offset + num_windows]
+        forward = (forward << np.uint64(2)) | window
+        reverse = reverse | ((np.uint64(3) - window) << np.uint64(2 * offset))
+    #Keep windows lying within a single sequence and made only of A, C, G and T
+    invalid = np.concatenate([[0], np.cumsum(~VALID[data])])
+    keep = invalid[ksize:] - invalid[:num_windows] == 0
+    ends = np.cumsum(lengths)
+    owners = np.searchsorted(ends, np.arange(num_windows), side = "right")
+    keep &= np.arange(num_windows) + ksize <= ends[owners]
+    return np.minimum(forward, reverse)[keep], owners[keep]
+
+def pack_bases(codes):
+    """
+    Pack 2-bit base codes four to a byte, first base in the lowest bits
+    Args:
+        codes: array of base codes with a length divisible by four
+    """
+    codes = codes.reshape(-1, 4)
+    return codes[:, 0] | (codes[:, 1] << 2) | (codes[:, 2] << 4) | (codes[:, 3] << 6)
+
+def build_read_store(fasta, store_path, chunk_size = 100000):
+    """
+    Convert a FASTA file into a packed read store composed of:
+        bases.bin: 2-bit packed bases of all reads, concatenated
+        offsets.npy: start of each read in bases.bin (in bases), followed by the total number of bases
+        exception_positions.npy / exception_bases.npy: position and original character of every base other than A, C, G or T (i.e N)
+        hashes.npy: 128-bit digest of each read, used to find identical reads
+    Args:
+        fasta: file path to fasta
+        store_path: directory in which the read store is written
+        chunk_size: number of reads encoded at a time
+    """
+    os.makedirs(store_path, exist_ok = True)
+    offsets = [np.zeros(1, dtype = np.int64)]
+    exception_positions = []
+    exception_bases = []
+    hashes = []
+    total = 0
+    carry = np.zeros(0, dtype = np.uint8)
+    with open(f"{store_path}/bases.bin", "wb") as f:
+        for chunk in fasta_records(fasta, chunk_size):
+            lengths = np.array([len(sequence) for sequence in chunk], dtype = np.int64)
+            data = np.frombuffer(b"".join(chunk), dtype = np.uint8)
+            hashes.append(read_hashes(chunk))
+            #Record non-ACGT characters so that reads are restored exactly
+            exceptions = np.flatnonzero(~VALID[data])
+            exception_positions.append(exceptions + total)
+            exception_bases.append(data[exceptions])
+            offsets.append(total + np.cumsum(lengths))
+            total += len(data)
+            #Bases left over from the last chunk are packed together with this one
+            codes = np.concatenate([carry, CODES[data]])
+            full = len(codes) // 4 * 4
+            f.write(pack_bases(codes[:full]).tobytes())
+            carry = codes[full:]
+        if len(carry) > 0:
+            f.write(pack_bases(np.concatenate([carry, np.zeros(4 - len(carry), dtype = np.uint8)])).tobytes())
+    np.save(f"{store_path}/exception_positions.npy", np.concatenate(exception_positions) if exception_positions else np.zeros(0, dtype = np.int64))
+    np.save(f"{store_path}/exception_bases.npy", np.concatenate(exception_bases) if exception_bases else np.zeros(0, dtype = np.uint8))
+    np.save(f"{store_path}/hashes.npy", np.concatenate(hashes) if hashes else np.zeros(0, dtype = "S16"))
+    #Offsets are written last, marking the read store as complete
+    np.save(f"{store_path}/offsets.npy", np.concatenate(offsets))
+
+def read_store_exists(store_path):
+    """
+    Check whether a complete read store is present
+    Args:
+        store_path: directory of the read store
+    """
+    return os.path.exists(f"{store_path}/offsets.npy")
+
+class ReadStore:
+    """
+    Memory-mapped access by position to the reads of a store written by build_read_store
+    Args:
+        store_path: directory of the read store
+    """
+    def __init__(self, store_path):
+        self.store_path = store_path
+        self.offsets = np.load(f"{store_path}/offsets.npy", mmap_mode = "r")
+        self.exception_positions = np.load(f"{store_path}/exception_positions.npy", mmap_mode = "r")
+        self.exception_bases = np.load(f"{store_path}/exception_bases.npy", mmap_mode = "r")
+        if os.path.getsize(f"{store_path}/bases.bin") > 0:
+            self.bases = np.memmap(f"{store_path}/bases.bin", dtype = np.uint8, mode = "r")
+        else:
+            self.bases = np.zeros(0, dtype = np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self, positions):
+        """
+        Return the length of the reads at the given positions
+        Args:
+            positions: positions of reads in the original FASTA
+        """
+        positions = np.asarray(positions, dtype = np.int64)
+        return self.offsets[positions + 1] - self.offsets[positions]
+
+    def hashes(self, positions):
+        """
+        Return the digest of the reads at the given positions
+        Args:
+            positions: positions of reads in the original FASTA
+        """
+        if os.path.exists(f"{self.store_path}/hashes.npy"):
+            return np.load(f"{self.store_path}/hashes.npy", mmap_mode = "r")[np.asarray(positions, dtype = np.int64)]
+        #Stores written before digests were recorded are hashed on the fly
+        return read_hashes(self.fetch(positions))
+
+    def fetch(self, positions):
+        """
+        Decode the reads at the given positions
+        Args:
+            positions: positions of reads in the original FASTA
+        """
+        positions = np.asarray(positions, dtype = np.int64)
+        if len(positions) == 0:
+            return []
+        starts = self.offsets[positions]
+        lengths = self.offsets[positions + 1] - starts
+        ends = np.cumsum(lengths)
+        begins = ends - lengths
+        #Position in the store of every base to decode, read after read
+        index = np.repeat(starts - begins, lengths) + np.arange(ends[-1])
+        characters = BASES[(self.bases[index >> 2] >> ((index & 3) << 1)) & 3]
+        #Restore non-ACGT characters falling within the requested reads
+        low = np.searchsorted(self.exception_positions, starts)
+        counts = np.searchsorted(self.exception_positions, starts + lengths) - low
+        if counts.sum() > 0:
+            exception_index = np.repeat(low - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+            characters[np.repeat(begins - starts, counts) + self.exception_positions[exception_index]] = self.exception_bases[exception_index]
+        data = characters.tobytes()
+        return [data[begin:end].decode() for begin, end in zip(begins, ends)]
+
+class KmerBatches:
+    """
+    Iterable of k-merized reads, fetched lazily from a read store one batch at a time
+    Args:
+        store_path: directory of the read store
+        positions: positions of the reads to fetch, in the order they are to be returned
+        ksize: size of k-mers to be created from sequence data
+        batch_size: number of reads k-merized at a time
+        kmerize: if False, reads are returned as they are, for classifiers which k-merize reads themselves
+    """
+    def __init__(self, store_path, positions, ksize = 13, batch_size = 100000, kmerize = True):
+        self.store_path = store_path
+        self.positions = positions
+        self.ksize = ksize
+        self.batch_size = batch_size
+        self.kmerize = kmerize
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __iter__(self):
+        store = ReadStore(self.store_path)
+        for start in range(0, len(self.positions), self.batch_size):
+            batch = store.fetch(self.positions[start:start + self.batch_size])
+            if self.kmerize:
+                yield [build_kmers(sequence, self.ksize) for sequence in batch]
+            else:
+                yield batch
@@ -0,0 +1,306 @@
+import glob
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+from HiTaxon.evaluation_utils import evaluation, evaluation_bwa, ensemble
+from HiTaxon.kraken_utils import LineageTable, ingest_kraken
+from HiTaxon.prediction_utils import ModelCache
+from HiTaxon.sequence_utils import build_read_store, read_store_exists
+
+
+def split_reads(sequence_file, kraken_file, shard_path, num_shards):
+    """
+    Split a FASTA file and its Kraken2 per-read output into contiguous read shards, {shard_path}/shard_{i}.fa and {shard_path}/shard_{i}.kraken. Returns shards with structure [{"name", "start", "num_reads"}...]
+    Args:
+        sequence_file: file path of FASTA file to analyze
+        kraken_file: file path of Kraken2 per-read output of the FASTA file
+        shard_path: directory in which shards are written
+        num_shards: number of shards, reduced to the number of reads if there are fewer reads
+    """
+    os.makedirs(shard_path, exist_ok = True)
+    num_reads = 0
+    with open(sequence_file, "rb") as f:
+        for line in f:
+            if line.startswith(b">"):
+                num_reads += 1
+    num_shards = max(1, min(num_shards, num_reads))
+    sizes = [num_reads // num_shards + (1 if index < num_reads % num_shards else 0) for index in range(num_shards)]
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(int)
+    shards = [{"name": f"shard_{index:05d}", "start": int(start), "num_reads": int(size)} for index, (start, size) in enumerate(zip(starts, sizes))]
+    for source, extension, is_record in [(sequence_file, "fa", lambda line: line.startswith(b">")), (kraken_file, "kraken", lambda line: True)]:
+        index = -1
+        position = 0
+        out = None
+        with open(source, "rb") as f:
+            for line in f:
+                if is_record(line):
+                    #Move to the next shard on the first record past the end of the current one
+                    while index + 1 < num_shards and position >= shards[index + 1]["start"]:
+                        index += 1
+                        if out is not None:
+                            out.close()
+                        out = open(f"{shard_path}/{shards[index]['name']}.{extension}", "wb")
+                    position += 1
+                if out is not None:
+                    out.write(line)
+        if out is not None:
+            out.close()
+        if position != num_reads:
+            raise ValueError(f"{source} has {position} reads, expected {num_reads}")
+    return shards
+
+def plan_shards(sequence_file, kraken_file, shard_path, num_shards, report_path, report_name, mode, specialized_path, ncbi, reference_assembly, threads = 1, alignment = "genus", prescreen = False, backend = "fasttext", model_cache_bytes = None):
+    """
+    Split a sample into read shards and write {shard_path}/manifest.json describing how each shard is evaluated, so that any worker with access to shard_path can evaluate it. The lineage of every taxid in the sample is expanded once into a lineage table shared by all shards. Returns the file path of the manifest
+    Args:
+        sequence_file: file path of FASTA file to analyze
+        kraken_file: file path of Kraken2 per-read output of the FASTA file
+        shard_path: directory shared by all workers, in which shards, locks and shard outputs are written
+        num_shards: number of shards
+        report_path: path to store merged classifer output
+        report_name: file name of merged output
+        mode: ensemble mode, either Kraken2_ML or Kraken2_BWA
+        specialized_path: path in which models or BWA indices are stored
+        ncbi: NCBITaxa()
+        reference_assembly: RefSeq assembly summary
+        threads: number of threads used by each BWA alignment of a worker
+        alignment: BWA alignment mode passed to evaluation_bwa
+        prescreen: skip aligning reads without k-mers in their genus Bloom filter
+        backend: ML inference backend, either "fasttext" or "numpy"
+        model_cache_bytes: memory budget of each worker for models kept loaded between shards (None to load each model when used)
+    """
+    shard_path = os.path.abspath(shard_path)
+    shards = split_reads(sequence_file, kraken_file, shard_path, num_shards)
+    table_file = f"{shard_path}/lineage_table.npz"
+    table = LineageTable(table_file)
+    for chunk in pd.read_csv(kraken_file, delimiter = "\t", header = None, usecols = [2], chunksize = 1000000):
+        table.add(chunk[2].values.astype(np.int64), ncbi, reference_assembly)
+    table.save()
+    manifest = {
+        "report_path": os.path.abspath(report_path),
+        "report_name": report_name,
+        "mode": mode,
+        "specialized_path": os.path.abspath(specialized_path),
+        "shard_path": shard_path,
+        "lineage_table": table_file,
+        "threads": threads,
+        "alignment": alignment,
+        "prescreen": prescreen,
+        "backend": backend,
+        "model_cache_bytes": model_cache_bytes,
+        "shards": shards,
+    }
+    manifest_file = f"{shard_path}/manifest.json"
+    json.dump(manifest, open(manifest_file, "w"), indent = 2)
+    return manifest_file
+
+def shard_file(shard_path, name, suffix, attempt = None):
+    """
+    Return the file path of a lock, failure, completion or output file of a shard
+    Args:
+        shard_path: directory of shards
+        name: name of the shard
+        suffix: "lock", "failed", "done" or "out"
+        attempt: attempt number, for every suffix but "done"
+    """
+    if attempt is None:
+        return f"{shard_path}/{name}.{suffix}"
+    return f"{shard_path}/{name}.attempt{attempt}.{suffix}"
+
+def shard_attempts(shard_path, name):
+    """
+    Return the attempt numbers of a shard claimed so far
+    Args:
+        shard_path: directory of shards
+        name: name of the shard
+    """
+    return sorted([int(lock.split(".attempt")[-1].split(".")[0]) for lock in glob.glob(f"{shard_path}/{name}.attempt*.lock")])
+
+def shard_status(shard_path, name, timeout, max_attempts, retry_seconds = 60):
+    """
+    Return the status of a shard: "done", "running" (or waiting to be retried after a failure), "pending" (never claimed, failed or timed out, and can be claimed) or "exhausted" (failed or timed out max_attempts times)
+    Args:
+        shard_path: directory of shards
+        name: name of the shard
+        timeout: seconds without a heartbeat after which a claimed shard is considered timed out
+        max_attempts: maximum number of attempts per shard
+        retry_seconds: seconds waited after a failed attempt before the shard can be claimed again
+    """
+    if os.path.exists(shard_file(shard_path, name, "done")):
+        return "done"
+    attempts = shard_attempts(shard_path, name)
+    if len(attempts) == 0:
+        return "pending" if max_attempts > 0 else "exhausted"
+    last = attempts[-1]
+    failed_file = shard_file(shard_path, name, "failed", last)
+    failed = os.path.exists(failed_file)
+    try:
+        timed_out = time.time() - os.path.getmtime(shard_file(shard_path, name, "lock", last)) > timeout
+    except FileNotFoundError:
+        timed_out = False
+    if (failed or timed_out) and last + 1 >= max_attempts:
+        return "exhausted"
+    if failed:
+        return "pending" if time.time() - os.path.getmtime(failed_file) > retry_seconds else "running"
+    return "pending" if timed_out else "running"
+
+def claim_shard(shard_path, name, timeout, max_attempts, retry_seconds = 60):
+    """
+    Claim a shard by atomically creating the lock file of its next attempt, returning the attempt number, or None if the shard is done, running, exhausted or was claimed by another worker first
+    Args:
+        shard_path: directory of shards
+        name: name of the shard
+        timeout: seconds without a heartbeat after which a claimed shard is considered timed out
+        max_attempts: maximum number of attempts per shard
+        retry_seconds: seconds waited after a failed attempt before the shard can be claimed again
+    """
+    if shard_status(shard_path, name, timeout, max_attempts, retry_seconds) != "pending":
+        return None
+    attempts = shard_attempts(shard_path, name)
+    attempt = attempts[-1] + 1 if len(attempts) > 0 else 0
+    #Only one worker can create the lock file of an attempt, so each attempt has a single owner
+    try:
+        lock = os.open(shard_file(shard_path, name, "lock", attempt), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return None
+    os.write(lock, f"{socket.gethostname()}\t{os.getpid()}\t{time.time()}\n".encode())
+    os.close(lock)
+    return attempt
+
+def heartbeat(lock_file, interval, stop):
+    """
+    Refresh the modification time of a lock file until stopped, showing that its shard is still being evaluated
+    Args:
+        lock_file: file path of the lock
+        interval: seconds between refreshes
+        stop: threading.Event set once the shard is finished
+    """
+    while not(stop.wait(interval)):
+        os.utime(lock_file)
+
+def evaluate_shard(manifest, shard, out_path, model_cache = None):
+    """
+    Run lineage mapping, specialized classification and ensembling for a shard, writing its lineage, specialized and ensemble CSVs to out_path
+    Args:
+        manifest: manifest written by plan_shards
+        shard: shard entry of the manifest
+        out_path: directory in which the outputs of the attempt are written
+        model_cache: ModelCache keeping models loaded between the shards of a worker
+    """
+    os.makedirs(out_path, exist_ok = True)
+    name = shard["name"]
+    shard_path = manifest["shard_path"]
+    #The shared lineage table already holds every taxid of the sample, so NCBI's taxonomy is not needed
+    table = LineageTable(manifest["lineage_table"], read_only = True)
+    kraken_calls = ingest_kraken(f"{shard_path}/{name}.kraken", table, None, None)
+    kraken_calls.write_lineage(f"{out_path}/{name}_lineage_kraken.csv")
+    read_store = f"{out_path}/{name}_reads"
+    if not(read_store_exists(read_store)):
+        build_read_store(f"{shard_path}/{name}.fa", read_store)
+    if manifest["mode"] == "Kraken2_ML":
+        model_output = evaluation(out_path, name, manifest["specialized_path"], 0.5, 1, read_store = read_store, model_cache = model_cache, backend = manifest["backend"], kraken_calls = kraken_calls)
+        output = "ml"
+    else:
+        model_output = evaluation_bwa(out_path, name, manifest["specialized_path"], read_store, num_threads = manifest["threads"], alignment = manifest["alignment"], prescreen = manifest["prescreen"], kraken_calls = kraken_calls)
+        output = "bwa"
+    model_output.to_csv(f"{out_path}/{name}_{output}.csv")
+    ensemble(out_path, name, manifest["mode"], kraken_calls).to_csv(f"{out_path}/{name}_ensemble_{output}.csv")
+
+def run_worker(manifest_file, timeout = 3600, max_attempts = 3, poll_seconds = 10, retry_seconds = 60):
+    """
+    Claim and evaluate shards until every shard is done or exhausted, waiting on shards claimed by other workers so that they can be taken over if they time out. Returns the number of shards evaluated by this worker
+    Args:
+        manifest_file: file path of the manifest written by plan_shards
+        timeout: seconds without a heartbeat after which a claimed shard is considered timed out
+        max_attempts: maximum number of attempts per shard
+        poll_seconds: seconds waited before checking shards claimed by other workers again
+        retry_seconds: seconds waited after a failed attempt before the shard can be claimed again
+    """
+    manifest = json.load(open(manifest_file))
+    shard_path = manifest["shard_path"]
+    #Models stay loaded between the shards of a worker within the budget of the manifest
+    model_cache = ModelCache(manifest.get("model_cache_bytes"), manifest["backend"])
+    completed = 0
+    while True:
+        for shard in manifest["shards"]:
+            name = shard["name"]
+            attempt = claim_shard(shard_path, name, timeout, max_attempts, retry_seconds)
+            if attempt is None:
+                continue
+            stop = threading.Event()
+            beat = threading.Thread(target = heartbeat, args = (shard_file(shard_path, name, "lock", attempt), max(1, timeout / 4), stop), daemon = True)
+            beat.start()
+            start = time.time()
+            try:
+                evaluate_shard(manifest, shard, shard_file(shard_path, name, "out", attempt), model_cache)
+                #The first attempt to finish provides the outputs of the shard
+                try:
+                    done = os.open(shard_file(shard_path, name, "done"), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                    os.write(done, json.dumps({"attempt": attempt, "host": socket.gethostname(), "seconds": time.time() - start}).encode())
+                    os.close(done)
+                except FileExistsError:
+                    pass
+                completed += 1
+                print(f"{name}: {shard['num_reads']} reads evaluated in {time.time() - start:.2f}s (attempt {attempt})")
+            except Exception:
+                with open(shard_file(shard_path, name, "failed", attempt), "w") as f:
+                    f.write(traceback.format_exc())
+                print(f"{name}: attempt {attempt} failed, see {shard_file(shard_path, name, 'failed', attempt)}")
+            finally:
+                stop.set()
+                beat.join()
+        statuses = [shard_status(shard_path, shard["name"], timeout, max_attempts, retry_seconds) for shard in manifest["shards"]]
+        if not("pending" in statuses or "running" in statuses):
+            return completed
+        if not("pending" in statuses):
+            time.sleep(poll_seconds)
+
+def run_local(manifest_file, num_workers = 1, timeout = 3600, max_attempts = 3, poll_seconds = 10, retry_seconds = 60):
+    """
+    Evaluate shards with several worker processes on this machine, sharing the same lock files as workers on other nodes
+    Args:
+        manifest_file: file path of the manifest written by plan_shards
+        num_workers: number of worker processes
+        timeout: seconds without a heartbeat after which a claimed shard is considered timed out
+        max_attempts: maximum number of attempts per shard
+        poll_seconds: seconds waited before checking shards claimed by other workers again
+        retry_seconds: seconds waited after a failed attempt before the shard can be claimed again
+    """
+    if num_workers <= 1:
+        return run_worker(manifest_file, timeout, max_attempts, poll_seconds, retry_seconds)
+    with ProcessPoolExecutor(max_workers = num_workers) as executor:
+        futures = [executor.submit(run_worker, manifest_file, timeout, max_attempts, poll_seconds, retry_seconds) for worker in range(num_workers)]
+        return sum([future.result() for future in futures])
+
+def merge_shard_outputs(manifest_file):
+    """
+    Concatenate the lineage, specialized and ensemble CSVs of all shards in original read order, writing {report_name}_lineage_kraken.csv, {report_name}_ml.csv or {report_name}_bwa.csv and the matching ensemble CSV to report_path
+    Args:
+        manifest_file: file path of the manifest written by plan_shards
+    """
+    manifest = json.load(open(manifest_file))
+    shard_path = manifest["shard_path"]
+    missing = [shard["name"] for shard in manifest["shards"] if not(os.path.exists(shard_file(shard_path, shard["name"], "done")))]
+    if len(missing) > 0:
+        raise RuntimeError(f"{len(missing)} shards are not done: {', '.join(missing)}. Run workers again, with a higher --max_attempts for shards that failed too often")
+    output = "ml" if manifest["mode"] == "Kraken2_ML" else "bwa"
+    done = {shard["name"]: json.load(open(shard_file(shard_path, shard["name"], "done"))) for shard in manifest["shards"]}
+    for suffix in ["lineage_kraken", output, f"ensemble_{output}"]:
+        frames = []
+        for shard in manifest["shards"]:
+            out_path = shard_file(shard_path, shard["name"], "out", done[shard["name"]]["attempt"])
+            #Values are kept as written, so that the merged CSV matches a single-process run
+            frame = pd.read_csv(f"{out_path}/{shard['name']}_{suffix}.csv", index_col = 0, dtype = str, keep_default_na = False)
+            if "Unnamed: 0" in frame.columns:
+                frame["Unnamed: 0"] = (frame["Unnamed: 0"].astype(np.int64) + shard["start"]).astype(str)
+            frames.append(frame)
+        pd.concat(frames, ignore_index = True).to_csv(f"{manifest['report_path']}/{manifest['report_name']}_{suffix}.csv")
+    seconds = [entry["seconds"] for entry in done.values()]
+    print(f"Merged {len(seconds)} shards: {sum(seconds):.2f}s of evaluation, longest shard {max(seconds):.2f}s")
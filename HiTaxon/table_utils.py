@@ -0,0 +1,113 @@
+import os
+import numpy as np
+import pandas as pd
+
+#Output formats of per-read tables, as file extensions
+TABLE_FORMATS = ["csv", "parquet"]
+#Rank columns, which the specialized classifiers fill with zeros when they do not predict them
+RANK_COLUMNS = ["phylum", "class", "order", "family", "genus", "species"]
+#Calls written to CSV for reads without a taxon, read back as missing
+MISSING_CALLS = ["NA", "nan"]
+
+
+def require_arrow():
+    """
+    Import pyarrow, which is only needed to read and write Parquet tables
+    """
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError("Parquet tables need pyarrow, install it with 'conda install -c conda-forge pyarrow' or write CSV tables instead")
+    return pyarrow
+
+def output_file(report_path, report_name, suffix, table_format = "csv"):
+    """
+    Return the file path of a per-read table in the given format
+    Args:
+        report_path: path to store classifer output
+        report_name: file name of output
+        suffix: table written, e.g. "lineage_kraken", "ml" or "ensemble_ml"
+        table_format: either "csv" or "parquet"
+    """
+    if not(table_format in TABLE_FORMATS):
+        raise ValueError(f"Unknown table format {table_format}, options being {', '.join(TABLE_FORMATS)}")
+    return f"{report_path}/{report_name}_{suffix}.{table_format}"
+
+def table_path(report_path, report_name, suffix):
+    """
+    Return the file path of the most recently written format of a per-read table, defaulting to CSV
+    Args:
+        report_path: path to store classifer output
+        report_name: file name of output
+        suffix: table written, e.g. "lineage_kraken", "ml" or "ensemble_ml"
+    """
+    written = [output_file(report_path, report_name, suffix, table_format) for table_format in TABLE_FORMATS]
+    written = [table_file for table_file in written if os.path.exists(table_file)]
+    if len(written) == 0:
+        return output_file(report_path, report_name, suffix)
+    return max(written, key = os.path.getmtime)
+
+def table_exists(report_path, report_name, suffix):
+    """
+    Check whether a per-read table was written in any format
+    Args:
+        report_path: path to store classifer output
+        report_name: file name of output
+        suffix: table written, e.g. "lineage_kraken", "ml" or "ensemble_ml"
+    """
+    return os.path.exists(table_path(report_path, report_name, suffix))
+
+def columnar_frame(frame, scores = None):
+    """
+    Convert a per-read table to columns stored compactly: taxa become categoricals holding each name once, with missing calls as nulls, and zero-filled rank placeholders and the row number column are dropped
+    Args:
+        frame: per-read table in the format written to CSV
+        scores: score of each read's prediction, stored as a float32 column (None to store no scores)
+    """
+    columns = {}
+    for column in frame.columns:
+        values = frame[column]
+        if column == "Unnamed: 0" or (column in RANK_COLUMNS and values.dtype != object and not(isinstance(values.dtype, pd.CategoricalDtype))):
+            continue
+        if values.dtype == object or isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.astype("category")
+            values = values.cat.remove_categories([call for call in MISSING_CALLS if call in values.cat.categories])
+        columns[column] = values.values
+    if scores is not None:
+        columns["score"] = np.asarray(scores, dtype = np.float32)
+    return pd.DataFrame(columns)
+
+def write_table(frame, table_file, scores = None):
+    """
+    Write a per-read table as CSV or, for .parquet files, as a dictionary-encoded Parquet table
+    Args:
+        frame: per-read table
+        table_file: file path ending in .csv or .parquet
+        scores: score of each read's prediction, only stored in Parquet tables
+    """
+    if table_file.endswith(".parquet"):
+        require_arrow()
+        columnar_frame(frame, scores).to_parquet(table_file, engine = "pyarrow", index = False, compression = "zstd")
+    else:
+        frame.to_csv(table_file)
+
+def read_table(table_file, columns = None, categorical = False):
+    """
+    Read a per-read table written by write_table, with missing calls read as NaN in both formats
+    Args:
+        table_file: file path ending in .csv or .parquet
+        columns: columns to read (None to read all columns)
+        categorical: keep taxa of Parquet tables as categoricals instead of decoding them to strings
+    """
+    if not(table_file.endswith(".parquet")):
+        return pd.read_csv(table_file, usecols = columns)
+    require_arrow()
+    frame = pd.read_parquet(table_file, engine = "pyarrow", columns = columns)
+    if not(categorical):
+        for column in frame.columns:
+            if isinstance(frame[column].dtype, pd.CategoricalDtype):
+                frame[column] = frame[column].astype(object)
+    if columns is None:
+        #Match the columns of the CSV read back with pandas, so that outputs written from either format are unchanged
+        frame.insert(0, "Unnamed: 0", np.arange(len(frame)))
+    return frame
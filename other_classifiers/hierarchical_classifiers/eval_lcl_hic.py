@@ -19,6 +19,7 @@ def main():
     parser.add_argument("report_path", type = str, help = "path in which outputs are saved")
     parser.add_argument("report_name", type = str, help = "file name of output")
     parser.add_argument("sequence_file", type = str, help = "file path for K-merized sequence file to analyze")
+    parser.add_argument("--backend", type = str, default = "fasttext", choices = ["fasttext", "numpy"], help = "inference backend used to classify reads")
 
     args = parser.parse_args()
     output_path = args.output_path
@@ -28,7 +29,7 @@ def main():
     sequence_file = args.sequence_file
 
     #Generate Predictions
-    hierarchical_lcl_prediction(sequence_file, report_path, report_name, model_path)
+    hierarchical_lcl_prediction(sequence_file, report_path, report_name, model_path, args.backend)
 
     #Run Heirarchy-informed LCL inference scheme 
     species_record = open(f"{output_path}/{args.species_present}").read().splitlines()
@@ -16,6 +16,7 @@ def main():
     parser.add_argument("report_path", type = str, help = "path in which outputs are saved")
     parser.add_argument("report_name", type = str, help = "file name of output")
     parser.add_argument("sequence_file", type = str, help = "file path for K-merized sequence file to analyze")
+    parser.add_argument("--backend", type = str, default = "fasttext", choices = ["fasttext", "numpy"], help = "inference backend used to classify reads")
 
     args = parser.parse_args()
     model_path = args.model_path
@@ -23,7 +24,7 @@ def main():
     report_name = args.report_name
 
     #Generate predictions
-    output = lcl_lcpn_prediction(args.sequence_file, report_path, report_name, model_path)
+    output = lcl_lcpn_prediction(args.sequence_file, report_path, report_name, model_path, args.backend)
     output.to_csv(f"{report_path}/{report_name}_lcl_lcpn.csv")
 
     #Run LCL-LCPN inference scheme  
@@ -20,6 +20,7 @@ def main():
     parser.add_argument("report_path", type = str, help = "path in which outputs are saved")
     parser.add_argument("report_name", type = str, help = "file name of output")
     parser.add_argument("sequence_file", type = str, help = "file path for K-merized sequence file to analyze")
+    parser.add_argument("--backend", type = str, default = "fasttext", choices = ["fasttext", "numpy"], help = "inference backend used to classify reads")
 
     args = parser.parse_args()
     output_path = args.output_path
@@ -35,7 +36,7 @@ def main():
     lineages["species"] = species_present
 
     #Generate predictions 
-    output = lcpn_prediction(lineages, sequence_file, report_path, report_name, model_path)
+    output = lcpn_prediction(lineages, sequence_file, report_path, report_name, model_path, args.backend)
     output.to_csv(f"{report_path}/{report_name}")
 
     #Run LCPN inference scheme
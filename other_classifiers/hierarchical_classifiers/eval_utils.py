@@ -1,10 +1,11 @@
 import numpy as np
 import pandas as pd
-import fasttext as ft
 
 from tqdm import tqdm
+from HiTaxon.fasttext_utils import load_model
+from HiTaxon.prediction_utils import batch_predict, split_batches
 
-def evaluate_taxa(taxa, predictions_dict, predictions_df, model_path):
+def evaluate_taxa(taxa, predictions_dict, predictions_df, model_path, backend = "fasttext"):
     """
     Generate taxonomic predictions for the next rank for all reads predicted to be of 'taxa' at current rank
     Args:
@@ -12,8 +13,9 @@ def evaluate_taxa(taxa, predictions_dict, predictions_df, model_path):
         predictions_dict: dictionary with predictions as keys, and a list composed of tuples of (sequence, position)
         prediction_df: dataframe of predictions with scores
         model_path: path in which models are saved
+        backend: inference backend, either "fasttext" or "numpy"
     """
-    model = ft.load_model(f"{model_path}/{taxa}_model.bin")
+    model = load_model(f"{model_path}/{taxa}_model.bin", backend)
     for seq in predictions_dict[taxa]:
         prediction = model.predict(seq[0])
         pred_label = prediction[0][0].split("label__")[1]
@@ -22,7 +24,7 @@ def evaluate_taxa(taxa, predictions_dict, predictions_df, model_path):
         predictions_dict[pred_label].append(seq)
         return predictions_df, predictions_dict
 
-def lcpn_prediction(lineages, sequence_file, report_path, report_name, model_path):
+def lcpn_prediction(lineages, sequence_file, report_path, report_name, model_path, backend = "fasttext"):
     """ 
     Generate predictions for all reads across all taxonomic ranks using LCPN architecture
     Args:
@@ -31,6 +33,7 @@ def lcpn_prediction(lineages, sequence_file, report_path, report_name, model_pat
         report_path: path in which outputs are saved
         report_name: output name
         model_path: path in which models are stored
+        backend: inference backend, either "fasttext" or "numpy"
     """
     ranks = ["species", "genus", "family", "class", "order", "phylum"]
     all_taxa = ["phylum"]
@@ -61,11 +64,11 @@ def lcpn_prediction(lineages, sequence_file, report_path, report_name, model_pat
     predictions["phylum"] = seqs
     #Generate predictions for each predicted taxa
     for taxa in tqdm(all_taxa[:num_of_taxa]):
-            predictions_mtx, predictions = evaluate_taxa(taxa, predictions, predictions_mtx, model_path)
+            predictions_mtx, predictions = evaluate_taxa(taxa, predictions, predictions_mtx, model_path, backend)
 
     return predictions_mtx
 
-def standard_lcl_prediction(sequence_file, report_path, report_name, model_path):
+def standard_lcl_prediction(sequence_file, report_path, report_name, model_path, backend = "fasttext"):
     """
     Generate predictions for all reads using standard LCL architecture
     Args:
@@ -73,6 +76,7 @@ def standard_lcl_prediction(sequence_file, report_path, report_name, model_path)
         report_path: path in which outputs are saved
         report_name: output name
         model_path: path in which models are stored    
+        backend: inference backend, either "fasttext" or "numpy"
     """
     ranks = ["species", "genus", "family", "class", "order", "phylum"]
     #Generate tuples of sequence and positional counter
@@ -86,16 +90,14 @@ def standard_lcl_prediction(sequence_file, report_path, report_name, model_path)
     predictions_mtx = pd.DataFrame(arr, columns = ranks)
     #Create predictions across all ranks
     for rank in ranks:
-        model = ft.load_model(f"{model_path}/{rank}_model.bin")
-        for seq in tqdm(seqs):
-            prediction = model.predict(seq[0])
-            pred_label = prediction[0][0].split("label__")[1]
-            score = prediction[1][0]
-            predictions_mtx[rank].iloc[seq[1]] = (pred_label, score)
+        model = load_model(f"{model_path}/{rank}_model.bin", backend)
+        #Classify reads in batches
+        pred_labels, scores = batch_predict(model, tqdm(split_batches([seq[0] for seq in seqs])))
+        predictions_mtx[rank] = list(zip(pred_labels, scores))
     return predictions_mtx
 
 
-def hierarchical_lcl_prediction(sequence_file, report_path, report_name, model_path):
+def hierarchical_lcl_prediction(sequence_file, report_path, report_name, model_path, backend = "fasttext"):
     """
     Generate predictions for all possible outputs across all ranks using the LCL architecture with heirarchy-informed evaluation
     Args:
@@ -103,6 +105,7 @@ def hierarchical_lcl_prediction(sequence_file, report_path, report_name, model_p
         report_path: path in which outputs are saved
         report_name: output name
         model_path: path in which models are stored    
+        backend: inference backend, either "fasttext" or "numpy"
     """
     ranks = ["species", "genus", "family", "class", "order", "phylum"]
     evaluation_file = open(sequence_file, "r")
@@ -114,33 +117,36 @@ def hierarchical_lcl_prediction(sequence_file, report_path, report_name, model_p
             counter += 1
     #Create predictions across all ranks
     for rank in ranks:
-        model = ft.load_model(f"{model_path}/{rank}_model.bin")
+        model = load_model(f"{model_path}/{rank}_model.bin", backend)
         num_labels = len(model.labels)
         predictions = []
-        for seq in tqdm(seqs):
-            all_label_outputs = {}
-            #Keep softmax score for all possible labels 
-            for label in model.labels:
-                all_label_outputs[label] = []
-            prediction = model.predict(seq[0], k = num_labels)
-            labels_and_scores = list(zip(prediction[0], prediction[1]))
-            #Create dict of structure {label A: score, label B:score}
-            for label_and_score in labels_and_scores:
-                all_label_outputs[label_and_score[0]] = (label_and_score[1])
-            predictions.append(all_label_outputs)
+        #Classify reads in batches
+        for batch in tqdm(split_batches([seq[0] for seq in seqs])):
+            batch_labels, batch_scores = model.predict(batch, k = num_labels)
+            for prediction in zip(batch_labels, batch_scores):
+                all_label_outputs = {}
+                #Keep softmax score for all possible labels 
+                for label in model.labels:
+                    all_label_outputs[label] = []
+                labels_and_scores = list(zip(prediction[0], prediction[1]))
+                #Create dict of structure {label A: score, label B:score}
+                for label_and_score in labels_and_scores:
+                    all_label_outputs[label_and_score[0]] = (label_and_score[1])
+                predictions.append(all_label_outputs)
 
         #Create CSV file for all possible label at a specific rank
         predictions_mtx = pd.DataFrame(predictions)
         predictions_mtx.to_csv(f"{report_path}/{report_name}_{rank}_lcl.csv")
 
 
-def lcl_lcpn_prediction(sequence_file, report_path, report_name, model_path):
+def lcl_lcpn_prediction(sequence_file, report_path, report_name, model_path, backend = "fasttext"):
     """
     Generate predictions for all reads across all taxonomic ranks using the LCL-LCPN architecture
         sequence_file: K-merized sequence file to analyze
         report_path: path in which outputs are saved
         report_name: output name
         model_path: path in which models are stored 
+        backend: inference backend, either "fasttext" or "numpy"
     """
     evaluation_file = open(sequence_file, "r")
     #Generate tuples of sequence and positional counter
@@ -155,14 +161,10 @@ def lcl_lcpn_prediction(sequence_file, report_path, report_name, model_path):
     for rank in ranks:
         #if rank is not genus or species, use the LCL framework for classification
         if rank in ['phylum', 'class', 'order', 'family']: 
-            model = ft.load_model(f"{model_path}/{rank}_model.bin")
+            model = load_model(f"{model_path}/{rank}_model.bin", backend)
             #Predictions for each rank are temporarily stored in prediction_tracker
-            prediction_tracker = []
-            for seq in seqs:
-                prediction = model.predict(seq[0])
-                pred_label = prediction[0][0].split("label__")[1]
-                score = prediction[1][0]
-                prediction_tracker.append((pred_label, score))
+            pred_labels, scores = batch_predict(model, split_batches([seq[0] for seq in seqs]))
+            prediction_tracker = list(zip(pred_labels, scores))
             predictions_mtx[rank] = prediction_tracker
         #Using lCPN framework for genus and species classifications
         else:
@@ -185,12 +187,10 @@ def lcl_lcpn_prediction(sequence_file, report_path, report_name, model_path):
                         prediction_tracker.append((pred_label, score, single_pred_and_position[1]))
                     continue
                 else:
-                    model = ft.load_model(f"{model_path}/{prior_pred}_model.bin")
-                for single_pred_and_position in pred_and_position:
-                    prediction = model.predict(seqs[single_pred_and_position[1]][0])
-                    pred_label = prediction[0][0].split("label__")[1]
-                    score = prediction[1][0]
-                    prediction_tracker.append((pred_label, score, single_pred_and_position[1]))
+                    model = load_model(f"{model_path}/{prior_pred}_model.bin", backend)
+                positions = [single_pred_and_position[1] for single_pred_and_position in pred_and_position]
+                pred_labels, scores = batch_predict(model, split_batches([seqs[position][0] for position in positions]))
+                prediction_tracker.extend(zip(pred_labels, scores, positions))
             #Re-sort list of predictions to ensure it matches the ordering of the original file
             prediction_tracker = sorted(prediction_tracker, key = lambda model_output: model_output[2])
             predictions_mtx[rank]= [(pred_and_score[0], pred_and_score[1]) for pred_and_score in prediction_tracker]
@@ -1,6 +1,8 @@
 import argparse
 import pandas as pd
 
+from HiTaxon.evaluation_utils import ensemble_lineages
+
 def kaiju_kraken_ensemble(report_path, report_name):
     """
     Ensemble Kaiju and Kraken2
@@ -10,20 +12,9 @@ def kaiju_kraken_ensemble(report_path, report_name):
     """
     kaiju_preds = pd.read_csv(f"{report_path}/{report_name}_lineage_kaiju.csv")
     kraken_preds = pd.read_csv(f"{report_path}/{report_name}_lineage_kraken.csv")
-    ensemble = []
     ranks = ["species", "genus", "family", "order", "class", "phylum"]
-    for i in range(0, len(kraken_preds)):
-        #If no outputs are provided at the species level, use Kraken2's predictions
-        if str(kraken_preds["species"].iloc[i]) == "nan" and str(kaiju_preds["species"].iloc[i]) == "nan":
-            ensemble.append(kraken_preds.iloc[i])
-        #else if no outputs are provided by Kraken2 at the species level, use Kaiju's predictions
-        elif str(kraken_preds["species"].iloc[i]) == "nan":
-            ensemble.append(kaiju_preds.iloc[i])
-        #by default, use Kraken2's predictions
-        else:
-            ensemble.append(kraken_preds.iloc[i])
-    ensemble_df = pd.DataFrame(ensemble)
-    return ensemble_df[ranks]
+    #Use Kaiju's predictions only where Kraken2 provides no output at the species level but Kaiju does, else Kraken2's predictions
+    return ensemble_lineages(kraken_preds, kaiju_preds, ranks)
 
 """
 Create Kaiju-Kraken2 Ensemble
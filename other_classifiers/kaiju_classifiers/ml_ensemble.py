@@ -6,7 +6,7 @@ import os
 
 from Bio import SeqIO
 from ete3 import NCBITaxa
-from HiTaxon.evaluation_utils import fasta2kmer
+from HiTaxon.evaluation_utils import fasta2kmer, ensemble_species
 
 def kaiju_HiTaxon_evaluation(sequence_file, report_path, report_name, model_path, min_threshold = 0.5):
     """
@@ -82,21 +82,9 @@ def kaiju_HiTaxon_ensemble(report_path, report_name):
         report_path: path in which Kaiju-informed ML and Kaiju outputs are saved
         report_name: pre-fix name used for Kaiju-informed ML and Kaiju outputs
     """
-    ml_species = pd.read_csv(f"{report_path}/{report_name}_ml.csv")
+    ml_species = pd.read_csv(f"{report_path}/{report_name}_ml.csv", usecols = ["species"])["species"]
     reference = pd.read_csv(f"{report_path}/{report_name}_lineage_kaiju.csv")
-    ensemble_preds = []
-    for i in range(0, len(reference)):
-        #If Kaiju has no genus predictions, ensemble leaves species unclassified
-        if str(reference["genus"].iloc[i]) == "nan":
-            ensemble_preds.append("nan")
-        #IF ML model has no species prediction, ensemble uses Kaiju prediction
-        elif str(ml_species["species"].iloc[i]) == "nan":
-            ensemble_preds.append(reference["species"].iloc[i])
-        #By default, uses ML predictions
-        else:
-            ensemble_preds.append(str(ml_species["species"].iloc[i]))
-    ensemble_preds = [str(i).replace(" ","_") for i in ensemble_preds]
-    reference["species"] = ensemble_preds
+    reference["species"] = ensemble_species(reference, ml_species)
     return reference
 
 """
@@ -121,10 +109,10 @@ def main():
     fasta2kmer(sequence_file, report_path, report_name)
 
     #Generate species-level predictions with ML models
-    ml_output = evaluation(sequence_file, report_path, report_name, model_path)
+    ml_output = kaiju_HiTaxon_evaluation(sequence_file, report_path, report_name, model_path)
     ml_output.to_csv(f"{report_path}/{report_name}kaiju_ml.csv")
     #Ensemble ML outputs with Kaiju outputs
-    ensemble_output = ensemble(report_path, report_name)
+    ensemble_output = kaiju_HiTaxon_ensemble(report_path, report_name)
     ensemble_output.to_csv(f"{report_path}/{report_name}_kaiju_HiTaxon.csv")
 
 if __name__ == "__main__":
@@ -2,6 +2,10 @@
 GENUS_NAMES=$1
 BWA_PATH=$2
 OUTPUT_PATH=$3
+BWA_COMBINED=$4
+BWA_SHARD_GB=$5
+NUM_OF_THREADS=${6:-1}
+BWA_BLOOM_FP=$7
 
 #Create directory if not exist
 if [ ! -d "$BWA_PATH" ]; then
@@ -10,7 +14,17 @@ if [ ! -d "$BWA_PATH" ]; then
 fi
 
 #Prepare sequences for BWA
-python "scripts/align/bwa_build.py" $BWA_PATH $OUTPUT_PATH $GENUS_NAMES
+BUILD_ARGS=""
+if [ "$BWA_COMBINED" = "true" ]; then
+    BUILD_ARGS="$BUILD_ARGS --combined"
+fi
+if [ -n "$BWA_SHARD_GB" ]; then
+    BUILD_ARGS="$BUILD_ARGS --shard_gb $BWA_SHARD_GB"
+fi
+if [ -n "$BWA_BLOOM_FP" ]; then
+    BUILD_ARGS="$BUILD_ARGS --bloom_fp $BWA_BLOOM_FP"
+fi
+python "scripts/align/bwa_build.py" $BWA_PATH $OUTPUT_PATH $GENUS_NAMES $BUILD_ARGS
 
 #Create BWA indices
-"scripts/align/bwa_build.sh" $GENUS_NAMES $BWA_PATH
+"scripts/align/bwa_build.sh" $GENUS_NAMES $BWA_PATH $NUM_OF_THREADS
@@ -2,7 +2,9 @@ import argparse
 import numpy as np
 import pandas as pd
 import os
-from HiTaxon.align_utils import bwa_FASTA_generator
+import glob
+from HiTaxon.align_utils import bwa_FASTA_generator, combined_FASTA_generator, shard_FASTA, genus_indices, COMBINED_INDEX
+from HiTaxon.bloom_utils import build_bloom_filter, bloom_file
 
 
 """
@@ -14,6 +16,9 @@ def main():
     parser.add_argument("bwa_path", type = str, help = "path in which bwa indices are to be stored")
     parser.add_argument("output_path", type = str, help = "path in which RefSeq data is collected and stored")
     parser.add_argument("taxa_path", type = str, help = "path in pertaining to relevant genera")
+    parser.add_argument("--shard_gb", type = float, default = None, help = "split genera whose BWA FASTA exceeds this size in GB into shards of whole species, indexed and aligned in parallel")
+    parser.add_argument("--bloom_fp", type = float, default = None, help = "build a k-mer Bloom filter with this false-positive rate next to each BWA index, used to skip aligning reads which cannot align")
+    parser.add_argument("--combined", action = "store_true", help = "also write a combined genus-tagged FASTA of all genera, to align all reads in a single pass")
     args = parser.parse_args()
 
     output_path = args.output_path
@@ -36,7 +41,7 @@ def main():
             continue
         species_name = species.replace(" ","_")
         genus = species_name.split("_")[0]
-        if os.path.exists(f"{bwa_path}/{genus}.fa.ann"):
+        if os.path.exists(f"{bwa_path}/{genus}.fa.ann") or len(glob.glob(f"{bwa_path}/{genus}.shard*.fa.ann")) > 0:
             continue
         genus2add.append(genus)
         bwa_FASTA_generator(species_name, output_path, bwa_path)
@@ -45,5 +50,25 @@ def main():
         f2.write(genus + "\n")
     f2.close()
 
+    #Split very large genera into shards of species
+    if args.shard_gb is not None:
+        for genus in np.unique(genus2add):
+            if os.path.getsize(f"{bwa_path}/{genus}.fa") > args.shard_gb * 1e9:
+                num_shards = shard_FASTA(bwa_path, genus, int(args.shard_gb * 1e9))
+                print(f"{genus} split into {num_shards} shards")
+
+    #Build k-mer Bloom filters used to prescreen reads before alignment
+    if args.bloom_fp is not None:
+        for genus in np.unique(genus2add):
+            build_bloom_filter(genus_indices(bwa_path, genus), bloom_file(bwa_path, genus), args.bloom_fp)
+
+    #Rewrite the combined FASTA whenever a genus is added, removing its outdated index
+    if args.combined and (len(genus2add) > 0 or not(os.path.exists(f"{bwa_path}/{COMBINED_INDEX}"))):
+        genera = [genus for genus in relevant_genus if os.path.exists(genus_indices(bwa_path, genus)[0])]
+        combined_FASTA_generator(bwa_path, genera)
+        for extension in ["amb", "ann", "bwt", "pac", "sa"]:
+            if os.path.exists(f"{bwa_path}/{COMBINED_INDEX}.{extension}"):
+                os.remove(f"{bwa_path}/{COMBINED_INDEX}.{extension}")
+
 if __name__ == '__main__':
     main()
@@ -1,9 +1,19 @@
 #!/usr/bin/env bash
 GENUS_NAMES=$1
 BWA_PATH=$2
+NUM_OF_THREADS=${3:-1}
 
 #Add sequences to library
 for genus in $(cut -f1 $BWA_PATH/genus2add.txt); do
-    bwa index $BWA_PATH/${genus}.fa
+    if [ -e "$BWA_PATH/${genus}.fa" ]; then
+        bwa index $BWA_PATH/${genus}.fa
+    else
+        #Index shards of large genera in parallel
+        ls $BWA_PATH/${genus}.shard*.fa | xargs -P $NUM_OF_THREADS -n 1 bwa index
+    fi
 done
 
+#Create combined index if its FASTA was written
+if [ -e "$BWA_PATH/combined/combined.fa" ] && [ ! -e "$BWA_PATH/combined/combined.fa.ann" ]; then
+    bwa index $BWA_PATH/combined/combined.fa
+fi
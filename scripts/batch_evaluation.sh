@@ -0,0 +1,38 @@
+#!/usr/bin/env bash
+KRAKEN_NAME=$1
+KRAKEN_PATH=$2
+MODE=$3
+SPECIALIZED_PATH=$4
+NUM_OF_THREADS=$5
+ASSEMBLY_SUMMARY=$6
+REPORT_PATH=$7
+SAMPLE_SHEET=$8
+OUTPUT_FORMAT=${9:-csv}
+
+#Create directory to store taxonomic predictions if not createed
+if [ ! -d "$REPORT_PATH" ]; then
+  mkdir -p "$REPORT_PATH"
+  echo "Directory created: $REPORT_PATH"
+fi
+
+if [ ! -e $ASSEMBLY_SUMMARY ]; then
+    wget "https://ftp.ncbi.nlm.nih.gov/genomes/refseq/bacteria/assembly_summary.txt" -O $ASSEMBLY_SUMMARY
+fi
+
+#Generate predictions with Kraken2 for every sample of the sheet
+while IFS=$'\t' read -r REPORT_NAME SEQUENCE_FILE KRAKEN_FILE; do
+    if [ -z "$REPORT_NAME" ]; then
+        continue
+    fi
+    if [ -z "$KRAKEN_FILE" ] && [ ! -e "${REPORT_PATH}/${REPORT_NAME}.kraken" ]; then
+        scripts/evaluation/kraken_evaluation.sh $KRAKEN_NAME $KRAKEN_PATH $NUM_OF_THREADS $REPORT_NAME $REPORT_PATH $SEQUENCE_FILE
+    fi
+done < $SAMPLE_SHEET
+
+if [ "$MODE" = "Kraken2_ML" ] || [ "$MODE" = "Kraken2_BWA" ]; then
+    echo "MODE is set to $MODE, classifying all samples genus by genus"
+    python "scripts/evaluation/batch_evaluation.py" $SPECIALIZED_PATH $REPORT_PATH $SAMPLE_SHEET $MODE $ASSEMBLY_SUMMARY --threads $NUM_OF_THREADS --output_format $OUTPUT_FORMAT
+else
+    echo "Batch evaluation supports the Kraken2_ML and Kraken2_BWA modes"
+    exit 1
+fi
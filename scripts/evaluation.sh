@@ -8,6 +8,14 @@ ASSEMBLY_SUMMARY=$6
 REPORT_NAME=$7
 REPORT_PATH=$8
 SEQUENCE_FILE=$9
+PREDICTION_CACHE=${10}
+BWA_ALIGNMENT=${11:-genus}
+BWA_PATH=${12}
+KRAKEN_SUPPORT=${13}
+KRAKEN_STREAM=${14}
+SHARDS=${15}
+CHECKPOINT=${16}
+OUTPUT_FORMAT=${17:-csv}
 
 echo $REPORT_PATH
 echo $SEQUENCE_FILE
@@ -39,14 +47,66 @@ if [ ! -e $ASSEMBLY_SUMMARY ]; then
     done
 fi
 
+#Optionally reuse predictions for reads seen in earlier samples
+CACHE_ARGS=""
+if [ -n "$PREDICTION_CACHE" ]; then
+    CACHE_ARGS="--prediction_cache $PREDICTION_CACHE"
+fi
+
+#Optionally keep Kraken2 species calls with strong k-mer support instead of reclassifying them
+SKIP_ARGS=""
+if [ -n "$KRAKEN_SUPPORT" ]; then
+    SKIP_ARGS="--kraken_support $KRAKEN_SUPPORT"
+fi
+
+#Skip aligning reads sharing no k-mer with their genus, wherever BWA_BLOOM_FP built a Bloom filter, in every mode aligning reads
+PRESCREEN_ARGS="--prescreen"
+
+#Optionally checkpoint each genus as it completes, so that a restarted run skips genera already classified
+CHECKPOINT_ARGS=""
+if [ "$CHECKPOINT" = "true" ]; then
+    CHECKPOINT_ARGS="--checkpoint"
+fi
+
+#Write per-read tables as CSV or as compact Parquet tables
+FORMAT_ARGS="--output_format $OUTPUT_FORMAT"
+
+#Pipe Kraken2's per-read output straight into a specialized classifier instead of writing and reloading it
+STREAM_KRAKEN=false
+run_specialized() {
+    if [ "$STREAM_KRAKEN" = true ]; then
+        kraken2 --db $KRAKEN_PATH/$KRAKEN_NAME --threads $NUM_OF_THREADS --report $REPORT_PATH/$REPORT_NAME.kreport2 $SEQUENCE_FILE | python "$@" --kraken - --assembly_summary $ASSEMBLY_SUMMARY
+    else
+        python "$@"
+    fi
+}
+
+#Split the sample into read shards evaluated by local worker processes, then merge them in original read order
+if [ -n "$SHARDS" ] && { [ "$MODE" = "Kraken2_ML" ] || [ "$MODE" = "Kraken2_BWA" ]; }; then
+    echo "MODE is set to $MODE, evaluating $SHARDS read shards"
+    if [ ! -e "${REPORT_PATH}/${REPORT_NAME}.kraken" ]; then
+        scripts/evaluation/kraken_evaluation.sh $KRAKEN_NAME $KRAKEN_PATH $NUM_OF_THREADS $REPORT_NAME $REPORT_PATH $SEQUENCE_FILE
+    fi
+    python "scripts/evaluation/shard_evaluation.py" run $SPECIALIZED_PATH $REPORT_NAME $REPORT_PATH $SEQUENCE_FILE $MODE $REPORT_PATH/$REPORT_NAME.kraken $ASSEMBLY_SUMMARY --shards $SHARDS --workers $NUM_OF_THREADS --alignment $BWA_ALIGNMENT $PRESCREEN_ARGS
+    exit 0
+fi
+
 #Generate predictions with Kraken2
-if [ -e "${REPORT_PATH}/${REPORT_NAME}_lineage_kraken.csv" ]; then
+if [ -e "${REPORT_PATH}/${REPORT_NAME}_lineage_kraken.csv" ] || [ -e "${REPORT_PATH}/${REPORT_NAME}_lineage_kraken.parquet" ]; then
     echo "Kraken Processed File Exist"
+elif [ "$KRAKEN_STREAM" = "true" ] && { [ "$MODE" = "Kraken2_ML" ] || [ "$MODE" = "Kraken2_BWA" ]; }; then
+    echo "Streaming Kraken2 output"
+    STREAM_KRAKEN=true
+#Run Kraken2, routing and specialized classification as concurrent stages
+elif [ "$KRAKEN_STREAM" = "pipeline" ] && { [ "$MODE" = "Kraken2_ML" ] || [ "$MODE" = "Kraken2_BWA" ]; }; then
+    echo "MODE is set to $MODE, classifying reads while Kraken2 runs"
+    python "scripts/evaluation/pipeline_evaluation.py" $SPECIALIZED_PATH $REPORT_NAME $REPORT_PATH $SEQUENCE_FILE $MODE $KRAKEN_PATH/$KRAKEN_NAME $ASSEMBLY_SUMMARY --threads $NUM_OF_THREADS $FORMAT_ARGS
+    exit 0
 else
     echo $SEQUENCE_FILE
     scripts/evaluation/kraken_evaluation.sh $KRAKEN_NAME $KRAKEN_PATH $NUM_OF_THREADS $REPORT_NAME $REPORT_PATH $SEQUENCE_FILE 
     #Get entire lineage of predictions
-    python "scripts/evaluation/kraken_evaluation.py" $ASSEMBLY_SUMMARY $REPORT_NAME $REPORT_PATH 
+    python "scripts/evaluation/kraken_evaluation.py" $ASSEMBLY_SUMMARY $REPORT_NAME $REPORT_PATH $FORMAT_ARGS
 fi
 
 if [ "$MODE" = "Kraken2" ]; then
@@ -55,11 +115,30 @@ if [ "$MODE" = "Kraken2" ]; then
 #Ensemble Kraken2's output with ML classifiers
 elif [ "$MODE" = "Kraken2_ML" ]; then
     echo "MODE is set to Kraken2_ML"
-    python "scripts/evaluation/fasttext_evaluation.py" $SPECIALIZED_PATH $REPORT_NAME $REPORT_PATH $SEQUENCE_FILE
+    run_specialized "scripts/evaluation/fasttext_evaluation.py" $SPECIALIZED_PATH $REPORT_NAME $REPORT_PATH $SEQUENCE_FILE $MODE --threads $NUM_OF_THREADS --stream $CACHE_ARGS $SKIP_ARGS $CHECKPOINT_ARGS $FORMAT_ARGS
+
+#Ensemble Kraken2's output with ML classifiers, aligning low-confidence reads with BWA
+elif [ "$MODE" = "Kraken2_ML_BWA" ]; then
+    echo "MODE is set to Kraken2_ML_BWA"
+    python "scripts/evaluation/cascade_evaluation.py" $SPECIALIZED_PATH $BWA_PATH $REPORT_NAME $REPORT_PATH $SEQUENCE_FILE $MODE --threads $NUM_OF_THREADS --alignment $BWA_ALIGNMENT $PRESCREEN_ARGS --stream $CACHE_ARGS $SKIP_ARGS
+
+#Ensemble Kraken2's output with the classifier planned for each genus from its read count and model or index size
+elif [ "$MODE" = "Kraken2_AUTO" ]; then
+    echo "MODE is set to Kraken2_AUTO"
+    python "scripts/evaluation/plan_evaluation.py" $SPECIALIZED_PATH $BWA_PATH $REPORT_NAME $REPORT_PATH $SEQUENCE_FILE $MODE --threads $NUM_OF_THREADS --alignment $BWA_ALIGNMENT $PRESCREEN_ARGS --stream $CACHE_ARGS $SKIP_ARGS
+
+#Ensemble Kraken2's output with both ML classifiers and BWA from a single pass over the reads, comparing their calls
+elif [ "$MODE" = "Kraken2_BOTH" ]; then
+    echo "MODE is set to Kraken2_BOTH"
+    python "scripts/evaluation/both_evaluation.py" $SPECIALIZED_PATH $BWA_PATH $REPORT_NAME $REPORT_PATH $SEQUENCE_FILE $MODE --threads $NUM_OF_THREADS $PRESCREEN_ARGS $FORMAT_ARGS
+
+elif [ "$MODE" = "Kraken2_KMER" ]; then
+    echo "MODE is set to Kraken2_KMER"
+    python "scripts/evaluation/kmer_evaluation.py" $SPECIALIZED_PATH $REPORT_NAME $REPORT_PATH $SEQUENCE_FILE $MODE
 
 else
     echo "MODE is set to Kraken2_BWA"
-    python "scripts/evaluation/bwa_evaluation.py" $SPECIALIZED_PATH $REPORT_NAME $REPORT_PATH $SEQUENCE_FILE $MODE
+    run_specialized "scripts/evaluation/bwa_evaluation.py" $SPECIALIZED_PATH $REPORT_NAME $REPORT_PATH $SEQUENCE_FILE $MODE --threads $NUM_OF_THREADS --alignment $BWA_ALIGNMENT $PRESCREEN_ARGS --stream $CACHE_ARGS $SKIP_ARGS $CHECKPOINT_ARGS $FORMAT_ARGS
 fi
 
 
@@ -0,0 +1,74 @@
+import argparse
+
+from ete3 import NCBITaxa
+
+from HiTaxon.batch_utils import SampleStores, route_samples, batch_classify, split_samples
+from HiTaxon.evaluation_utils import ensemble
+from HiTaxon.kraken_utils import LineageTable, ingest_kraken, load_reference_assembly
+from HiTaxon.pipeline_utils import pipeline_predictions, trained_genera
+from HiTaxon.prediction_utils import prediction_scores
+from HiTaxon.sequence_utils import build_read_store, read_store_exists
+from HiTaxon.table_utils import TABLE_FORMATS, output_file, write_table
+
+"""
+Generate Ensemble Predictions for a batch of samples, classifying the reads of every sample genus by genus
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("specialized_path", type = str, help = "path in which models or BWA indices are stored")
+    parser.add_argument("report_path", type = str, help = "path to store classifer output")
+    parser.add_argument("sample_sheet", type = str, help = "tab-separated file of report names and FASTA files, with an optional third column giving the Kraken2 per-read output ({report_path}/{report_name}.kraken by default)")
+    parser.add_argument("mode", type = str, choices = ["Kraken2_ML", "Kraken2_BWA"], help = "The ensemble mode")
+    parser.add_argument("assembly_summary", type = str, help = "file path to assembly summary")
+    parser.add_argument("--threads", type = int, default = 1, help = "number of threads used by BWA")
+    parser.add_argument("--backend", type = str, default = "fasttext", choices = ["fasttext", "numpy"], help = "inference backend used to classify reads")
+    parser.add_argument("--no_dedup", action = "store_true", help = "classify every read, including exact duplicates of reads already classified in any sample")
+    parser.add_argument("--lineage_table", type = str, default = None, help = "precompiled taxid to lineage table kept between batches ({report_path}/lineage_table.npz by default)")
+    parser.add_argument("--output_format", type = str, default = "csv", choices = TABLE_FORMATS, help = "format of per-read tables, parquet storing taxa as dictionary-encoded categoricals (needs pyarrow)")
+    args = parser.parse_args()
+
+    report_path = args.report_path
+    classifier = "ML" if args.mode == "Kraken2_ML" else "BWA"
+    output = "ml" if classifier == "ML" else "bwa"
+
+    #Samples to analyze, with structure [(report name, FASTA file, Kraken2 output)...]
+    samples = []
+    for line in open(args.sample_sheet).read().splitlines():
+        if line.strip() != "":
+            fields = line.split("\t")
+            samples.append((fields[0], fields[1], fields[2] if len(fields) > 2 else f"{report_path}/{fields[0]}.kraken"))
+
+    #Taxonomy is loaded once and each taxid expanded once for the whole batch
+    ncbi = NCBITaxa()
+    reference_assembly = load_reference_assembly(args.assembly_summary)
+    table = LineageTable(args.lineage_table if args.lineage_table is not None else f"{report_path}/lineage_table.npz")
+    samples_calls = []
+    read_stores = []
+    for report_name, sequence_file, kraken_file in samples:
+        kraken_calls = ingest_kraken(kraken_file, table, ncbi, reference_assembly)
+        kraken_calls.write_lineage(output_file(report_path, report_name, "lineage_kraken", args.output_format))
+        samples_calls.append(kraken_calls)
+        read_store = f"{report_path}/{report_name}_reads"
+        if not(read_store_exists(read_store)):
+            build_read_store(sequence_file, read_store)
+        read_stores.append(read_store)
+    stores = SampleStores(read_stores)
+    for (report_name, sequence_file, kraken_file), kraken_calls, store in zip(samples, samples_calls, stores.stores):
+        if len(kraken_calls) != len(store):
+            raise ValueError(f"{kraken_file} has {len(kraken_calls)} reads but {sequence_file} has {len(store)}")
+
+    #Load each model or index once, classifying the reads routed to it from every sample, and release it before loading the next
+    genera = trained_genera(classifier, args.specialized_path)
+    genus_positions = route_samples(samples_calls, genera, stores.offsets[:-1])
+    preds = batch_classify(classifier, args.specialized_path, genus_positions, stores, None, args.backend, num_threads = args.threads, dedup = not(args.no_dedup))
+    for (report_name, sequence_file, kraken_file), kraken_calls, sample_preds in zip(samples, samples_calls, split_samples(preds, stores.offsets)):
+        model_output = pipeline_predictions(kraken_calls, sample_preds, genera)
+        write_table(model_output, output_file(report_path, report_name, output, args.output_format), prediction_scores(sample_preds, len(kraken_calls)) if classifier == "ML" else None)
+        #Ensemble specialized predictions with Kraken2
+        ensemble_output = ensemble(report_path, report_name, args.mode, kraken_calls)
+        write_table(ensemble_output, output_file(report_path, report_name, f"ensemble_{output}", args.output_format))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+import argparse
+
+from HiTaxon.compare_utils import evaluation_both, agreement_table, report_agreement
+from HiTaxon.evaluation_utils import ensemble
+from HiTaxon.prediction_utils import ModelCache
+from HiTaxon.sequence_utils import build_read_store, read_store_exists
+from HiTaxon.table_utils import TABLE_FORMATS, output_file, write_table
+
+"""
+Generate Ensemble Predictions with both ML classifiers and BWA in a single pass, and compare them
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_path", type = str, help = "path in which models are stored")
+    parser.add_argument("bwa_path", type = str, help = "path in which BWA indices are stored")
+    parser.add_argument("report_name", type = str, help = "file name of output")
+    parser.add_argument("report_path", type = str, help = "path to store classifer output")
+    parser.add_argument("sequence_file", type = str, help = "file path of FASTA file to analyze")
+    parser.add_argument("mode", type = str, help = "The ensemble mode")
+    parser.add_argument("--threads", type = int, default = 1, help = "number of threads split between ML workers and BWA alignments, which run at the same time")
+    parser.add_argument("--ml_threads", type = int, default = None, help = "number of --threads given to ML workers, the others being shared by BWA alignments (half of --threads by default)")
+    parser.add_argument("--backend", type = str, default = "fasttext", choices = ["fasttext", "numpy"], help = "inference backend used to classify reads")
+    parser.add_argument("--model_cache_gb", type = float, default = None, help = "memory budget in GB for models kept loaded when ML runs in-process with --ml_threads 1 (worker processes load the model of their genus themselves)")
+    parser.add_argument("--prescreen", action = "store_true", help = "skip aligning reads with too few k-mers in the Bloom filter of their genus, where a filter was built")
+    parser.add_argument("--min_kmer_hits", type = int, default = 1, help = "minimum number of k-mers found in the Bloom filter for a read to be aligned")
+    parser.add_argument("--no_dedup", action = "store_true", help = "classify every read, including exact duplicates of reads already classified")
+    parser.add_argument("--output_format", type = str, default = "csv", choices = TABLE_FORMATS, help = "format of per-read tables, parquet storing taxa as dictionary-encoded categoricals (needs pyarrow)")
+    args = parser.parse_args()
+
+    report_path = args.report_path
+    report_name = args.report_name
+    #Pack FASTA file to be analyzed into a read store shared by both classifiers
+    read_store = f"{report_path}/{report_name}_reads"
+    if not(read_store_exists(read_store)):
+        build_read_store(args.sequence_file, read_store)
+    #Bound the models kept loaded by ML running in-process, so that they do not all stay resident during the BWA alignments
+    model_cache = ModelCache(None if args.model_cache_gb is None else int(args.model_cache_gb * 1e9), args.backend)
+    #ML and BWA run at the same time, so the thread budget is split between them
+    ml_threads = max(1, args.threads // 2) if args.ml_threads is None else args.ml_threads
+    bwa_threads = max(1, args.threads - ml_threads)
+    ml_output, bwa_output, ml_scores = evaluation_both(report_path, report_name, args.model_path, args.bwa_path, read_store, 0.5, ml_threads, bwa_threads, model_cache, args.backend, not(args.no_dedup), args.prescreen, args.min_kmer_hits)
+    write_table(ml_output, output_file(report_path, report_name, "ml", args.output_format), ml_scores)
+    write_table(bwa_output, output_file(report_path, report_name, "bwa", args.output_format))
+    #Ensemble each classifier's predictions with Kraken2
+    ml_ensemble = ensemble(report_path, report_name, "Kraken2_ML")
+    write_table(ml_ensemble, output_file(report_path, report_name, "ensemble_ml", args.output_format))
+    bwa_ensemble = ensemble(report_path, report_name, "Kraken2_BWA")
+    write_table(bwa_ensemble, output_file(report_path, report_name, "ensemble_bwa", args.output_format))
+    agreement = agreement_table(ml_ensemble, bwa_ensemble, ml_output, bwa_output, ml_scores)
+    write_table(agreement, output_file(report_path, report_name, "agreement", args.output_format))
+    report_agreement(agreement)
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,16 @@
 import argparse
+import numpy as np
 import pandas as pd
 import os
 
 from ete3 import NCBITaxa
 
-from HiTaxon.evaluation_utils import fasta2bwa, evaluation_bwa, ensemble
+from HiTaxon.evaluation_utils import fasta2bwa, evaluation_bwa, ensemble, confident_species_calls
+from HiTaxon.sequence_utils import build_read_store, read_store_exists
+from HiTaxon.cache_utils import PredictionCache, GenusCheckpoints
+from HiTaxon.kraken_utils import LineageTable, ingest_kraken, load_reference_assembly
+from HiTaxon.align_utils import IndexResidency
+from HiTaxon.table_utils import TABLE_FORMATS, output_file, write_table
 
 """
 Generate Ensemble Predictions
@@ -18,6 +24,22 @@ def main():
     parser.add_argument("report_path", type = str, help = "path to store classifer output")
     parser.add_argument("sequence_file", type = str, help = "file path of FASTA file to analyze")
     parser.add_argument("mode", type = str, help = "The ensemble mode")
+    parser.add_argument("--threads", type = int, default = 1, help = "number of threads shared by BWA alignments")
+    parser.add_argument("--max_memory_gb", type = float, default = None, help = "memory budget in GB for BWA indices loaded at the same time")
+    parser.add_argument("--shm_gb", type = float, default = None, help = "memory budget in GB for BWA indices kept staged in shared memory between samples (bwa shm)")
+    parser.add_argument("--alignment", type = str, default = "genus", choices = ["genus", "combined", "compare"], help = "align reads against the index of their genus, against the combined genus-tagged index in a single pass, or both to compare them")
+    parser.add_argument("--prescreen", action = "store_true", help = "skip aligning reads with too few k-mers in the Bloom filter of their genus, where a filter was built")
+    parser.add_argument("--min_kmer_hits", type = int, default = 1, help = "minimum number of k-mers found in the Bloom filter for a read to be aligned")
+    parser.add_argument("--stream", action = "store_true", help = "pack reads into a read store and fetch them by position instead of writing a renamed copy")
+    parser.add_argument("--no_dedup", action = "store_true", help = "align every read, including exact duplicates of reads already aligned")
+    parser.add_argument("--kraken_support", type = float, default = None, help = "skip specialized classification of reads whose Kraken2 species call is supported by at least this fraction of their k-mers")
+    parser.add_argument("--kraken", type = str, default = None, help = "Kraken2 per-read output to ingest in chunks, or - to read it from standard input while Kraken2 runs, instead of loading {report_name}_lineage_kraken.csv")
+    parser.add_argument("--assembly_summary", type = str, default = None, help = "file path to assembly summary, needed with --kraken")
+    parser.add_argument("--lineage_table", type = str, default = None, help = "precompiled taxid to lineage table kept between samples ({report_path}/lineage_table.npz by default)")
+    parser.add_argument("--checkpoint", action = "store_true", help = "save the predictions of each genus as it completes in {report_path}/{report_name}_bwa_checkpoints, so that a restarted run skips genera already classified")
+    parser.add_argument("--prediction_cache", type = str, default = None, help = "SQLite file in which predictions are kept between samples, invalidated when a model or index changes")
+    parser.add_argument("--prediction_cache_entries", type = int, default = 50000000, help = "maximum number of predictions kept in the prediction cache")
+    parser.add_argument("--output_format", type = str, default = "csv", choices = TABLE_FORMATS, help = "format of per-read tables, parquet storing taxa as dictionary-encoded categoricals (needs pyarrow)")
     args = parser.parse_args()
 
     report_path = args.report_path
@@ -25,17 +47,52 @@ def main():
     sequence_file = args.sequence_file
     specialized_path = args.specialized_path
     mode = args.mode
+    stream = args.stream
+    num_of_threads = args.threads
+    max_memory = None if args.max_memory_gb is None else int(args.max_memory_gb * 1e9)
+    #Keep frequently used indices in shared memory so that later samples do not reload them
+    residency = None if args.shm_gb is None else IndexResidency(specialized_path, int(args.shm_gb * 1e9))
+    dedup = not(args.no_dedup)
+    #Reuse predictions for reads seen in earlier samples
+    prediction_cache = None if args.prediction_cache is None else PredictionCache(args.prediction_cache, args.prediction_cache_entries)
      
     ncbi = NCBITaxa()
-    #K-merize FASTA file to be analyzed
-    if not(os.path.exists("{report_path}/{report_name}_bwa.fa")):
-        fasta2bwa(sequence_file, report_path, report_name)
-    #Generate predictions using ML classifiers
-    bwa_output = evaluation_bwa(report_path, report_name, specialized_path)
-    bwa_output.to_csv(f"{report_path}/{report_name}_bwa.csv")
+    #Map Kraken2's calls to lineage codes as they are read, keeping the lineage CSV as a Kraken2 report
+    kraken_calls = None
+    if args.kraken is not None:
+        table = LineageTable(args.lineage_table if args.lineage_table is not None else f"{report_path}/lineage_table.npz")
+        kraken_calls = ingest_kraken(args.kraken, table, ncbi, load_reference_assembly(args.assembly_summary), support = args.kraken_support is not None)
+        kraken_calls.write_lineage(output_file(report_path, report_name, "lineage_kraken", args.output_format))
+    #Keep Kraken2 species calls with strong k-mer support
+    subset = None if args.kraken_support is None else np.flatnonzero(~confident_species_calls(report_path, report_name, args.kraken_support, ncbi, kraken_calls))
+    #Resume genera aligned before an interruption
+    checkpoints = GenusCheckpoints(f"{report_path}/{report_name}_bwa_checkpoints") if args.checkpoint else None
+    if stream:
+        #Pack FASTA file to be analyzed into a read store shared by all evaluation stages
+        read_store = f"{report_path}/{report_name}_reads"
+        if not(read_store_exists(read_store)):
+            build_read_store(sequence_file, read_store)
+        #Generate predictions using BWA, fetching reads from the read store
+        bwa_output = evaluation_bwa(report_path, report_name, specialized_path, read_store, dedup = dedup, prediction_cache = prediction_cache, num_threads = num_of_threads, max_memory = max_memory, residency = residency, alignment = args.alignment, prescreen = args.prescreen, min_kmer_hits = args.min_kmer_hits, subset = subset, kraken_calls = kraken_calls, checkpoints = checkpoints)
+    else:
+        #K-merize FASTA file to be analyzed
+        if not(os.path.exists("{report_path}/{report_name}_bwa.fa")):
+            fasta2bwa(sequence_file, report_path, report_name)
+        #Generate predictions using ML classifiers
+        bwa_output = evaluation_bwa(report_path, report_name, specialized_path, dedup = dedup, prediction_cache = prediction_cache, num_threads = num_of_threads, max_memory = max_memory, residency = residency, alignment = args.alignment, prescreen = args.prescreen, min_kmer_hits = args.min_kmer_hits, subset = subset, kraken_calls = kraken_calls, checkpoints = checkpoints)
+    write_table(bwa_output, output_file(report_path, report_name, "bwa", args.output_format))
     #Ensemble ML predictions with Kraken2
-    ensemble_output = ensemble(report_path, report_name, mode)
-    ensemble_output.to_csv(f"{report_path}/{report_name}_ensemble_bwa.csv")
+    ensemble_output = ensemble(report_path, report_name, mode, kraken_calls)
+    write_table(ensemble_output, output_file(report_path, report_name, "ensemble_bwa", args.output_format))
+    if prediction_cache is not None:
+        prediction_cache.report()
+    if residency is not None:
+        residency.report()
+        residency.release()
+    if checkpoints is not None:
+        checkpoints.report()
+        #Outputs are written, so checkpoints are no longer needed
+        checkpoints.clear()
 
 if __name__ == "__main__":
     main()
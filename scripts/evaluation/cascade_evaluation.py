@@ -0,0 +1,83 @@
+import argparse
+import numpy as np
+import pandas as pd
+import os
+
+from ete3 import NCBITaxa
+from HiTaxon.evaluation_utils import fasta2kmer, fasta2bwa, evaluation_cascade, ensemble, confident_species_calls
+from HiTaxon.prediction_utils import ModelCache
+from HiTaxon.sequence_utils import build_read_store, read_store_exists
+from HiTaxon.cache_utils import PredictionCache
+from HiTaxon.align_utils import IndexResidency
+
+"""
+Generate Ensemble Predictions
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_path", type = str, help = "path in which models are stored")
+    parser.add_argument("bwa_path", type = str, help = "path in which bwa indices are stored")
+    parser.add_argument("report_name", type = str, help = "file name of output")
+    parser.add_argument("report_path", type = str, help = "path to store classifer output")
+    parser.add_argument("sequence_file", type = str, help = "file path of FASTA file to analyze")
+    parser.add_argument("mode", type = str, help = "The ensemble mode")
+    parser.add_argument("--min_threshold", type = float, default = 0.5, help = "minimum softmax score needed to use ML prediction, reads below it being aligned with BWA")
+    parser.add_argument("--threads", type = int, default = 1, help = "number of genera classified at the same time and of threads shared by BWA alignments")
+    parser.add_argument("--stream", action = "store_true", help = "pack reads into a read store and fetch them by position instead of writing k-merized and renamed copies")
+    parser.add_argument("--backend", type = str, default = "fasttext", choices = ["fasttext", "numpy"], help = "inference backend used to classify reads")
+    parser.add_argument("--model_cache_gb", type = float, default = None, help = "memory budget in GB for models kept loaded")
+    parser.add_argument("--max_memory_gb", type = float, default = None, help = "memory budget in GB for BWA indices loaded at the same time")
+    parser.add_argument("--shm_gb", type = float, default = None, help = "memory budget in GB for BWA indices kept staged in shared memory between samples (bwa shm)")
+    parser.add_argument("--alignment", type = str, default = "genus", choices = ["genus", "combined", "compare"], help = "align reads against the index of their genus, against the combined genus-tagged index in a single pass, or both to compare them")
+    parser.add_argument("--prescreen", action = "store_true", help = "skip aligning reads with too few k-mers in the Bloom filter of their genus, where a filter was built")
+    parser.add_argument("--min_kmer_hits", type = int, default = 1, help = "minimum number of k-mers found in the Bloom filter for a read to be aligned")
+    parser.add_argument("--no_dedup", action = "store_true", help = "classify every read, including exact duplicates of reads already classified")
+    parser.add_argument("--kraken_support", type = float, default = None, help = "skip specialized classification of reads whose Kraken2 species call is supported by at least this fraction of their k-mers")
+    parser.add_argument("--prediction_cache", type = str, default = None, help = "SQLite file in which predictions are kept between samples, invalidated when a model or index changes")
+    parser.add_argument("--prediction_cache_entries", type = int, default = 50000000, help = "maximum number of predictions kept in the prediction cache")
+    args = parser.parse_args()
+
+    report_path = args.report_path
+    report_name = args.report_name
+    sequence_file = args.sequence_file
+    mode = args.mode
+    num_of_threads = args.threads
+    dedup = not(args.no_dedup)
+    model_cache = ModelCache(None if args.model_cache_gb is None else int(args.model_cache_gb * 1e9), args.backend)
+    max_memory = None if args.max_memory_gb is None else int(args.max_memory_gb * 1e9)
+    #Keep frequently used indices in shared memory so that later samples do not reload them
+    residency = None if args.shm_gb is None else IndexResidency(args.bwa_path, int(args.shm_gb * 1e9))
+    #Reuse predictions for reads seen in earlier samples
+    prediction_cache = None if args.prediction_cache is None else PredictionCache(args.prediction_cache, args.prediction_cache_entries)
+
+    #Keep Kraken2 species calls with strong k-mer support
+    subset = None if args.kraken_support is None else np.flatnonzero(~confident_species_calls(report_path, report_name, args.kraken_support, NCBITaxa()))
+    read_store = None
+    if args.stream:
+        #Pack FASTA file to be analyzed into a read store shared by all evaluation stages
+        read_store = f"{report_path}/{report_name}_reads"
+        if not(read_store_exists(read_store)):
+            build_read_store(sequence_file, read_store)
+    else:
+        #K-merize FASTA file for ML classifiers and rename it for BWA
+        if not(os.path.exists(f"{report_path}/{report_name}_kmer.txt")):
+            fasta2kmer(sequence_file, report_path, report_name)
+        if not(os.path.exists(f"{report_path}/{report_name}_bwa.fa")):
+            fasta2bwa(sequence_file, report_path, report_name)
+    #Generate predictions using ML classifiers, aligning low-confidence reads with BWA
+    cascade_output = evaluation_cascade(report_path, report_name, args.model_path, args.bwa_path, args.min_threshold, num_of_threads, read_store = read_store, model_cache = model_cache, backend = args.backend, dedup = dedup, prediction_cache = prediction_cache, num_threads = num_of_threads, max_memory = max_memory, residency = residency, alignment = args.alignment, prescreen = args.prescreen, min_kmer_hits = args.min_kmer_hits, subset = subset, sequence_file = sequence_file)
+    cascade_output.to_csv(f"{report_path}/{report_name}_ml_bwa.csv")
+    #Ensemble cascade predictions with Kraken2
+    ensemble_output = ensemble(report_path, report_name, mode)
+    ensemble_output.to_csv(f"{report_path}/{report_name}_ensemble_ml_bwa.csv")
+    model_cache.report()
+    if prediction_cache is not None:
+        prediction_cache.report()
+    if residency is not None:
+        residency.report()
+        residency.release()
+
+if __name__ == "__main__":
+    main()
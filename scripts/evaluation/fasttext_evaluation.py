@@ -1,10 +1,16 @@
 import argparse
+import numpy as np
 import pandas as pd
 import os
 
 from ete3 import NCBITaxa
 
-from HiTaxon.evaluation_utils import fasta2kmer, evaluation, ensemble
+from HiTaxon.evaluation_utils import fasta2kmer, evaluation, ensemble, confident_species_calls
+from HiTaxon.prediction_utils import ModelCache
+from HiTaxon.sequence_utils import build_read_store, read_store_exists
+from HiTaxon.cache_utils import PredictionCache, GenusCheckpoints
+from HiTaxon.kraken_utils import LineageTable, ingest_kraken, load_reference_assembly
+from HiTaxon.table_utils import TABLE_FORMATS, output_file, write_table
 
 """
 Generate Ensemble Predictions
@@ -18,6 +24,19 @@ def main():
     parser.add_argument("report_path", type = str, help = "path to store classifer output")
     parser.add_argument("sequence_file", type = str, help = "file path of FASTA file to analyze")
     parser.add_argument("mode", type = str, help = "The ensemble mode")
+    parser.add_argument("--threads", type = int, default = 1, help = "number of genera classified at the same time")
+    parser.add_argument("--stream", action = "store_true", help = "pack reads into a read store and k-merize them one batch at a time instead of writing a k-merized copy")
+    parser.add_argument("--backend", type = str, default = "fasttext", choices = ["fasttext", "numpy"], help = "inference backend used to classify reads")
+    parser.add_argument("--model_cache_gb", type = float, default = None, help = "memory budget in GB for models loaded before worker processes start and shared with them (by default each model is loaded when used and released after); use batch_evaluation.py to keep models loaded across samples")
+    parser.add_argument("--no_dedup", action = "store_true", help = "classify every read, including exact duplicates of reads already classified")
+    parser.add_argument("--kraken_support", type = float, default = None, help = "skip specialized classification of reads whose Kraken2 species call is supported by at least this fraction of their k-mers")
+    parser.add_argument("--kraken", type = str, default = None, help = "Kraken2 per-read output to ingest in chunks, or - to read it from standard input while Kraken2 runs, instead of loading {report_name}_lineage_kraken.csv")
+    parser.add_argument("--assembly_summary", type = str, default = None, help = "file path to assembly summary, needed with --kraken")
+    parser.add_argument("--lineage_table", type = str, default = None, help = "precompiled taxid to lineage table kept between samples ({report_path}/lineage_table.npz by default)")
+    parser.add_argument("--checkpoint", action = "store_true", help = "save the predictions of each genus as it completes in {report_path}/{report_name}_ml_checkpoints, so that a restarted run skips genera already classified")
+    parser.add_argument("--prediction_cache", type = str, default = None, help = "SQLite file in which predictions are kept between samples, invalidated when a model or index changes")
+    parser.add_argument("--prediction_cache_entries", type = int, default = 50000000, help = "maximum number of predictions kept in the prediction cache")
+    parser.add_argument("--output_format", type = str, default = "csv", choices = TABLE_FORMATS, help = "format of per-read tables, parquet storing taxa as dictionary-encoded categoricals (needs pyarrow)")
     args = parser.parse_args()
 
     report_path = args.report_path
@@ -25,17 +44,51 @@ def main():
     sequence_file = args.sequence_file
     model_path = args.model_path
     mode = args.mode
+    num_of_threads = args.threads
+    stream = args.stream
+    backend = args.backend
+    dedup = not(args.no_dedup)
+    #Reuse predictions for reads seen in earlier samples
+    prediction_cache = None if args.prediction_cache is None else PredictionCache(args.prediction_cache, args.prediction_cache_entries)
+    #Models fitting within the budget are loaded once and shared with worker processes
+    max_bytes = None if args.model_cache_gb is None else int(args.model_cache_gb * 1e9)
+    model_cache = ModelCache(max_bytes, backend)
 
     ncbi = NCBITaxa()
-    #K-merize FASTA file to be analyzed
-    if not(os.path.exists("{report_path}/{report_name}_kmer.txt")):
-        fasta2kmer(sequence_file, report_path, report_name)
-    #Generate predictions using ML classifiers
-    ml_output = evaluation(report_path, report_name, model_path, 0.5)
-    ml_output.to_csv(f"{report_path}/{report_name}_ml.csv")
+    #Map Kraken2's calls to lineage codes as they are read, keeping the lineage CSV as a Kraken2 report
+    kraken_calls = None
+    if args.kraken is not None:
+        table = LineageTable(args.lineage_table if args.lineage_table is not None else f"{report_path}/lineage_table.npz")
+        kraken_calls = ingest_kraken(args.kraken, table, ncbi, load_reference_assembly(args.assembly_summary), support = args.kraken_support is not None)
+        kraken_calls.write_lineage(output_file(report_path, report_name, "lineage_kraken", args.output_format))
+    #Keep Kraken2 species calls with strong k-mer support
+    subset = None if args.kraken_support is None else np.flatnonzero(~confident_species_calls(report_path, report_name, args.kraken_support, ncbi, kraken_calls))
+    #Resume genera classified before an interruption
+    checkpoints = GenusCheckpoints(f"{report_path}/{report_name}_ml_checkpoints") if args.checkpoint else None
+    if stream:
+        #Pack FASTA file to be analyzed into a read store shared by all evaluation stages
+        read_store = f"{report_path}/{report_name}_reads"
+        if not(read_store_exists(read_store)):
+            build_read_store(sequence_file, read_store)
+        #Generate predictions using ML classifiers, k-merizing reads as they are classified
+        ml_output, scores = evaluation(report_path, report_name, model_path, 0.5, num_of_threads, read_store = read_store, model_cache = model_cache, backend = backend, dedup = dedup, prediction_cache = prediction_cache, subset = subset, kraken_calls = kraken_calls, checkpoints = checkpoints, return_scores = True)
+    else:
+        #K-merize FASTA file to be analyzed
+        if not(os.path.exists("{report_path}/{report_name}_kmer.txt")):
+            fasta2kmer(sequence_file, report_path, report_name)
+        #Generate predictions using ML classifiers
+        ml_output, scores = evaluation(report_path, report_name, model_path, 0.5, num_of_threads, model_cache = model_cache, backend = backend, dedup = dedup, prediction_cache = prediction_cache, subset = subset, kraken_calls = kraken_calls, checkpoints = checkpoints, return_scores = True, sequence_file = sequence_file)
+    write_table(ml_output, output_file(report_path, report_name, "ml", args.output_format), scores)
     #Ensemble ML predictions with Kraken2
-    ensemble_output = ensemble(report_path, report_name, mode)
-    ensemble_output.to_csv(f"{report_path}/{report_name}_ensemble_ml.csv")
+    ensemble_output = ensemble(report_path, report_name, mode, kraken_calls)
+    write_table(ensemble_output, output_file(report_path, report_name, "ensemble_ml", args.output_format))
+    model_cache.report()
+    if prediction_cache is not None:
+        prediction_cache.report()
+    if checkpoints is not None:
+        checkpoints.report()
+        #Outputs are written, so checkpoints are no longer needed
+        checkpoints.clear()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,43 @@
+import argparse
+import pandas as pd
+import os
+
+from HiTaxon.evaluation_utils import evaluation_kmer, ensemble
+from HiTaxon.sequence_utils import build_read_store, read_store_exists
+
+"""
+Generate Ensemble Predictions
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("specialized_path", type = str, help = "path in which k-mer tables are stored")
+    parser.add_argument("report_name", type = str, help = "file name of output")
+    parser.add_argument("report_path", type = str, help = "path to store classifer output")
+    parser.add_argument("sequence_file", type = str, help = "file path of FASTA file to analyze")
+    parser.add_argument("mode", type = str, help = "The ensemble mode")
+    parser.add_argument("--min_hits", type = int, default = 1, help = "minimum number of k-mers supporting a species for it to be assigned")
+    parser.add_argument("--no_dedup", action = "store_true", help = "classify every read, including exact duplicates of reads already classified")
+    args = parser.parse_args()
+
+    report_path = args.report_path
+    report_name = args.report_name
+    sequence_file = args.sequence_file
+    specialized_path = args.specialized_path
+    mode = args.mode
+    dedup = not(args.no_dedup)
+
+    #Pack FASTA file to be analyzed into a read store shared by all evaluation stages
+    read_store = f"{report_path}/{report_name}_reads"
+    if not(read_store_exists(read_store)):
+        build_read_store(sequence_file, read_store)
+    #Generate predictions by looking up read k-mers in k-mer tables
+    kmer_output = evaluation_kmer(report_path, report_name, specialized_path, read_store, min_hits = args.min_hits, dedup = dedup)
+    kmer_output.to_csv(f"{report_path}/{report_name}_kmer.csv")
+    #Ensemble k-mer predictions with Kraken2
+    ensemble_output = ensemble(report_path, report_name, mode)
+    ensemble_output.to_csv(f"{report_path}/{report_name}_ensemble_kmer.csv")
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,8 @@ import pandas as pd
 
 from ete3 import NCBITaxa
 from HiTaxon.evaluation_utils import expand_lineage, expand_predictions
+from HiTaxon.kraken_utils import load_reference_assembly
+from HiTaxon.table_utils import TABLE_FORMATS, output_file, write_table
 
 """
 Reformat Kraken2's prediction to include entire lineage
@@ -14,6 +16,7 @@ def main():
     parser.add_argument("assembly_summary", type = str, help = "file path to assembly summary")
     parser.add_argument("report_name", type = str, help = "file name of output")
     parser.add_argument("report_path", type = str, help = "path to store classifier output")
+    parser.add_argument("--output_format", type = str, default = "csv", choices = TABLE_FORMATS, help = "format of per-read tables, parquet storing taxa as dictionary-encoded categoricals (needs pyarrow)")
     args = parser.parse_args()
 
     ncbi = NCBITaxa()
@@ -22,13 +25,11 @@ def main():
     report_path = args.report_path
     predictions = report_path + "/" + report_name + ".kraken"
     
-    refseq = pd.read_csv(assembly_summary, delimiter = "\t", skiprows = 1)
-    refseq = refseq[["#assembly_accession", "refseq_category", "species_taxid", "organism_name", "infraspecific_name", "assembly_level", "genome_rep"]]
-    refseq["species"] = refseq["organism_name"].apply(lambda x: " ".join(x.replace("_"," ").split(" ")[:2]))
+    refseq = load_reference_assembly(assembly_summary)
 
     #Convert taxids to names, alongside expanding lineage
     kraken_predictions = expand_predictions(predictions, ncbi, refseq)
-    kraken_predictions.to_csv(f"{report_path}/{report_name}_lineage_kraken.csv")
+    write_table(kraken_predictions, output_file(report_path, report_name, "lineage_kraken", args.output_format))
 
 
 
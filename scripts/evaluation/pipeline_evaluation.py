@@ -0,0 +1,68 @@
+import argparse
+import asyncio
+import json
+
+from ete3 import NCBITaxa
+
+from HiTaxon.align_utils import IndexResidency
+from HiTaxon.evaluation_utils import ensemble
+from HiTaxon.kraken_utils import LineageTable, load_reference_assembly
+from HiTaxon.pipeline_utils import pipeline, pipeline_predictions, report_pipeline, trained_genera
+from HiTaxon.prediction_utils import ModelCache, prediction_scores
+from HiTaxon.table_utils import TABLE_FORMATS, output_file, write_table
+
+"""
+Generate Ensemble Predictions, classifying reads with ML or BWA while Kraken2 is still running
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("specialized_path", type = str, help = "path in which models or BWA indices are stored")
+    parser.add_argument("report_name", type = str, help = "file name of output")
+    parser.add_argument("report_path", type = str, help = "path to store classifer output")
+    parser.add_argument("sequence_file", type = str, help = "file path of FASTA file to analyze")
+    parser.add_argument("mode", type = str, help = "The ensemble mode, either Kraken2_ML or Kraken2_BWA")
+    parser.add_argument("kraken_db", type = str, help = "path of the Kraken2 database")
+    parser.add_argument("assembly_summary", type = str, help = "file path to assembly summary")
+    parser.add_argument("--threads", type = int, default = 1, help = "number of threads used by Kraken2, and shared by BWA alignments of all workers")
+    parser.add_argument("--workers", type = int, default = 2, help = "number of batches classified at the same time")
+    parser.add_argument("--max_memory_gb", type = float, default = None, help = "memory budget in GB for BWA indices loaded at the same time by all workers")
+    parser.add_argument("--shm_gb", type = float, default = None, help = "memory budget in GB for BWA indices kept staged in shared memory (bwa shm), letting batches of a genus be aligned while Kraken2 runs without loading its index again")
+    parser.add_argument("--batch_size", type = int, default = 20000, help = "number of reads of a genus queued before they are classified")
+    parser.add_argument("--queue_depth", type = int, default = 4, help = "maximum number of chunks or batches waiting between stages")
+    parser.add_argument("--backend", type = str, default = "fasttext", choices = ["fasttext", "numpy"], help = "inference backend used to classify reads")
+    parser.add_argument("--model_cache_gb", type = float, default = 4.0, help = "memory budget in GB for models kept loaded between batches, the last model loaded always being kept")
+    parser.add_argument("--lineage_table", type = str, default = None, help = "precompiled taxid to lineage table kept between samples ({report_path}/lineage_table.npz by default)")
+    parser.add_argument("--output_format", type = str, default = "csv", choices = TABLE_FORMATS, help = "format of per-read tables, parquet storing taxa as dictionary-encoded categoricals (needs pyarrow)")
+    args = parser.parse_args()
+
+    report_path = args.report_path
+    report_name = args.report_name
+    classifier = "ML" if args.mode == "Kraken2_ML" else "BWA"
+    output = "ml" if classifier == "ML" else "bwa"
+    command = ["kraken2", "--db", args.kraken_db, "--threads", str(args.threads), "--report", f"{report_path}/{report_name}.kreport2", args.sequence_file]
+
+    ncbi = NCBITaxa()
+    table = LineageTable(args.lineage_table if args.lineage_table is not None else f"{report_path}/lineage_table.npz")
+    read_store = f"{report_path}/{report_name}_reads"
+    #Batches of a genus arrive over the whole run, so models are kept loaded within a bounded budget
+    model_cache = ModelCache(int(args.model_cache_gb * 1e9), args.backend)
+    max_memory = None if args.max_memory_gb is None else int(args.max_memory_gb * 1e9)
+    residency = None if args.shm_gb is None or classifier == "ML" else IndexResidency(args.specialized_path, int(args.shm_gb * 1e9))
+    #Run Kraken2, routing and specialized classification as concurrent stages
+    kraken_calls, preds, summary = asyncio.run(pipeline(command, args.sequence_file, read_store, classifier, args.specialized_path, table, ncbi, load_reference_assembly(args.assembly_summary), model_cache, args.backend, args.batch_size, args.queue_depth, args.workers, args.threads, max_memory = max_memory, residency = residency))
+    kraken_calls.write_lineage(output_file(report_path, report_name, "lineage_kraken", args.output_format))
+    model_output = pipeline_predictions(kraken_calls, preds, trained_genera(classifier, args.specialized_path))
+    write_table(model_output, output_file(report_path, report_name, output, args.output_format), prediction_scores(preds, len(kraken_calls)) if classifier == "ML" else None)
+    #Ensemble specialized predictions with Kraken2
+    ensemble_output = ensemble(report_path, report_name, args.mode, kraken_calls)
+    write_table(ensemble_output, output_file(report_path, report_name, f"ensemble_{output}", args.output_format))
+    report_pipeline(summary)
+    if residency is not None:
+        residency.report()
+        residency.release()
+    json.dump(summary, open(f"{report_path}/{report_name}_pipeline.json", "w"), indent = 2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import argparse
+import numpy as np
+import pandas as pd
+import os
+import time
+
+from ete3 import NCBITaxa
+from HiTaxon.evaluation_utils import fasta2kmer, fasta2bwa, evaluation, evaluation_bwa, evaluation_planned, report_plan_baseline, ensemble, confident_species_calls
+from HiTaxon.plan_utils import lineage_genus_counts, kreport_genus_counts, plan_routing, write_plan, read_plan
+from HiTaxon.prediction_utils import ModelCache
+from HiTaxon.sequence_utils import build_read_store, read_store_exists
+from HiTaxon.cache_utils import PredictionCache
+from HiTaxon.table_utils import table_path
+
+"""
+Generate Ensemble Predictions
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_path", type = str, help = "path in which models are stored")
+    parser.add_argument("bwa_path", type = str, help = "path in which bwa indices are stored")
+    parser.add_argument("report_name", type = str, help = "file name of output")
+    parser.add_argument("report_path", type = str, help = "path to store classifer output")
+    parser.add_argument("sequence_file", type = str, help = "file path of FASTA file to analyze")
+    parser.add_argument("mode", type = str, help = "The ensemble mode")
+    parser.add_argument("--max_seconds_per_read", type = float, default = 0.01, help = "highest estimated cost per read, including model or index loading, worth paying for a species call")
+    parser.add_argument("--prefer", type = str, default = "BWA", choices = ["BWA", "ML"], help = "classifier used for a genus when its cost is acceptable, the other being tried next")
+    parser.add_argument("--plan_file", type = str, default = None, help = "JSON routing plan to follow, written if it does not exist ({report_name}_plan.json by default). An existing plan is followed as is, even if Kraken2's read counts or the rates below have changed since it was written")
+    parser.add_argument("--replan", action = "store_true", help = "write the routing plan again from the current read counts and rates, replacing an existing plan")
+    parser.add_argument("--ml_load_rate", type = float, default = None, help = "bytes of FastText model loaded per second (5e8 by default)")
+    parser.add_argument("--ml_read_rate", type = float, default = None, help = "reads classified per second by a FastText model, as printed per genus by ML evaluation (1e4 by default)")
+    parser.add_argument("--bwa_load_rate", type = float, default = None, help = "bytes of BWA index loaded per second (2e8 by default)")
+    parser.add_argument("--bwa_read_rate", type = float, default = None, help = "reads aligned per second by BWA (1e3 by default)")
+    parser.add_argument("--kreport", action = "store_true", help = "count reads per genus from {report_name}.kreport2 instead of {report_name}_lineage_kraken.csv")
+    parser.add_argument("--baseline", type = str, default = None, choices = ["BWA", "ML"], help = "also always run this classifier and report its agreement and time against the plan")
+    parser.add_argument("--threads", type = int, default = 1, help = "number of genera classified at the same time and of threads shared by BWA alignments")
+    parser.add_argument("--stream", action = "store_true", help = "pack reads into a read store and fetch them by position instead of writing k-merized and renamed copies")
+    parser.add_argument("--alignment", type = str, default = "genus", choices = ["genus", "combined", "compare"], help = "align reads against the index of their genus, against the combined genus-tagged index in a single pass, or both to compare them")
+    parser.add_argument("--prescreen", action = "store_true", help = "skip aligning reads with too few k-mers in the Bloom filter of their genus, where a filter was built")
+    parser.add_argument("--backend", type = str, default = "fasttext", choices = ["fasttext", "numpy"], help = "inference backend used to classify reads")
+    parser.add_argument("--model_cache_gb", type = float, default = None, help = "memory budget in GB for models kept loaded (by default each model is loaded when used and released after)")
+    parser.add_argument("--no_dedup", action = "store_true", help = "classify every read, including exact duplicates of reads already classified")
+    parser.add_argument("--kraken_support", type = float, default = None, help = "skip specialized classification of reads whose Kraken2 species call is supported by at least this fraction of their k-mers")
+    parser.add_argument("--prediction_cache", type = str, default = None, help = "SQLite file in which predictions are kept between samples, invalidated when a model or index changes")
+    parser.add_argument("--prediction_cache_entries", type = int, default = 50000000, help = "maximum number of predictions kept in the prediction cache")
+    args = parser.parse_args()
+
+    report_path = args.report_path
+    report_name = args.report_name
+    sequence_file = args.sequence_file
+    model_path = args.model_path
+    bwa_path = args.bwa_path
+    mode = args.mode
+    num_of_threads = args.threads
+    dedup = not(args.no_dedup)
+    max_bytes = None if args.model_cache_gb is None else int(args.model_cache_gb * 1e9)
+    #Reuse predictions for reads seen in earlier samples
+    prediction_cache = None if args.prediction_cache is None else PredictionCache(args.prediction_cache, args.prediction_cache_entries)
+    if args.baseline is not None and prediction_cache is not None:
+        #Whichever run goes second would reuse the predictions of the first, so neither timed run uses the prediction cache
+        print("Prediction cache is not used when timing the plan against a baseline")
+        prediction_cache = None
+
+    #Estimate the cost of each genus and decide which classifier, if any, is worth running
+    plan_file = args.plan_file if args.plan_file is not None else f"{report_path}/{report_name}_plan.json"
+    if args.replan or not(os.path.exists(plan_file)):
+        #Rates not given are left to the defaults of classifier_costs
+        rates = {name: getattr(args, name) for name in ["ml_load_rate", "ml_read_rate", "bwa_load_rate", "bwa_read_rate"] if getattr(args, name) is not None}
+        if args.kreport:
+            genus_counts = kreport_genus_counts(f"{report_path}/{report_name}.kreport2")
+        else:
+            genus_counts = lineage_genus_counts(table_path(report_path, report_name, "lineage_kraken"))
+        write_plan(plan_routing(genus_counts, model_path, bwa_path, args.max_seconds_per_read, args.prefer, rates), plan_file)
+    plan = read_plan(plan_file)
+
+    #Keep Kraken2 species calls with strong k-mer support
+    subset = None if args.kraken_support is None else np.flatnonzero(~confident_species_calls(report_path, report_name, args.kraken_support, NCBITaxa()))
+    read_store = None
+    if args.stream:
+        #Pack FASTA file to be analyzed into a read store shared by all evaluation stages
+        read_store = f"{report_path}/{report_name}_reads"
+        if not(read_store_exists(read_store)):
+            build_read_store(sequence_file, read_store)
+    else:
+        #K-merize FASTA file for ML classifiers and rename it for BWA
+        if not(os.path.exists(f"{report_path}/{report_name}_kmer.txt")):
+            fasta2kmer(sequence_file, report_path, report_name)
+        if not(os.path.exists(f"{report_path}/{report_name}_bwa.fa")):
+            fasta2bwa(sequence_file, report_path, report_name)
+    #Generate predictions with the classifier planned for each genus
+    start = time.time()
+    planned_output = evaluation_planned(report_path, report_name, plan, model_path, bwa_path, 0.5, num_of_threads, read_store = read_store, model_cache = ModelCache(max_bytes, args.backend), backend = args.backend, dedup = dedup, prediction_cache = prediction_cache, num_threads = num_of_threads, alignment = args.alignment, prescreen = args.prescreen, subset = subset, sequence_file = sequence_file)
+    planned_seconds = time.time() - start
+    planned_output.to_csv(f"{report_path}/{report_name}_auto.csv")
+    if args.baseline is not None:
+        #Always run the baseline classifier to measure what the plan gives up and saves, with a model cache of its own so that it loads models as the plan did
+        start = time.time()
+        if args.baseline == "ML":
+            baseline_output = evaluation(report_path, report_name, model_path, 0.5, num_of_threads, read_store = read_store, model_cache = ModelCache(max_bytes, args.backend), backend = args.backend, dedup = dedup, subset = subset)
+        else:
+            baseline_output = evaluation_bwa(report_path, report_name, bwa_path, read_store, dedup = dedup, num_threads = num_of_threads, alignment = args.alignment, prescreen = args.prescreen, subset = subset)
+        report_plan_baseline(planned_output, planned_seconds, baseline_output, time.time() - start)
+    #Ensemble planned predictions with Kraken2
+    ensemble_output = ensemble(report_path, report_name, mode)
+    ensemble_output.to_csv(f"{report_path}/{report_name}_ensemble_auto.csv")
+    if prediction_cache is not None:
+        prediction_cache.report()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import argparse
+
+from ete3 import NCBITaxa
+
+from HiTaxon.kraken_utils import load_reference_assembly
+from HiTaxon.shard_utils import plan_shards, run_local, merge_shard_outputs
+
+"""
+Generate Ensemble Predictions over read shards evaluated by any number of workers sharing a filesystem
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest = "action", required = True)
+    #Options of the work queue, shared by the work and run actions
+    queue = argparse.ArgumentParser(add_help = False)
+    queue.add_argument("--workers", type = int, default = 1, help = "number of worker processes started on this machine")
+    queue.add_argument("--timeout", type = float, default = 3600, help = "seconds without a heartbeat after which a claimed shard is evaluated again by another worker")
+    queue.add_argument("--max_attempts", type = int, default = 3, help = "maximum number of times a failed or timed-out shard is evaluated")
+    queue.add_argument("--retry_seconds", type = float, default = 60, help = "seconds waited after a failed attempt before the shard is evaluated again")
+    queue.add_argument("--poll_seconds", type = float, default = 10, help = "seconds waited before checking shards claimed by other workers again")
+    plan = argparse.ArgumentParser(add_help = False)
+    plan.add_argument("specialized_path", type = str, help = "path in which models or BWA indices are stored")
+    plan.add_argument("report_name", type = str, help = "file name of output")
+    plan.add_argument("report_path", type = str, help = "path to store classifer output")
+    plan.add_argument("sequence_file", type = str, help = "file path of FASTA file to analyze")
+    plan.add_argument("mode", type = str, choices = ["Kraken2_ML", "Kraken2_BWA"], help = "The ensemble mode")
+    plan.add_argument("kraken_file", type = str, help = "file path of Kraken2 per-read output of the FASTA file")
+    plan.add_argument("assembly_summary", type = str, help = "file path to assembly summary")
+    plan.add_argument("--shards", type = int, default = 8, help = "number of read shards")
+    plan.add_argument("--shard_path", type = str, default = None, help = "directory shared by all workers ({report_path}/{report_name}_shards by default)")
+    plan.add_argument("--threads", type = int, default = 1, help = "number of threads used by each BWA alignment of a worker")
+    plan.add_argument("--alignment", type = str, default = "genus", choices = ["genus", "combined", "compare"], help = "align reads against the index of their genus, against the combined genus-tagged index in a single pass, or both to compare them")
+    plan.add_argument("--prescreen", action = "store_true", help = "skip aligning reads with too few k-mers in the Bloom filter of their genus, where a filter was built")
+    plan.add_argument("--backend", type = str, default = "fasttext", choices = ["fasttext", "numpy"], help = "inference backend used to classify reads")
+    plan.add_argument("--model_cache_gb", type = float, default = None, help = "memory budget in GB of each worker for models kept loaded between shards (by default each model is loaded when used and released after)")
+    subparsers.add_parser("plan", parents = [plan], help = "split a sample into read shards and write their manifest")
+    work = subparsers.add_parser("work", parents = [queue], help = "evaluate shards of a manifest until none is left")
+    work.add_argument("manifest", type = str, help = "file path of the manifest")
+    merge = subparsers.add_parser("merge", help = "merge shard outputs in original read order")
+    merge.add_argument("manifest", type = str, help = "file path of the manifest")
+    subparsers.add_parser("run", parents = [plan, queue], help = "plan, evaluate shards with local workers and merge")
+    args = parser.parse_args()
+
+    if args.action in ["plan", "run"]:
+        shard_path = args.shard_path if args.shard_path is not None else f"{args.report_path}/{args.report_name}_shards"
+        manifest = plan_shards(args.sequence_file, args.kraken_file, shard_path, args.shards, args.report_path, args.report_name, args.mode, args.specialized_path, NCBITaxa(), load_reference_assembly(args.assembly_summary), args.threads, args.alignment, args.prescreen, args.backend, None if args.model_cache_gb is None else int(args.model_cache_gb * 1e9))
+        print(f"Manifest written to {manifest}")
+    else:
+        manifest = args.manifest
+    if args.action in ["work", "run"]:
+        completed = run_local(manifest, args.workers, args.timeout, args.max_attempts, args.poll_seconds, args.retry_seconds)
+        print(f"{completed} shards evaluated on this machine")
+    if args.action in ["merge", "run"]:
+        merge_shard_outputs(manifest)
+
+if __name__ == "__main__":
+    main()
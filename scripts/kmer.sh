@@ -0,0 +1,13 @@
+#!/usr/bin/env bash
+GENUS_NAMES=$1
+KMER_PATH=$2
+OUTPUT_PATH=$3
+
+#Create directory if not exist
+if [ ! -d "$KMER_PATH" ]; then
+    echo "K-mer directory not found. Creating Directory..."
+    mkdir $KMER_PATH
+fi
+
+#Create sorted k-mer tables of each genus
+python "scripts/kmer/kmer_build.py" $KMER_PATH $OUTPUT_PATH $GENUS_NAMES
@@ -0,0 +1,43 @@
+import argparse
+import numpy as np
+import os
+from HiTaxon.kmer_utils import build_kmer_table, table_exists
+
+
+"""
+Create k-mer tables for exact k-mer lookup
+
+"""
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("kmer_path", type = str, help = "path in which k-mer tables are to be stored")
+    parser.add_argument("output_path", type = str, help = "path in which RefSeq data is collected and stored")
+    parser.add_argument("taxa_path", type = str, help = "path in pertaining to relevant genera")
+    parser.add_argument("--ksize", type = int, default = 31, help = "size of k-mers, at most 31")
+    args = parser.parse_args()
+
+    output_path = args.output_path
+    kmer_path = args.kmer_path
+    all_species = open(f'{output_path}/species_record.txt').read().splitlines()
+    missing_species =  open(f'{output_path}/missing_species.txt').read().splitlines()
+    relevant_genus = open(args.taxa_path).read().splitlines()
+
+    #Create dictionary with structure: {Genus => {Species => [non-redundant FASTA]}}
+    genus2add = {}
+    for species in all_species:
+        genus = species.split(" ")[0]
+        if species in missing_species or genus not in relevant_genus:
+            continue
+        species_name = species.replace(" ","_")
+        genus = species_name.split("_")[0]
+        #Skip genera whose table is already complete
+        if table_exists(f"{kmer_path}/{genus}"):
+            continue
+        genus2add.setdefault(genus, {})[species_name] = [f"{output_path}/{genus}/{species_name}/non_redundant.fa"]
+
+    for genus in np.unique(list(genus2add.keys())):
+        print(f"Building k-mer table for {genus}")
+        build_kmer_table(genus2add[genus], f"{kmer_path}/{genus}", args.ksize)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+import os
+import random
+import pandas as pd
+from HiTaxon.align_utils import shard_FASTA, genus_indices, parse_sam, merge_shards
+
+INDEX_EXTENSIONS = ["amb", "ann", "bwt", "pac", "sa"]
+SPECIES = ["Bacillus_subtilis", "Bacillus_cereus", "Bacillus_anthracis"]
+
+
+def write_genus_fasta(bwa_path, genus, species_sequences):
+    """
+    Write a BWA FASTA of a genus in the format of bwa_FASTA_generator, with index files as left by bwa index
+    Args:
+        bwa_path: path in which bwa fasta are stored
+        genus: genus of interest
+        species_sequences: dictionary with structure {species => [sequence ... sequence]}
+    """
+    with open(f"{bwa_path}/{genus}.fa", "w") as fasta:
+        for species, sequences in species_sequences.items():
+            for counter, sequence in enumerate(sequences):
+                fasta.write(f">sequence{counter}|{species}\n{sequence}\n")
+    for extension in INDEX_EXTENSIONS:
+        with open(f"{bwa_path}/{genus}.fa.{extension}", "w") as index_file:
+            index_file.write("index")
+
+def test_shard_fasta_replaces_unsharded_index(tmp_path):
+    species_sequences = {"Bacillus_subtilis": ["ACGT" * 10, "TTGA" * 10], "Bacillus_cereus": ["GGCA" * 20], "Bacillus_anthracis": ["CATG" * 15]}
+    write_genus_fasta(tmp_path, "Bacillus", species_sequences)
+    original = open(f"{tmp_path}/Bacillus.fa").read()
+    num_shards = shard_FASTA(str(tmp_path), "Bacillus", 100)
+    shards = genus_indices(str(tmp_path), "Bacillus")
+    assert num_shards == 3
+    assert shards == [f"{tmp_path}/Bacillus.shard{index}.fa" for index in range(num_shards)]
+    #Neither the unsharded FASTA nor its index files are left to be picked up as an index of the genus
+    assert sorted(os.listdir(tmp_path)) == [f"Bacillus.shard{index}.fa" for index in range(num_shards)]
+    #Every record is kept, in order, with each species within a single shard
+    assert "".join([open(shard).read() for shard in shards]) == original
+    for species in species_sequences:
+        assert sum([f"|{species}\n" in open(shard).read() for shard in shards]) == 1
+
+def toy_sam(seed, num_reads = 200):
+    """
+    Generate SAM lines of reads with several alignments each, scores being drawn from few values so that ties are frequent
+    Args:
+        seed: seed of the random generator
+        num_reads: number of reads
+    """
+    rng = random.Random(seed)
+    lines = ["@HD\tVN:1.6\n", "@SQ\tSN:sequence0|Bacillus_subtilis\tLN:100\n"]
+    for position in range(num_reads):
+        num_records = rng.randint(0, 4)
+        if num_records == 0:
+            lines.append(f"_{position}\t4\t*\t0\t0\t*\t*\t0\t0\tACGT\t*\tAS:i:0\tXS:i:0\n")
+        for record in range(num_records):
+            reference = f"sequence{rng.randint(0, 2)}|{rng.choice(SPECIES)}"
+            flag = 0 if record == 0 else rng.choice([256, 2048])
+            lines.append(f"_{position}\t{flag}\t{reference}\t1\t60\t4M\t*\t0\t0\tACGT\t*\tNM:i:0\tAS:i:{rng.choice([20, 30, 40])}\tXS:i:0\n")
+    return lines
+
+def baseline_calls(lines):
+    """
+    Resolve alignments as evaluation_bwa did before SAM records were parsed as they were read, from the output of its awk command. Returns {read => species}, with "NA" for tied reads
+    Args:
+        lines: SAM lines
+    """
+    records = []
+    for line in lines:
+        fields = line.rstrip("\n").split("\t")
+        if not(fields[0].startswith("@")) and fields[2] != "*":
+            records.append((fields[0], fields[2], int([tag for tag in fields[11:] if tag.startswith("AS:i:")][0].split(":")[2])))
+    read_2_reference = pd.DataFrame(records)
+    read_2_reference["species"] = read_2_reference[1].apply(lambda x: x.split("|")[1])
+    read_2_reference = read_2_reference.sort_values(2, ascending=False).drop_duplicates((0, "species")).sort_index()
+    r2r_dict_holder = {}
+    for index, row in read_2_reference.iterrows():
+        if row[0] not in r2r_dict_holder.keys():
+            r2r_dict_holder[row[0]] = (row[1], row[2])
+        elif row[2] > r2r_dict_holder[row[0]][1]:
+            r2r_dict_holder[row[0]] = (row[1], row[2])
+        elif row[2] == r2r_dict_holder[row[0]][1]:
+            r2r_dict_holder[row[0]] = ("|NA", row[2])
+    return {read: reference.split("|")[1] for read, (reference, score) in r2r_dict_holder.items()}
+
+def test_parse_sam_matches_baseline_ties():
+    lines = toy_sam(seed = 0)
+    calls = {read: reference.split("|")[1] for read, reference, score in parse_sam(lines)}
+    expected = baseline_calls(lines)
+    assert calls == expected
+    #The toy alignments hold unmapped, tied and resolved reads
+    assert 0 < list(calls.values()).count("NA") < len(calls) < 200
+    #Alignments rejected by keep are ignored, as if BWA had not reported them
+    keep = lambda read, reference: not(reference.endswith("|Bacillus_cereus"))
+    calls = {read: reference.split("|")[1] for read, reference, score in parse_sam(lines, keep)}
+    assert calls == baseline_calls([line for line in lines if "|Bacillus_cereus\t" not in line])
+
+def test_parse_sam_skips_records_without_score():
+    lines = ["_0\t0\tsequence0|Bacillus_subtilis\t1\t60\t4M\t*\t0\t0\tACGT\t*\tNM:i:0\n", "_1\t0\tsequence0|Bacillus_cereus\t1\t60\t4M\t*\t0\t0\tACGT\t*\tAS:i:4\n"]
+    assert list(parse_sam(lines)) == [("_1", "sequence0|Bacillus_cereus", 4)]
+
+def test_merge_shards_matches_single_index():
+    lines = toy_sam(seed = 1)
+    positions = list(range(200))
+    single = merge_shards([{int(read[1:]): (reference, score) for read, reference, score in parse_sam(lines)}], positions)
+    #Each species is held by a single shard, as written by shard_FASTA
+    shard_alignments = []
+    for species in SPECIES:
+        keep = lambda read, reference, species = species: reference.endswith(f"|{species}")
+        shard_alignments.append({int(read[1:]): (reference, score) for read, reference, score in parse_sam(lines, keep)})
+    merged = merge_shards(shard_alignments, positions)
+    assert {position: reference.split("|")[1] for position, reference in merged.items()} == {position: reference.split("|")[1] for position, reference in single.items()}
+    baseline = baseline_calls(lines)
+    assert {position: reference.split("|")[1] for position, reference in merged.items()} == {position: baseline.get(f"_{position}", "NA") for position in positions}
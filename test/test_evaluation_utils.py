@@ -0,0 +1,80 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import fasttext as ft
+from HiTaxon.evaluation_utils import evaluation
+from HiTaxon.sequence_utils import build_read_store
+from HiTaxon.train_utils import build_kmers
+from test.test_numpy_backend import KSIZE, toy_reads, train_toy_model
+
+RANKS = ['phylum', 'class', 'order', 'family', 'genus', "species"]
+
+
+def write_sample(tmp_path, report_name):
+    """
+    Write a toy sample as left by Kraken2 and fasta2kmer: its FASTA, k-merized reads and Kraken2 lineage, with reads of trained genera, of an untrained genus and without a genus, some of them duplicated
+    Args:
+        tmp_path: directory to store the sample
+        report_name: file name of output
+    """
+    reads = [read for _, read in toy_reads(seed = 1, num_reads = 15)]
+    reads = reads + reads[:5]
+    genera = (["Bacillus", "Listeria", "Clostridium", np.nan] * len(reads))[:len(reads)]
+    with open(tmp_path / f"{report_name}.fa", "w") as fasta:
+        for counter, read in enumerate(reads):
+            fasta.write(f">read{counter}\n{read}\n")
+    with open(tmp_path / f"{report_name}_kmer.txt", "w") as kmer_file:
+        for read in reads:
+            kmer_file.write(build_kmers(read, KSIZE) + "\n")
+    lineage = pd.DataFrame({rank: ["NA"] * len(reads) for rank in RANKS})
+    lineage["genus"] = genera
+    lineage.to_csv(tmp_path / f"{report_name}_lineage_kraken.csv")
+
+def sequential_evaluation(report_path, report_name, model_path, min_threshold):
+    """
+    Classify every read one at a time with its genus model, as evaluation did before batching, parallelism and deduplication
+    Args:
+        report_path: path to store classifer output
+        report_name: file name of output
+        model_path: path in which models are stored
+        min_threshold: minimum softmax score needed to use ML prediction
+    """
+    seqs = open(f"{report_path}/{report_name}_kmer.txt").read().splitlines()
+    trained_genus = [model.split("_")[0] for model in os.listdir(model_path)]
+    reference = pd.read_csv(f"{report_path}/{report_name}_lineage_kraken.csv")
+    model_preds = pd.DataFrame(np.zeros(shape = (len(seqs), 6)), columns = RANKS)
+    model_preds["genus"] = reference["genus"].apply(lambda x: x if x in trained_genus else "nan")
+    models = {}
+    species_pred = []
+    for genus, seq in zip(model_preds["genus"].values, seqs):
+        if genus == "nan":
+            pred, score = "NA", 0.49
+        else:
+            if genus not in models:
+                models[genus] = ft.load_model(f"{model_path}/{genus}_model.bin")
+            model_prediction = models[genus].predict(seq)
+            pred, score = model_prediction[0][0].split("label__")[1], model_prediction[1][0]
+        species_pred.append(pred if score >= min_threshold else "NA")
+    model_preds["species"] = species_pred
+    return model_preds
+
+@pytest.mark.parametrize("num_workers, batch_size, use_store", [(1, 100000, False), (2, 7, False), (2, 7, True)])
+def test_evaluation_matches_sequential(tmp_path, num_workers, batch_size, use_store):
+    model_path = tmp_path / "models"
+    os.makedirs(model_path)
+    train_toy_model(model_path, "Bacillus_model", lr = 1.0)
+    train_toy_model(model_path, "Listeria_model", loss = "ova", lr = 1.0)
+    #Training data is kept out of the model directory, as only models are listed there
+    for train_file in model_path.glob("*.txt"):
+        train_file.unlink()
+    write_sample(tmp_path, "sample")
+    read_store = None
+    if use_store:
+        read_store = str(tmp_path / "store")
+        build_read_store(str(tmp_path / "sample.fa"), read_store)
+    #Thresholds below every score and within the range of scores
+    for min_threshold in [0.5, 0.85]:
+        expected = sequential_evaluation(str(tmp_path), "sample", str(model_path), min_threshold)
+        actual = evaluation(str(tmp_path), "sample", str(model_path), min_threshold = min_threshold, num_workers = num_workers, batch_size = batch_size, read_store = read_store, ksize = KSIZE)
+        assert actual.to_csv() == expected.to_csv()
@@ -0,0 +1,88 @@
+import random
+import numpy as np
+from HiTaxon.kmer_utils import build_kmer_table, KmerTable
+
+KSIZE = 11
+COMPLEMENT = str.maketrans("ACGT", "TGCA")
+
+
+def canonical(kmer):
+    """
+    Return the smaller of a k-mer and its reverse complement
+    Args:
+        kmer: k-mer as a string
+    """
+    return min(kmer, kmer.translate(COMPLEMENT)[::-1])
+
+def toy_genus(tmp_path, seed):
+    """
+    Write the FASTA of three toy species, the last of which shares the first half of the first. Returns their sequences and FASTA files
+    Args:
+        tmp_path: directory to store the FASTA files
+        seed: seed of the random generator
+    """
+    rng = random.Random(seed)
+    genomes = {"species_a": "".join(rng.choices("ACGT", k = 200)), "species_b": "".join(rng.choices("ACGT", k = 200))}
+    genomes["species_c"] = genomes["species_a"][:100] + "".join(rng.choices("ACGT", k = 100))
+    species_fastas = {}
+    for species, genome in genomes.items():
+        species_fastas[species] = [str(tmp_path / f"{species}.fa")]
+        with open(species_fastas[species][0], "w") as f:
+            f.write(f">{species}\n{genome}\n")
+    return genomes, species_fastas
+
+def voting_classify(genomes, sequences, min_hits):
+    """
+    Classify reads by counting, k-mer by k-mer, the species whose genome holds each k-mer on either strand
+    Args:
+        genomes: dictionary with structure {species => genome}
+        sequences: list of reads
+        min_hits: minimum number of k-mers supporting a species for it to be assigned
+    """
+    species_kmers = {species: set([canonical(genome[start:start + KSIZE]) for start in range(len(genome) - KSIZE + 1)]) for species, genome in genomes.items()}
+    preds = []
+    scores = []
+    for sequence in sequences:
+        kmers = [canonical(sequence[start:start + KSIZE]) for start in range(len(sequence) - KSIZE + 1)]
+        kmers = [kmer for kmer in kmers if set(kmer) <= set("ACGT")]
+        votes = {species: sum([kmer in members for kmer in kmers]) for species, members in species_kmers.items()}
+        top = max(votes.values())
+        best = [species for species, count in votes.items() if count == top]
+        if len(best) == 1 and top >= min_hits and top > 0:
+            preds.append(best[0])
+            scores.append(top / len(kmers))
+        else:
+            preds.append("NA")
+            scores.append(0.0)
+    return preds, scores
+
+def test_classify_ties(tmp_path):
+    genomes, species_fastas = toy_genus(tmp_path, seed = 0)
+    build_kmer_table(species_fastas, str(tmp_path / "table"), ksize = KSIZE, block_size = 2)
+    table = KmerTable(str(tmp_path / "table"))
+    a, b, c = genomes["species_a"], genomes["species_b"], genomes["species_c"]
+    sequences = [
+        a[120:160],
+        #Reverse complement of a read of species_b
+        b[20:60].translate(COMPLEMENT)[::-1],
+        #As many k-mers of species_a as of species_b
+        a[150:180] + b[0:30],
+        #One k-mer more of species_b than of species_a
+        a[150:180] + b[0:31],
+        #Shared by species_a and species_c
+        a[10:60],
+        #Mostly shared by species_a and species_c, with a few k-mers only in species_a
+        a[80:115],
+        a[120:130] + "N" + a[131:160],
+        "ACGT",
+        "",
+    ]
+    #The read with one k-mer more of species_b is supported by exactly 21 k-mers, and the read with an N by 19
+    for min_hits in [1, 21]:
+        preds, scores = table.classify(sequences, min_hits = min_hits)
+        expected_preds, expected_scores = voting_classify(genomes, sequences, min_hits)
+        assert preds == expected_preds
+        np.testing.assert_allclose(scores, expected_scores)
+    preds, _ = table.classify(sequences)
+    assert preds[:6] == ["species_a", "species_b", "NA", "species_b", "NA", "species_a"]
+    assert table.classify([])[0] == []
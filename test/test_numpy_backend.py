@@ -0,0 +1,84 @@
+import random
+import numpy as np
+import pytest
+import fasttext as ft
+from HiTaxon.fasttext_utils import load_model
+from HiTaxon.train_utils import build_kmers
+
+KSIZE = 5
+NUCLEOTIDES = "ACGT"
+
+
+def toy_reads(seed, num_reads = 60, length = 40):
+    """
+    Generate reads of two toy species, each favouring different nucleotides
+    Args:
+        seed: seed of the random generator
+        num_reads: number of reads per species
+        length: length of each read
+    """
+    rng = random.Random(seed)
+    reads = []
+    for label, weights in [("species_a", [4, 1, 1, 2]), ("species_b", [1, 3, 4, 1])]:
+        for _ in range(num_reads):
+            reads.append((label, "".join(rng.choices(NUCLEOTIDES, weights = weights, k = length))))
+    return reads
+
+def train_toy_model(tmp_path, name, **params):
+    """
+    Train a tiny supervised FastText model on k-merized toy reads and return its file path
+    Args:
+        tmp_path: directory to store the training data and model
+        name: file name of the model
+        params: extra training parameters passed to FastText
+    """
+    train_file = tmp_path / f"{name}.txt"
+    with open(train_file, "w") as handle:
+        for label, read in toy_reads(seed = 0):
+            handle.write(f"__label__{label} {build_kmers(read, KSIZE)}\n")
+    model = ft.train_supervised(input = str(train_file), dim = 8, epoch = 5, wordNgrams = 2, minCount = 1, bucket = 1000, thread = 1, verbose = 0, seed = 0, **params)
+    model_file = tmp_path / f"{name}.bin"
+    model.save_model(str(model_file))
+    return str(model_file), model
+
+def assert_same_predictions(expected, actual):
+    """
+    Check that labels match exactly and scores agree to float32 precision
+    Args:
+        expected: (labels, scores) returned by FastText
+        actual: (labels, scores) returned by NumpyFastText
+    """
+    assert [list(labels) for labels in expected[0]] == [list(labels) for labels in actual[0]]
+    for expected_scores, actual_scores in zip(expected[1], actual[1]):
+        np.testing.assert_allclose(actual_scores, expected_scores, rtol = 1e-5, atol = 1e-6)
+
+@pytest.mark.parametrize("loss", ["softmax", "ova"])
+def test_predict_matches_fasttext(tmp_path, loss):
+    model_file, _ = train_toy_model(tmp_path, loss, loss = loss)
+    reference = ft.load_model(model_file)
+    model = load_model(model_file, backend = "numpy")
+    #Held-out reads, including one too short to hold a k-mer and one with k-mers unseen in training
+    reads = [read for _, read in toy_reads(seed = 1, num_reads = 10)] + ["ACG", "NNNNNNNN"]
+    sentences = [build_kmers(read, KSIZE) for read in reads]
+    for k, threshold in [(1, 0.0), (2, 0.0), (-1, 0.2)]:
+        expected = reference.predict(sentences, k = k, threshold = threshold)
+        assert_same_predictions(expected, model.predict(sentences, k = k, threshold = threshold))
+        assert_same_predictions(expected, model.predict_reads(reads, KSIZE, k = k, threshold = threshold))
+    #A single sentence is returned unwrapped, as by FastText
+    labels, scores = model.predict(sentences[0])
+    expected_labels, expected_scores = reference.predict(sentences[0])
+    assert labels == expected_labels
+    np.testing.assert_allclose(scores, expected_scores, rtol = 1e-5, atol = 1e-6)
+
+def test_rejects_character_ngrams(tmp_path):
+    model_file, _ = train_toy_model(tmp_path, "subwords", minn = 2, maxn = 3)
+    with pytest.raises(ValueError, match = "character n-grams"):
+        load_model(model_file, backend = "numpy")
+
+def test_rejects_quantized_models(tmp_path):
+    _, model = train_toy_model(tmp_path, "quantized")
+    model.quantize(qnorm = True, retrain = False, dsub = 2)
+    model_file = tmp_path / "quantized.ftz"
+    model.save_model(str(model_file))
+    with pytest.raises(ValueError, match = "quantized"):
+        load_model(str(model_file), backend = "numpy")
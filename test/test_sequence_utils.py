@@ -0,0 +1,45 @@
+import random
+import numpy as np
+from HiTaxon.sequence_utils import build_read_store, fasta_hashes, read_hashes, ReadStore, KmerBatches
+from HiTaxon.train_utils import build_kmers
+
+
+def toy_fasta(fasta, seed, num_reads = 50):
+    """
+    Write reads of every length from empty to a few hundred bases, with N, lowercase and ambiguity codes among their bases, wrapping some records over several lines. Returns the reads
+    Args:
+        fasta: file path to fasta
+        seed: seed of the random generator
+        num_reads: number of random reads, written after reads with only exceptions and an empty read
+    """
+    rng = random.Random(seed)
+    reads = ["", "N", "NNNNN", "acgtn"]
+    for _ in range(num_reads):
+        reads.append("".join(rng.choices("ACGT" * 20 + "NacgtRY", k = rng.randint(1, 300))))
+    with open(fasta, "w") as f:
+        for counter, read in enumerate(reads):
+            f.write(f">read{counter} description\n")
+            width = 60 if counter % 2 else 1000
+            for start in range(0, len(read), width):
+                f.write(read[start:start + width] + "\n")
+    return reads
+
+def test_read_store_round_trip(tmp_path):
+    reads = toy_fasta(tmp_path / "reads.fa", seed = 0)
+    store_path = str(tmp_path / "store")
+    #Small chunks carry partially packed bytes and exceptions from one chunk to the next
+    build_read_store(str(tmp_path / "reads.fa"), store_path, chunk_size = 7)
+    store = ReadStore(store_path)
+    assert len(store) == len(reads)
+    assert store.fetch(range(len(reads))) == reads
+    #Reads are fetched in any order, repeated or not
+    positions = np.random.default_rng(0).integers(0, len(reads), 100)
+    assert store.fetch(positions) == [reads[position] for position in positions]
+    assert store.fetch([]) == []
+    assert list(store.lengths(positions)) == [len(reads[position]) for position in positions]
+    #Digests are those of the reads as written in the FASTA, whichever way they are computed
+    assert (store.hashes(positions) == read_hashes([reads[position] for position in positions])).all()
+    assert (fasta_hashes(str(tmp_path / "reads.fa"), chunk_size = 7) == read_hashes(reads)).all()
+    batches = list(KmerBatches(store_path, positions, ksize = 5, batch_size = 30))
+    assert [len(batch) for batch in batches] == [30, 30, 30, 10]
+    assert sum(batches, []) == [build_kmers(reads[position], 5) for position in positions]